@@ -1,2 +1,3 @@
 from couchdbsession.session import Session
-
+from couchdbsession.group import SessionGroup
+from couchdbsession.sessionpool import SessionPool
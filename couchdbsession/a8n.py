@@ -3,11 +3,13 @@ Known limitations:
     * Not thread safe.
 """
 
+import collections
+import copy
 import datetime
+import inspect
 import itertools
+import json
 import types
-import UserDict
-from simplegeneric import generic
 from peak.util.proxies import ObjectWrapper
 import couchdb
 from decimal import Decimal
@@ -15,30 +17,334 @@ from decimal import Decimal
 
 _SENTINEL = object()
 
+# Shared, never modified, stand-in for a recorder table that hasn't been
+# needed yet.
+_EMPTY = {}
+
+
+class Action(object):
+    """
+    A single tracked change.
+
+    Actions are stored compactly, as slots, but behave like the dicts they
+    once were: action['path'], action.get('was'), dict(action) and
+    comparisons with dicts all work. An action only has the 'value' and 'was'
+    keys that apply to it; a 'create' has no 'was' and a 'remove' no
+    'value'. Recorded actions keep their path as a _Path, only turned into
+    a list when action['path'] is asked for.
+
+    Actions are not dicts, e.g. to json.dumps(); sessions pass flush hooks
+    dict(action) copies.
+    """
+
+    __slots__ = ('action', 'path', 'value', 'was')
+
+    def __init__(self, action, path, value=_SENTINEL, was=_SENTINEL):
+        self.action = action
+        self.path = path
+        if value is not _SENTINEL:
+            self.value = value
+        if was is not _SENTINEL:
+            self.was = was
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                pass
+            else:
+                if key == 'path' and isinstance(value, _Path):
+                    return value.list()
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Action)):
+            return dict(self) == dict(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, (dict, Action)):
+            return dict(self) != dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        for key, value in state.iteritems():
+            setattr(self, key, value)
+
+collections.Mapping.register(Action)
+
+
+class _Path(object):
+    """
+    The path to a tracked item, as a node linked to the path of its parent.
+
+    Paths are interned, through their parent's children, so extending a
+    path is a dict lookup, everything recorded under a subtree shares the
+    nodes of the subtree's path, and a path is the same object wherever
+    it's used. A path is only built as a list when it's asked for; it
+    compares equal to that list.
+    """
+
+    __slots__ = ('parent', 'name', 'depth', 'children')
+
+    def __init__(self, parent=None, name=None):
+        self.parent = parent
+        self.name = name
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.children = None
+
+    def child(self, name):
+        # Most paths only ever have one child, which is kept as it is
+        # rather than in a dict.
+        children = self.children
+        if children is None:
+            path = self.children = _Path(self, name)
+            return path
+        if type(children) is _Path:
+            if children.name == name:
+                return children
+            children = self.children = {children.name: children}
+        path = children.get(name)
+        if path is None:
+            path = children[name] = _Path(self, name)
+        return path
+
+    def ancestor(self, depth):
+        """
+        Return the prefix of this path that's depth names long.
+        """
+        path = self
+        while path.depth > depth:
+            path = path.parent
+        return path
+
+    def startswith(self, prefix):
+        return self.depth >= prefix.depth and self.ancestor(prefix.depth) is prefix
+
+    def list(self):
+        names = []
+        path = self
+        while path.parent is not None:
+            names.append(path.name)
+            path = path.parent
+        names.reverse()
+        return names
+
+    def __len__(self):
+        return self.depth
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __getitem__(self, pos):
+        return self.list()[pos]
+
+    def __eq__(self, other):
+        if isinstance(other, list):
+            return self.list() == other
+        return self is other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return '<path %r>' % (self.list(),)
+
+    def _children_named(self, names):
+        """
+        Return the set of child paths, that have been used, for names.
+        """
+        children = self.children
+        if children is None:
+            return set()
+        if type(children) is _Path:
+            return set(children for name in names if children.name == name)
+        return set(children[name] for name in names if name in children)
+
 
 class Tracker(object):
 
-    def __init__(self, dirty_callback=None):
+    # Most tracked documents are never changed so the change log and the
+    # recorder tables are only allocated when they're first needed.
+    __slots__ = ('_dirty_callback', '_change_callback', '_changes',
+                 '_barrier', '_copied', '_keep_nested', '_root',
+                 '_next_recorder_id', '_root_path', '_recorders',
+                 '_recorder_creates', '_recorder_edits')
+
+    def __init__(self, dirty_callback=None, change_callback=None):
         self._dirty_callback = dirty_callback
-        self._changes = []
-        self._recorder_id = itertools.count()
-        self._recorder_paths = {}
-        self._recorder_creates = {}
-        self._recorder_edits = {}
+        self._change_callback = change_callback
+        self._changes = ()
+        self._barrier = 0
+        self._copied = 0
+        self._keep_nested = False
+        self._root = None
+        self._next_recorder_id = 0
+        self._root_path = _Path()
+        self._recorders = None
+        self._recorder_creates = None
+        self._recorder_edits = None
 
     def track(self, obj):
         """
         Start tracking an object.
         """
-        return self._track(obj, [])
+        self._root = getattr(obj, '__subject__', obj)
+        return self._track(obj, self._root_path)
 
     def clear(self):
         """
         Forget all changes tracked so far.
         """
-        self._changes = []
-        self._recorder_creates = {}
-        self._recorder_edits = {}
+        self._changes = ()
+        self._barrier = 0
+        self._copied = 0
+        self._keep_nested = False
+        self._recorder_creates = None
+        self._recorder_edits = None
+
+    def detach(self):
+        """
+        Stop tracking: forget all changes and stop calling the callbacks.
+
+        Nested objects stop being tracked and the tracker and its recorders
+        no longer refer to each other, so they're freed as soon as they're
+        dropped rather than left for the garbage collector.
+        """
+        self._dirty_callback = None
+        self._change_callback = None
+        if self._recorders:
+            for recorder in self._recorders.itervalues():
+                recorder._path = None
+        self._recorders = None
+        self.clear()
+
+    def savepoint(self):
+        """
+        Return a savepoint that the tracked object can be rolled back to with
+        rollback(), until the tracker is next cleared.
+        """
+        # Created and edited values are recorded by reference and would be
+        # changed, untracked, in place. Copy them so that anything done from
+        # now on is tracked and can be undone.
+        for action in itertools.islice(self._changes, self._copied, None):
+            if action['action'] != 'remove':
+                action['value'] = copy.deepcopy(action['value'])
+        self._copied = len(self._changes)
+        # Nothing recorded before the savepoint can be merged with or removed
+        # by later changes. Nested actions are kept, even once their parent
+        # is replaced, because the replaced value has them applied.
+        self._barrier = len(self._changes)
+        self._keep_nested = True
+        self._recorder_creates = None
+        self._recorder_edits = None
+        return len(self._changes)
+
+    def rollback(self, savepoint):
+        """
+        Undo, in place, everything changed since the savepoint was taken by
+        walking the change log backwards.
+
+        Wrappers of nested objects obtained before the rollback are no longer
+        tracked.
+        """
+        if savepoint > len(self._changes):
+            raise ValueError('savepoint is no longer valid')
+        for action in reversed(self._changes[savepoint:]):
+            _undo(self._root, action)
+        if savepoint < len(self._changes):
+            del self._changes[savepoint:]
+        self._barrier = self._copied = savepoint
+        self._recorder_creates = None
+        self._recorder_edits = None
+        # Detach everything but the root recorders; the nested objects they
+        # were recording may have been moved or replaced.
+        if self._recorders:
+            for recorder in self._recorders.itervalues():
+                recorder._path = None
+        self._recorders = None
+
+    def json_patch(self):
+        """
+        Return the tracked changes as an RFC 6902 JSON Patch. See
+        json_patch().
+        """
+        return json_patch(self)
+
+    def dump(self, fp, encode=None, was=True):
+        """
+        Write the tracked changes to fp. See dump_changes().
+        """
+        dump_changes(self, fp, encode, was)
+
+    def load(self, fp, decode=None):
+        """
+        Replace the tracked changes with those read from fp. See
+        load_changes().
+        """
+        self.restore(load_changes(fp, decode))
+
+    def restore(self, changes):
+        """
+        Replace the tracked changes, e.g. with changes previously taken from
+        this tracker before the object was serialised.
+        """
+        self._changes = list(changes) or ()
+        # Nothing restored can be merged with or removed by later changes.
+        self._barrier = len(self._changes)
+        self._copied = 0
+        self._recorder_creates = None
+        self._recorder_edits = None
 
     def freeze(self):
         """
@@ -56,40 +362,132 @@ class Tracker(object):
         return iter(self._changes)
 
     def append(self, change):
-        if not self._changes and self._dirty_callback:
-            self._dirty_callback()
+        if not self._changes:
+            if self._dirty_callback:
+                self._dirty_callback()
+            if not isinstance(self._changes, list):
+                self._changes = []
         self._changes.append(change)
 
+    def index(self, action):
+        """
+        Return the position of an action in the change log. Equal actions are
+        recorded at different times so look for the action itself, starting
+        with the most recent.
+        """
+        changes = self._changes
+        for pos in xrange(len(changes)-1, -1, -1):
+            if changes[pos] is action:
+                return pos
+        raise ValueError('action not in change log')
+
+    def notify(self, action):
+        """
+        Pass an action, exactly as it happened, to the change callback.
+        """
+        if self._change_callback is not None:
+            # Copy the action; the original may be updated by later changes.
+            self._change_callback(dict(action))
+
     def _make_recorder(self, path):
-        id = self._recorder_id.next()
-        self._recorder_paths[id] = path
-        return Recorder(self, id)
+        # Share a recorder between all wrappers of the same nested object so
+        # they all know which of its items have been created or edited, and
+        # are therefore no longer tracked. The root is never shared in case
+        # more than one object is tracked.
+        if path is self._root_path:
+            return self._new_recorder(path)
+        if self._recorders is None:
+            self._recorders = {}
+        recorder = self._recorders.get(path)
+        if recorder is None:
+            recorder = self._recorders[path] = self._new_recorder(path)
+        return recorder
+
+    def _new_recorder(self, path):
+        id = self._next_recorder_id
+        self._next_recorder_id += 1
+        return Recorder(self, id, path)
+
+    def _forget_tables(self, id):
+        for tables in (self._recorder_creates, self._recorder_edits):
+            if tables:
+                tables.pop(id, None)
 
     def _track(self, obj, path):
+        # Most values are immutable and returned as they are.
+        if type(obj) in _track.immutable:
+            return obj
         if isinstance(obj, Tracked):
             return obj
         return _track(obj, self, path)
 
 
-@generic
-def _track(obj, path, tracker):
+class _TypeDispatcher(object):
+    """
+    Call the function registered for the type of the first arg, or one of
+    its base classes, like simplegeneric's generic functions but with a
+    type to function table that's built as types are seen.
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._registry = {}
+        self._table = {}
+        # Types whose values are returned as they are.
+        self.immutable = frozenset()
+
+    def __call__(self, obj, *args):
+        func = self._table.get(type(obj))
+        if func is None:
+            func = self._find(getattr(obj, '__class__', type(obj)))
+            self._table[type(obj)] = func
+        return func(obj, *args)
+
+    def when_type(self, *types):
+        """
+        Decorator registering a function for one or more types.
+        """
+        def register(func):
+            for t in types:
+                self._registry[t] = func
+            self._table = {}
+            self.immutable = frozenset(t for (t, f) in self._registry.iteritems()
+                                       if f is _track_immutable)
+            return func
+        return register
+
+    def _find(self, cls):
+        for base in inspect.getmro(cls):
+            func = self._registry.get(base)
+            if func is not None:
+                return func
+        return self._default
+
+
+def _untrackable(obj, tracker, path):
     pass
 
-@_track.when_type(types.NoneType)
-@_track.when_type(bool)
-@_track.when_type(float)
-@_track.when_type(int)
-@_track.when_type(long)
-@_track.when_type(str)
-@_track.when_type(unicode)
-@_track.when_type(datetime.datetime)
-@_track.when_type(datetime.date)
-@_track.when_type(datetime.time)
-@_track.when_type(Decimal)
-@_track.when_type(tuple)
 def _track_immutable(obj, tracker, path):
     return obj
 
+_track = _TypeDispatcher(_untrackable)
+
+# Register tracking for other types with @when_type(type), decorating a
+# function of (obj, tracker, path) that returns the value to hand out. path
+# is a _Path; list(path) if a list is needed.
+when_type = _track.when_type
+
+
+def register_immutable(*types):
+    """
+    Register types whose values are never tracked, just returned.
+    """
+    _track.when_type(*types)(_track_immutable)
+
+register_immutable(types.NoneType, bool, float, int, long, str, unicode,
+                   datetime.datetime, datetime.date, datetime.time, Decimal,
+                   tuple)
+
 @_track.when_type(couchdb.Document)
 def _track_doc(obj, tracker, path):
     return Document(obj, tracker._make_recorder(path))
@@ -105,31 +503,64 @@ def _track_list(obj, tracker, path):
 
 class Recorder(object):
 
-    def __init__(self, tracker, id):
+    # _path is the recorded object's _Path, or None once it's no longer
+    # tracked.
+    __slots__ = ('_tracker', '_id', '_path')
+
+    def __init__(self, tracker, id, path):
         self._tracker = tracker
         self._id = id
+        self._path = path
 
     @property
     def _creates(self):
-        return self._tracker._recorder_creates.setdefault(self._id, {})
+        """
+        The items created since the last barrier; read only, see _table().
+        """
+        tables = self._tracker._recorder_creates
+        if tables is None:
+            return _EMPTY
+        return tables.get(self._id, _EMPTY)
 
     @property
     def _edits(self):
-        return self._tracker._recorder_edits.setdefault(self._id, {})
+        """
+        The items edited since the last barrier; read only, see _table().
+        """
+        tables = self._tracker._recorder_edits
+        if tables is None:
+            return _EMPTY
+        return tables.get(self._id, _EMPTY)
 
-    @property
-    def _path(self):
-        return self._tracker._recorder_paths[self._id]
+    def _table(self, name):
+        """
+        Return this recorder's table from the tracker's named tables,
+        allocating them if necessary, so it can be changed.
+        """
+        tables = getattr(self._tracker, name)
+        if tables is None:
+            tables = {}
+            setattr(self._tracker, name, tables)
+        table = tables.get(self._id)
+        if table is None:
+            table = tables[self._id] = {}
+        return table
 
     def create(self, path, value):
-        action = {'action': 'create',
-                  'path': self._path + [path],
-                  'value': value}
-        self._creates[path] = action
+        if self._path is None:
+            return
+        action = Action('create', self._path.child(path), value)
+        self._table('_recorder_creates')[path] = action
         self._tracker.append(action)
+        self._tracker.notify(action)
 
     def edit(self, path, value, was):
+        if self._path is None:
+            return
         self._remove_nested_actions(path)
+        self._detach_children(path, was)
+        action = Action('edit', self._path.child(path), value, was)
+        self._tracker.notify(action)
         # Update a previous 'create' action.
         create_action = self._creates.get(path)
         if create_action is not None:
@@ -141,55 +572,439 @@ class Recorder(object):
             edit_action['value'] = value
             return
         # Add a new 'edit' action.
-        action = {'action': 'edit',
-                  'path': self._path + [path],
-                  'value': value,
-                  'was': was}
-        self._edits[path] = action
+        self._table('_recorder_edits')[path] = action
         self._tracker.append(action)
 
     def remove(self, path, was):
+        if self._path is None:
+            return
         self._remove_nested_actions(path)
+        self._detach_children(path, was)
+        action = Action('remove', self._path.child(path), was=was)
+        self._tracker.notify(action)
         # Remove a previous 'create' action.
-        create_action = self._creates.pop(path, None)
-        if create_action is not None:
-            self._tracker._changes.remove(create_action)
+        create_action = None
+        if path in self._creates:
+            create_action = self._table('_recorder_creates').pop(path)
+        if create_action is not None and self._can_forget(create_action):
+            del self._tracker._changes[self._tracker.index(create_action)]
             return
-        # Remove a previous 'edit' action and continue.
-        edit_action = self._edits.pop(path, None)
+        # Remove a previous 'edit' action, keeping what the value was before
+        # it, and continue.
+        edit_action = None
+        if path in self._edits:
+            edit_action = self._table('_recorder_edits').pop(path)
         if edit_action is not None:
-            self._tracker._changes.remove(edit_action)
+            del self._tracker._changes[self._tracker.index(edit_action)]
+            action['was'] = edit_action['was']
         # Add a new 'delete' action.
-        action = {'action': 'remove',
-                  'path': self._path + [path],
-                  'was': was}
         self._tracker.append(action)
 
+    def record(self, changes):
+        """
+        Record a batch of changes to different items, each an (action, path,
+        value, was) tuple as passed to create(), edit() and remove(), with
+        _SENTINEL for whichever of value and was doesn't apply.
+
+        The result is the same as making the changes one at a time but the
+        change log and recorded paths are scanned once for the whole batch,
+        not once per item.
+        """
+        if self._path is None or not changes:
+            return
+        tracker = self._tracker
+        my_path = self._path
+        replaced = [(path, was) for (action, path, value, was) in changes
+                    if action != 'create']
+        self._remove_nested_actions_many([path for (path, was) in replaced])
+        self._detach_children_many(replaced)
+        dropped = set()
+        added = []
+        for action_name, path, value, was in changes:
+            action = Action(action_name, my_path.child(path), value, was)
+            tracker.notify(action)
+            if action_name == 'create':
+                self._table('_recorder_creates')[path] = action
+                added.append(action)
+            elif action_name == 'edit':
+                # Update a previous 'create' or 'edit' action.
+                previous = self._creates.get(path)
+                if previous is None:
+                    previous = self._edits.get(path)
+                if previous is not None:
+                    previous['value'] = value
+                    continue
+                self._table('_recorder_edits')[path] = action
+                added.append(action)
+            else:
+                # Drop a previous 'create' action, or a previous 'edit'
+                # action, keeping what the value was before it.
+                if path in self._creates:
+                    create_action = self._table('_recorder_creates').pop(path)
+                    if self._can_forget(create_action):
+                        dropped.add(id(create_action))
+                        continue
+                if path in self._edits:
+                    edit_action = self._table('_recorder_edits').pop(path)
+                    dropped.add(id(edit_action))
+                    action['was'] = edit_action['was']
+                added.append(action)
+        if dropped:
+            tracker._changes[:] = [action for action in tracker._changes
+                                   if id(action) not in dropped]
+        for action in added:
+            tracker.append(action)
+
+    def replaces_live(self, path, value, was):
+        """
+        Check if an equal value is replacing a created or edited value. The
+        recorded action refers to the old object and must be updated as any
+        later changes will be made to the new one.
+        """
+        return value is not was and (path in self._creates or path in self._edits)
+
     def track_child(self, obj, name):
-        return self._tracker._track(obj, self._path+[name])
+        my_path = self._path
+        if my_path is None:
+            return obj
+        return self._tracker._track(obj, my_path.child(name))
 
     def adjust_child_paths(self, adjuster):
-        # Avoid looking up the path multiple times.
+        """
+        Move this list's items, and everything inside them, to the positions
+        returned by adjuster(pos). Items for which adjuster returns None are
+        no longer in the list and stop being tracked.
+        """
+        tracker = self._tracker
+        # Existing actions keep the positions they were recorded with, which
+        # is what applying them in order expects, but those positions may
+        # now refer to different items: stop removing old nested actions.
+        tracker._barrier = len(tracker._changes)
+        # Move the record of which items were created or edited.
+        for tables in (tracker._recorder_creates, tracker._recorder_edits):
+            table = tables and tables.get(self._id)
+            if table:
+                tables[self._id] = dict((adjuster(pos), action)
+                                        for (pos, action) in table.iteritems()
+                                        if adjuster(pos) is not None)
+        if not tracker._recorders:
+            return
         my_path = self._path
-        my_path_len = len(self._path)
-        # Loop over all the recorded paths, calling the adjuster for any
-        # immediate children, and updating the paths for the future.
-        for id, path in self._tracker._recorder_paths.iteritems():
-            if not (path[:my_path_len] == my_path and len(path) > my_path_len):
+        my_depth = my_path.depth
+        # Loop over the recorders of everything inside this list, calling
+        # the adjuster for the item each is in, and moving them to their new
+        # paths.
+        moved = [(path, recorder) for (path, recorder) in tracker._recorders.iteritems()
+                 if path.depth > my_depth and path.startswith(my_path)]
+        # Unregister everything first so moved recorders don't replace each
+        # other.
+        for path, recorder in moved:
+            del tracker._recorders[path]
+        for path, recorder in moved:
+            pos = adjuster(path.ancestor(my_depth+1).name)
+            if pos is None:
+                # The item has gone; forget it and everything inside it.
+                recorder._path = None
+                tracker._forget_tables(recorder._id)
                 continue
-            child_path = path[my_path_len]
-            remaining_path = path[my_path_len+1:]
-            new_path = my_path + [adjuster(path[-1])] + remaining_path
-            self._tracker._recorder_paths[id] = new_path
+            new_path = my_path.child(pos)
+            for name in path.list()[my_depth+1:]:
+                new_path = new_path.child(name)
+            recorder._path = new_path
+            tracker._recorders[new_path] = recorder
+
+    def _detach_children(self, path, was):
+        """
+        Stop tracking a replaced or removed value and everything inside it,
+        so nothing tracked later at the same path is mistaken for it.
+        """
+        self._detach_children_many([(path, was)])
+
+    def _detach_children_many(self, replaced):
+        """
+        Detach the values of a batch of (path, was) items in a single scan of
+        the recorded paths.
+        """
+        tracker = self._tracker
+        if not tracker._recorders:
+            return
+        my_path = self._path
+        items = my_path._children_named(path for (path, was) in replaced
+                                        if isinstance(was, (dict, list, Tracked)))
+        if not items:
+            return
+        depth = my_path.depth + 1
+        detached = [(path, recorder) for (path, recorder) in tracker._recorders.iteritems()
+                    if path.depth >= depth and path.ancestor(depth) in items]
+        for path, recorder in detached:
+            del tracker._recorders[path]
+            recorder._path = None
+            tracker._forget_tables(recorder._id)
+
+    def _can_forget(self, create_action):
+        """
+        Check if a 'create' action can be removed from the change log without
+        changing the meaning of the actions recorded after it.
+        """
+        # Dictionary keys don't depend on each other.
+        if not isinstance(create_action.path.name, (int, long)):
+            return True
+        # List positions recorded after the item was created assume it's
+        # there. Everything after the barrier was recorded, with a _Path.
+        changes = self._tracker._changes
+        pos = self._tracker.index(create_action)
+        if pos < self._tracker._barrier:
+            return False
+        my_path = self._path
+        for i in xrange(pos+1, len(changes)):
+            if changes[i].path.startswith(my_path):
+                return False
+        return True
 
     def _remove_nested_actions(self, path):
-        full_path = self._path + [path]
-        full_path_len = len(full_path)
-        to_delete = (i for (i,change) in enumerate(self._tracker._changes)
-                     if change['path'][:full_path_len] == full_path and 
-                         len(change['path']) > full_path_len)
-        for i in sorted(to_delete, reverse=True):
-            del self._tracker._changes[i]
+        self._remove_nested_actions_many([path])
+
+    def _remove_nested_actions_many(self, paths):
+        """
+        Remove the actions recorded inside a batch of replaced or removed
+        items in a single scan of the change log.
+        """
+        if self._tracker._keep_nested or not paths:
+            return
+        items = self._path._children_named(paths)
+        if not items:
+            return
+        depth = self._path.depth + 1
+        changes = self._tracker._changes
+        to_delete = [i for i in xrange(self._tracker._barrier, len(changes))
+                     if changes[i].path.depth > depth and
+                         changes[i].path.ancestor(depth) in items]
+        for i in reversed(to_delete):
+            del changes[i]
+
+
+_ACTION_CODES = {'create': 'c', 'edit': 'e', 'remove': 'r'}
+_ACTION_NAMES = dict((v, k) for (k, v) in _ACTION_CODES.iteritems())
+
+
+def dump_changes(changes, fp, encode=None, was=True):
+    """
+    Write changes to fp as compact JSON lines.
+
+    Each change is written as a list of [code, path, value, was], where code
+    is 'c', 'e' or 'r', without the value or was that the action does not
+    have. Path segments that are strings are interned: a ['s', ...] line
+    adds segments to a table and paths refer to them by position. List
+    positions are written as -(pos+1).
+
+    encode, if given, is called with every value and was before it's
+    written. Pass was=False to leave out the values that were replaced or
+    removed.
+    """
+    segments = {}
+    for change in changes:
+        path = []
+        new_segments = []
+        for name in change['path']:
+            if isinstance(name, (int, long)):
+                path.append(-name-1)
+                continue
+            pos = segments.get(name)
+            if pos is None:
+                pos = segments[name] = len(segments)
+                new_segments.append(name)
+            path.append(pos)
+        if new_segments:
+            fp.write(_dumps(['s'] + new_segments))
+            fp.write('\n')
+        record = [_ACTION_CODES[change['action']], path]
+        if change['action'] != 'remove':
+            record.append(change['value'])
+        if was and change['action'] != 'create':
+            record.append(change['was'])
+        if encode is not None:
+            record[2:] = [encode(value) for value in record[2:]]
+        fp.write(_dumps(record))
+        fp.write('\n')
+
+
+def load_changes(fp, decode=None):
+    """
+    Read changes written by dump_changes() from fp, generating actions like
+    those from iterating a Tracker.
+    """
+    segments = []
+    for line in fp:
+        record = json.loads(line)
+        if record[0] == 's':
+            segments.extend(record[1:])
+            continue
+        values = record[2:]
+        if decode is not None:
+            values = [decode(value) for value in values]
+        change = Action(_ACTION_NAMES[record[0]],
+                        [segments[i] if i >= 0 else -i-1 for i in record[1]])
+        if change['action'] != 'remove':
+            change['value'] = values.pop(0)
+        if values:
+            change['was'] = values[0]
+        yield change
+
+
+def apply_changes(obj, changes):
+    """
+    Apply changes, in order, to obj.
+
+    obj may be a plain object or a tracked one, in which case the changes
+    are tracked too. Created and edited values are copied so later changes
+    don't change the change log, or another object it's applied to.
+    """
+    for change in changes:
+        path = change['path']
+        parent = obj
+        for name in path[:-1]:
+            parent = parent[name]
+        name = path[-1]
+        if change['action'] == 'create':
+            if isinstance(parent, (list, List)):
+                parent.insert(name, copy.deepcopy(change['value']))
+            else:
+                parent[name] = copy.deepcopy(change['value'])
+        elif change['action'] == 'edit':
+            parent[name] = copy.deepcopy(change['value'])
+        elif change['action'] == 'remove':
+            del parent[name]
+
+
+def _undo(obj, action):
+    """
+    Undo a single action on an untracked object.
+    """
+    path = action['path']
+    for name in path[:-1]:
+        obj = obj[name]
+    name = path[-1]
+    if action['action'] == 'create':
+        del obj[name]
+    elif action['action'] == 'remove' and isinstance(obj, list):
+        obj.insert(name, action['was'])
+    else:
+        obj[name] = action['was']
+
+
+_PATCH_OPS = {'create': 'add', 'edit': 'replace', 'remove': 'remove'}
+
+
+def json_patch(changes):
+    """
+    Convert changes to an RFC 6902 JSON Patch, i.e. a list of operations.
+
+    List positions in a change log are the positions at the time each change
+    was made, which is exactly what a patch applied in order expects, so
+    each change maps to a single operation.
+    """
+    patch = []
+    for change in changes:
+        op = {'op': _PATCH_OPS[change['action']],
+              'path': _pointer(change['path'])}
+        if change['action'] != 'remove':
+            op['value'] = change['value']
+        patch.append(op)
+    return patch
+
+
+def apply_json_patch(obj, patch):
+    """
+    Apply an RFC 6902 JSON Patch to obj, in place.
+
+    A failed 'test' operation or invalid path raises a ValueError, leaving
+    obj partially patched. Added and replaced values are copied, so the
+    patch can be applied to any number of objects.
+    """
+    for op in patch:
+        name = op['op']
+        parent, key = _resolve(obj, op['path'])
+        if name == 'add':
+            _patch_add(parent, key, copy.deepcopy(op['value']))
+        elif name == 'remove':
+            _patch_remove(parent, key)
+        elif name == 'replace':
+            _patch_get(parent, key)
+            parent[key] = copy.deepcopy(op['value'])
+        elif name == 'move':
+            from_parent, from_key = _resolve(obj, op['from'])
+            _patch_add(parent, key, _patch_remove(from_parent, from_key))
+        elif name == 'copy':
+            from_parent, from_key = _resolve(obj, op['from'])
+            _patch_add(parent, key, copy.deepcopy(_patch_get(from_parent, from_key)))
+        elif name == 'test':
+            if _patch_get(parent, key) != op['value']:
+                raise ValueError('test failed: %r' % (op,))
+        else:
+            raise ValueError('unknown op: %r' % (op,))
+    return obj
+
+
+def _pointer(path):
+    return ''.join('/' + unicode(name).replace('~', '~0').replace('/', '~1')
+                   for name in path)
+
+
+def _resolve(obj, pointer):
+    """
+    Find the container of the item pointed to and the item's key or position
+    in it.
+    """
+    if not pointer:
+        raise ValueError('cannot patch the root of a document')
+    names = [name.replace('~1', '/').replace('~0', '~')
+             for name in pointer.split('/')[1:]]
+    for name in names[:-1]:
+        obj = _patch_get(obj, _key(obj, name))
+    return obj, _key(obj, names[-1])
+
+
+def _key(obj, name):
+    if not isinstance(obj, (list, List)):
+        return name
+    if name == '-':
+        return len(obj)
+    try:
+        return int(name)
+    except ValueError:
+        raise ValueError('invalid list position: %r' % (name,))
+
+
+def _patch_get(obj, key):
+    try:
+        return obj[key]
+    except (KeyError, IndexError, TypeError):
+        raise ValueError('path not found: %r' % (key,))
+
+
+def _patch_add(obj, key, value):
+    if isinstance(obj, (list, List)):
+        if not 0 <= key <= len(obj):
+            raise ValueError('list position out of range: %r' % (key,))
+        obj.insert(key, value)
+    else:
+        obj[key] = value
+
+
+def _patch_remove(obj, key):
+    value = _patch_get(obj, key)
+    del obj[key]
+    return value
+
+
+def _dumps(obj):
+    return json.dumps(obj, default=_unwrap, separators=(',', ':'))
+
+
+def _unwrap(obj):
+    if isinstance(obj, Tracked):
+        return obj.__subject__
+    raise TypeError(repr(obj) + " is not JSON serializable")
 
 
 class Tracked(ObjectWrapper):
@@ -198,10 +1013,12 @@ class Tracked(ObjectWrapper):
     """
 
 
-class Dictionary(UserDict.DictMixin, Tracked):
-
-    # TODO:
-    #   __contains__(), __iter__(), and iteritems() to improve performance
+class Dictionary(Tracked):
+    """
+    Tracked dict, implementing the whole mapping protocol directly on the
+    dict it wraps. Anything not implemented here, e.g. copy(), is passed
+    through to the dict untracked.
+    """
 
     __recorder = None
     _private = []
@@ -212,6 +1029,8 @@ class Dictionary(UserDict.DictMixin, Tracked):
 
     def __getitem__(self, name):
         value = self.__subject__.__getitem__(name)
+        if type(value) in _track.immutable:
+            return value
         if name in self.__recorder._creates or name in self.__recorder._edits:
             return value
         return self.__recorder.track_child(value, name)
@@ -221,7 +1040,7 @@ class Dictionary(UserDict.DictMixin, Tracked):
             was = self.__subject__.get(name, _SENTINEL)
             if was is _SENTINEL:
                 self.__recorder.create(name, value)
-            elif value != was:
+            elif value != was or self.__recorder.replaces_live(name, value, was):
                 self.__recorder.edit(name, value, was)
         return self.__subject__.__setitem__(name, value)
 
@@ -230,9 +1049,97 @@ class Dictionary(UserDict.DictMixin, Tracked):
         self.__subject__.__delitem__(name)
         self.__recorder.remove(name, was)
 
+    def __contains__(self, name):
+        return name in self.__subject__
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.__subject__)
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.__subject__)
+
     def keys(self):
         return self.__subject__.keys()
 
+    def get(self, name, default=None):
+        value = self.__subject__.get(name, _SENTINEL)
+        if value is _SENTINEL:
+            return default
+        return self.__track_child(name, value)
+
+    def iteritems(self):
+        for name, value in self.__subject__.iteritems():
+            yield name, self.__track_child(name, value)
+
+    def itervalues(self):
+        for name, value in self.__subject__.iteritems():
+            yield self.__track_child(name, value)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def update(self, other=(), **kwargs):
+        # Only the last value for each name counts.
+        values = {}
+        if hasattr(other, 'iteritems'):
+            values.update(other.iteritems())
+        elif hasattr(other, 'keys'):
+            values.update((name, other[name]) for name in other.keys())
+        else:
+            values.update(other)
+        values.update(kwargs)
+        changes = []
+        for name, value in values.iteritems():
+            if name in self._private:
+                continue
+            was = self.__subject__.get(name, _SENTINEL)
+            if was is _SENTINEL:
+                changes.append(('create', name, value, _SENTINEL))
+            elif value != was or self.__recorder.replaces_live(name, value, was):
+                changes.append(('edit', name, value, was))
+        self.__recorder.record(changes)
+        self.__subject__.update(values)
+
+    def setdefault(self, name, default=None):
+        value = self.__subject__.get(name, _SENTINEL)
+        if value is not _SENTINEL:
+            return self.__track_child(name, value)
+        self[name] = default
+        return default
+
+    def pop(self, name, *default):
+        if name not in self.__subject__ and default:
+            return default[0]
+        value = self.__subject__.pop(name)
+        self.__recorder.remove(name, value)
+        return value
+
+    def popitem(self):
+        name, value = self.__subject__.popitem()
+        self.__recorder.remove(name, value)
+        return name, value
+
+    def clear(self):
+        changes = [('remove', name, _SENTINEL, was)
+                   for (name, was) in self.__subject__.iteritems()]
+        self.__subject__.clear()
+        self.__recorder.record(changes)
+
+    def __track_child(self, name, value):
+        # As __getitem__, for values already looked up.
+        if type(value) in _track.immutable:
+            return value
+        if name in self.__recorder._creates or name in self.__recorder._edits:
+            return value
+        return self.__recorder.track_child(value, name)
+
 
 class Document(Dictionary):
     _private = ['_id', '_rev', '_attachments']
@@ -248,13 +1155,17 @@ class List(Tracked):
 
     def __iter__(self):
         for pos, item in enumerate(self.__subject__):
-            if pos in self.__recorder._creates or pos in self.__recorder._edits:
+            if type(item) in _track.immutable:
+                yield item
+            elif pos in self.__recorder._creates or pos in self.__recorder._edits:
                 yield item
             else:
                 yield self.__recorder.track_child(item, pos)
 
     def __getitem__(self, pos):
         value = self.__subject__.__getitem__(pos)
+        if type(value) in _track.immutable:
+            return value
         if pos in self.__recorder._creates or pos in self.__recorder._edits:
             return value
         return self.__recorder.track_child(value, pos)
@@ -264,15 +1175,17 @@ class List(Tracked):
         
     def __setitem__(self, pos, item):
         was = self.__subject__[pos]
+        pos = self.__real_pos(pos)
         self.__subject__.__setitem__(pos, item)
-        if item != was:
+        if item != was or self.__recorder.replaces_live(pos, item, was):
             self.__recorder.edit(pos, item, was)
 
     def __delitem__(self, pos):
         was = self.__subject__[pos]
+        pos = self.__real_pos(pos)
         self.__subject__.__delitem__(pos)
         self.__recorder.remove(pos, was)
-        self.__recorder.adjust_child_paths(_make_list_adjuster(-1, pos))
+        self.__recorder.adjust_child_paths(_make_list_remover(pos))
 
     def __setslice__(self, *a, **k):
         raise NotImplementedError()
@@ -292,7 +1205,7 @@ class List(Tracked):
 
     def insert(self, pos, item):
         pos = self.__real_pos(pos)
-        self.__recorder.adjust_child_paths(_make_list_adjuster(+1, pos))
+        self.__recorder.adjust_child_paths(_make_list_inserter(pos))
         self.__recorder.create(pos, item)
         return self.__subject__.insert(pos, item)
 
@@ -303,13 +1216,13 @@ class List(Tracked):
         except IndexError:
             raise
         self.__recorder.remove(pos, item)
-        self.__recorder.adjust_child_paths(_make_list_adjuster(-1, pos+1))
+        self.__recorder.adjust_child_paths(_make_list_remover(pos))
         return item
 
     def remove(self, item):
         pos = self.index(item)
-        self.__recorder.remove(pos, item)
-        self.__recorder.adjust_child_paths(_make_list_adjuster(-1, pos+1))
+        self.__recorder.remove(pos, self.__subject__[pos])
+        self.__recorder.adjust_child_paths(_make_list_remover(pos))
         return self.__subject__.remove(item)
 
     def reverse(self, *a, **k):
@@ -319,10 +1232,16 @@ class List(Tracked):
         before = list(self.__subject__)
         before_pos = dict((id(i), pos) for pos, i in enumerate(self.__subject__))
         self.__subject__.sort(*a, **k)
-        for pos, i in enumerate(self.__subject__):
-            oldpos = before_pos[id(i)]
-            if pos != oldpos:
-                self.__recorder.edit(pos, i, before[pos])
+        moved = [(pos, i) for (pos, i) in enumerate(self.__subject__)
+                 if before_pos[id(i)] != pos]
+        # Nothing tracked inside a moved item knows where it is any more.
+        moved_pos = set(pos for (pos, i) in moved)
+        self.__recorder.adjust_child_paths(
+            lambda pos: None if pos in moved_pos else pos)
+        # The replaced items are still in the list, and may be changed, so
+        # record copies for rollback() to put back.
+        for pos, i in moved:
+            self.__recorder.edit(pos, i, copy.deepcopy(before[pos]))
 
     def __real_pos(self, pos):
         if pos < 0:
@@ -330,11 +1249,20 @@ class List(Tracked):
         return max(0, min(pos, len(self.__subject__)))
 
 
-def _make_list_adjuster(adjustment, start, end=None):
-    def adjuster(path):
-        if (start is  None or start <= path) and \
-           (end is None or path < end):
-            return path + adjustment
-        return path
+def _make_list_inserter(start):
+    def adjuster(pos):
+        if pos >= start:
+            return pos + 1
+        return pos
+    return adjuster
+
+
+def _make_list_remover(removed):
+    def adjuster(pos):
+        if pos == removed:
+            return None
+        if pos > removed:
+            return pos - 1
+        return pos
     return adjuster
 
@@ -0,0 +1,179 @@
+"""
+Adaptive, retrying _bulk_docs writer.
+
+Documents are sent in batches sized to take about target_time seconds,
+and no more than max_bytes if set, between min_size and max_size. The size
+is adjusted after every batch from its observed latency and payload.
+
+A batch that fails with a transient error (a socket error or timeout, an
+HTTP protocol error, or a 5xx response) is resent after a jittered
+exponential backoff. The failed request may have been applied before the
+error, so conflicts reported while retrying are checked against the
+database. A document that already has exactly the content that was sent is
+reported as written, with its current _rev.
+
+Known limitations:
+    * Not thread safe.
+"""
+
+import httplib
+import itertools
+import random
+import socket
+import time
+
+import couchdb
+from couchdb import json
+
+
+class BatchWriter(object):
+
+    def __init__(self, db, max_size=1000, min_size=1, target_time=1.0,
+                 max_bytes=None, retries=3, retry_delay=0.1,
+                 max_retry_delay=5.0, clock=time.time, sleep=time.sleep):
+        self._db = db
+        self.max_size = max_size
+        self.min_size = min_size
+        self.target_time = target_time
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._clock = clock
+        self._sleep = sleep
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the adapted batch size and everything observed so far.
+        """
+        # The size of the next batch, once something has been written.
+        self.size = None
+        self._stats = {'batches': 0, 'documents': 0, 'bytes': 0, 'seconds': 0.0,
+                       'retried': 0, 'recovered': 0, 'last_size': None,
+                       'last_seconds': None}
+
+    def stats(self):
+        """
+        Return the writer's configuration and what it has observed so far.
+        """
+        stats = dict(self._stats)
+        stats.update(size=self._next_size(), max_size=self.max_size,
+                     min_size=self.min_size, target_time=self.target_time,
+                     max_bytes=self.max_bytes, retries=self.retries,
+                     retry_delay=self.retry_delay,
+                     max_retry_delay=self.max_retry_delay)
+        return stats
+
+    def write(self, docs):
+        """
+        Write an iterable of documents, yielding the (success, docid,
+        rev_or_exc) result for each one.
+        """
+        docs = iter(docs)
+        while True:
+            size = self._next_size()
+            if size is None:
+                chunk = list(docs)
+            else:
+                chunk = list(itertools.islice(docs, size))
+            if not chunk:
+                return
+            for result in self._write_batch(chunk, size):
+                yield result
+
+    def _next_size(self):
+        if self.max_size is None:
+            return None
+        if self.size is None:
+            return self.max_size
+        return min(self.max_size, max(self.min_size, self.size))
+
+    def _write_batch(self, chunk, size):
+        attempt = 0
+        while True:
+            start = self._clock()
+            try:
+                results = self._db.update(chunk)
+            except Exception, e:
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+                self._stats['retried'] += 1
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempt)
+                self._sleep(random.uniform(delay / 2.0, delay))
+                attempt += 1
+                continue
+            seconds = self._clock() - start
+            break
+        if attempt:
+            results = self._recover(chunk, results)
+        self._adapt(chunk, size, seconds)
+        return results
+
+    def _recover(self, chunk, results):
+        """
+        Replace conflicts for documents that an earlier, failed, attempt
+        actually wrote with the document's current _rev.
+        """
+        conflicts = dict((docid, pos) for (pos, (success, docid, rev_or_exc))
+                         in enumerate(results)
+                         if not success and isinstance(rev_or_exc, couchdb.ResourceConflict))
+        if not conflicts:
+            return results
+        results = list(results)
+        sent = dict((doc['_id'], doc) for doc in chunk if '_id' in doc)
+        rows = self._db.view('_all_docs', keys=conflicts.keys(), include_docs=True)
+        for row in rows:
+            pos = conflicts.get(row.key)
+            doc = sent.get(row.key)
+            if pos is None or doc is None or row.value is None:
+                continue
+            if doc.get('_deleted'):
+                written = row.value.get('deleted', False)
+            else:
+                written = row.doc is not None and _same_content(doc, row.doc)
+            if written:
+                results[pos] = (True, row.key, row.value['rev'])
+                self._stats['recovered'] += 1
+        return results
+
+    def _adapt(self, chunk, size, seconds):
+        stats = self._stats
+        stats['batches'] += 1
+        stats['documents'] += len(chunk)
+        stats['seconds'] += seconds
+        stats['last_size'] = len(chunk)
+        stats['last_seconds'] = seconds
+        if size is None:
+            return
+        # Size the next batch to take target_time, moving half way there to
+        # smooth out noise. The last, short, batch of a write says little
+        # about how long a full one would take.
+        if self.target_time is not None and seconds > 0 and len(chunk) == size:
+            ideal = len(chunk) * self.target_time / seconds
+            size = int((size + ideal) / 2)
+        if self.max_bytes is not None:
+            num_bytes = sum(len(json.encode(doc)) for doc in chunk)
+            stats['bytes'] += num_bytes
+            size = min(size, int(self.max_bytes * len(chunk) / max(num_bytes, 1)))
+        self.size = size
+
+
+def is_transient(e):
+    """
+    Check if an exception raised by a request is worth retrying.
+    """
+    if isinstance(e, couchdb.ServerError):
+        try:
+            return e.args[0][0] >= 500
+        except (IndexError, TypeError):
+            return False
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+
+def _same_content(sent, stored):
+    sent = json.decode(json.encode(sent))
+    sent.pop('_rev', None)
+    stored = dict(stored)
+    stored.pop('_rev', None)
+    return sent == stored
@@ -0,0 +1,146 @@
+"""
+Batch processor for a database's _changes feed.
+
+A ChangesProcessor reads the feed batch_size changes at a time. For each
+batch it loads the changed documents into a new session with a single
+get_many(), calls callback(session, docs) with them, flushes the session
+and then checkpoints the feed's last_seq in a _local document, named after
+the processor, so a restarted processor carries on where it left off.
+Deleted documents aren't passed to the callback.
+
+With partitions > 1 a batch's documents are split, by a hash of their ids,
+between that many sessions, each loaded, called back and flushed in its own
+thread. A document is always in the same partition, so it's only ever
+changed by one thread at a time, and the checkpoint is only stored once
+every partition has been flushed.
+
+Sessions are created by session_factory, a new Session for the database by
+default, and given to release_session, if set, once they've been flushed;
+e.g. pool.acquire and pool.release to use sessions from a SessionPool.
+
+A batch is checkpointed only after it has been flushed so, after a crash,
+the last batch may be processed again; callbacks should be idempotent. A
+callback's own changes appear in the feed too and are processed in a later
+batch, so a callback should only change documents that need changing.
+
+Known limitations:
+    * A processor is not thread safe; run() it in one thread.
+    * Partitions share the database object, and its HTTP session.
+"""
+
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from couchdbsession import session as _session
+
+
+class ChangesProcessor(object):
+
+    def __init__(self, db, callback, name, batch_size=100, partitions=1,
+                 session_factory=None, release_session=None, feed_options=None,
+                 sleep=time.sleep):
+        self.db = db
+        self.callback = callback
+        self.name = name
+        self.batch_size = batch_size
+        self.partitions = partitions
+        self.session_factory = session_factory or (lambda: _session.Session(db))
+        self.release_session = release_session
+        self.feed_options = feed_options or {}
+        self._sleep = sleep
+        self._pool = None
+        self._stopped = False
+        # The checkpoint document, once it's been read.
+        self._checkpoint = None
+
+    @property
+    def checkpoint_id(self):
+        return '_local/' + self.name
+
+    def checkpoint(self):
+        """
+        Return the seq the processor has checkpointed, or None if it hasn't
+        processed anything yet.
+        """
+        if self._checkpoint is None:
+            self._checkpoint = self.db.get(self.checkpoint_id) or {'_id': self.checkpoint_id}
+        return self._checkpoint.get('seq')
+
+    def process_batch(self):
+        """
+        Process the next batch of changes, returning the number of changes
+        in the batch, 0 once the processor has caught up.
+        """
+        since = self.checkpoint()
+        options = dict(self.feed_options, limit=self.batch_size)
+        if since is not None:
+            options['since'] = since
+        feed = self.db.changes(**options)
+        results = feed['results']
+        if not results:
+            return 0
+        ids = _session._unique(change['id'] for change in results
+                               if not change.get('deleted'))
+        if self.partitions > 1:
+            partitions = [[] for i in xrange(self.partitions)]
+            for doc_id in ids:
+                partitions[_partition(doc_id, self.partitions)].append(doc_id)
+            self._thread_pool().map(self._process, [p for p in partitions if p])
+        elif ids:
+            self._process(ids)
+        self._store_checkpoint(feed['last_seq'])
+        return len(results)
+
+    def run(self, poll_interval=None):
+        """
+        Process batches until the processor has caught up or, with a
+        poll_interval, forever, checking for new changes every poll_interval
+        seconds, until stop() is called.
+        """
+        self._stopped = False
+        while not self._stopped:
+            if self.process_batch():
+                continue
+            if poll_interval is None:
+                break
+            self._sleep(poll_interval)
+
+    def stop(self):
+        """
+        Stop run() once the current batch has been processed.
+        """
+        self._stopped = True
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _process(self, ids):
+        session = self.session_factory()
+        try:
+            docs = [doc for doc in session.get_many(ids) if doc is not None]
+            self.callback(session, docs)
+            session.flush()
+        finally:
+            if self.release_session is not None:
+                self.release_session(session)
+
+    def _store_checkpoint(self, seq):
+        # save() updates the document's _rev, ready for the next batch.
+        doc = dict(self._checkpoint, seq=seq)
+        self.db.save(doc)
+        self._checkpoint = doc
+
+    def _thread_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.partitions)
+        return self._pool
+
+
+def _partition(doc_id, partitions):
+    if isinstance(doc_id, unicode):
+        doc_id = doc_id.encode('utf-8')
+    return zlib.crc32(doc_id) % partitions
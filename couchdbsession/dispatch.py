@@ -0,0 +1,125 @@
+"""
+Dispatch of flushed changes to hooks subscribed to document types and paths.
+
+A hook subscribes with an optional document type and an optional list of
+path patterns, e.g. ['items', '*', 'price'] where '*' matches any key or
+list position. All changes are walked once per flush to build an index of
+what each hook needs and then only the hooks with something to see are
+called.
+
+Known limitations:
+    * Not thread safe.
+"""
+
+WILDCARD = '*'
+
+
+class Dispatcher(object):
+
+    def __init__(self, type_field='type'):
+        self.type_field = type_field
+        self._subscriptions = []
+        # Subscriptions by document type, None for any type.
+        self._by_type = {}
+
+    def __contains__(self, subscription):
+        return subscription in self._subscriptions
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, hook, doc_type=None, paths=None):
+        """
+        Subscribe hook to changes to documents of doc_type, or any type, that
+        match any of the path patterns, or any path.
+
+        A change matches a pattern if it's made at, inside or above the
+        pattern, e.g. ['items', '*', 'price'] matches changes to
+        ['items', 0, 'price'], ['items', 0, 'price', 'currency'] and
+        ['items'].
+        """
+        subscription = _Subscription(hook, paths)
+        self._subscriptions.append(subscription)
+        self._by_type.setdefault(doc_type, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions.remove(subscription)
+        for subscriptions in self._by_type.itervalues():
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+
+    def dispatch(self, session, deletions, additions, changes):
+        """
+        Call each subscribed hook, as hook(session, deletions, additions,
+        changes), with only the documents and actions it subscribed to.
+        Hooks with nothing to see are not called.
+
+        changes is an iterable of (doc, actions) pairs.
+        """
+        if not self._subscriptions:
+            return
+        matched = dict((id(s), ([], [], [])) for s in self._subscriptions)
+        for doc in deletions:
+            for s in self._subscribed(doc):
+                matched[id(s)][0].append(doc)
+        for doc in additions:
+            for s in self._subscribed(doc):
+                matched[id(s)][1].append(doc)
+        for doc, actions in changes:
+            subscriptions = self._subscribed(doc)
+            if not subscriptions:
+                continue
+            by_subscription = {}
+            for action in actions:
+                for s in subscriptions:
+                    if s.matches(action['path']):
+                        by_subscription.setdefault(id(s), []).append(action)
+            for key, doc_actions in by_subscription.iteritems():
+                matched[key][2].append((doc, doc_actions))
+        # Call hooks in the order they subscribed.
+        for s in list(self._subscriptions):
+            deleted, added, changed = matched[id(s)]
+            if deleted or added or changed:
+                s.hook(session, deleted, added, changed)
+
+    def _subscribed(self, doc):
+        subscriptions = self._by_type.get(None, [])
+        doc_type = doc.get(self.type_field)
+        if doc_type is None:
+            return subscriptions
+        return subscriptions + self._by_type.get(doc_type, [])
+
+
+class _Subscription(object):
+
+    def __init__(self, hook, paths):
+        self.hook = hook
+        self._trie = None
+        if paths is not None:
+            self._trie = {}
+            for path in paths:
+                node = self._trie
+                for name in path:
+                    node = node.setdefault(name, {})
+                # A pattern ending here matches everything below it.
+                node[None] = True
+
+    def matches(self, path):
+        if self._trie is None:
+            return True
+        nodes = [self._trie]
+        for name in path:
+            next_nodes = []
+            for node in nodes:
+                if None in node:
+                    return True
+                if name in node:
+                    next_nodes.append(node[name])
+                if WILDCARD in node:
+                    next_nodes.append(node[WILDCARD])
+            if not next_nodes:
+                return False
+            nodes = next_nodes
+        # The change is at or above a pattern.
+        return True
@@ -0,0 +1,175 @@
+"""
+Persistent, on disk, cache of documents as they were fetched from CouchDB,
+for processes that restart often and keep loading the same, mostly static,
+documents.
+
+Documents are stored as JSON, along with their _rev, in a SQLite database
+that outlives the process. The cache is for a single CouchDB database; it's
+cleared if it's synced with a different one.
+
+Cached documents are validated in one of two ways:
+
+    * 'changes', the default: the first time a session uses the cache it
+      reads the database's _changes feed since the sequence it last saw and
+      discards every document that has changed. Cached documents are then
+      trusted for the rest of the session.
+    * 'revs': a cached document's _rev is checked every time it's used,
+      with a conditional GET for a single document or an _all_docs request
+      without include_docs for many.
+
+If max_bytes is set the least recently used documents are evicted to keep
+the stored JSON within it.
+
+Known limitations:
+    * Not thread safe.
+"""
+
+import sqlite3
+
+import couchdb
+from couchdb import json
+
+
+class DocCache(object):
+
+    def __init__(self, filename, max_bytes=None, validate='changes',
+                 changes_limit=1000):
+        if validate not in ('changes', 'revs'):
+            raise ValueError('validate must be "changes" or "revs"')
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.changes_limit = changes_limit
+        self._conn = sqlite3.connect(filename)
+        # Losing the last few puts in a crash is fine; they'll be refetched.
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS docs ('
+                           'id TEXT PRIMARY KEY, rev TEXT, data BLOB, '
+                           'size INTEGER, used INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS docs_used ON docs (used)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+        self._bytes, self._tick = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM docs').fetchone()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def __contains__(self, id):
+        return self._conn.execute('SELECT 1 FROM docs WHERE id = ?', (id,)).fetchone() is not None
+
+    def get_many(self, ids):
+        """
+        Return a dict of the cached documents, by id, for any of ids, as
+        couchdb.Documents, just as they would be fetched from CouchDB.
+        """
+        found = {}
+        for chunk in _chunks(list(ids), 500):
+            rows = self._conn.execute('SELECT id, data FROM docs WHERE id IN (%s)'
+                                      % ','.join('?' * len(chunk)), chunk)
+            for id, data in rows:
+                found[id] = couchdb.Document(json.decode(str(data).decode('utf-8')))
+        if found:
+            self._tick += 1
+            self._conn.executemany('UPDATE docs SET used = ? WHERE id = ?',
+                                   ((self._tick, id) for id in found))
+            self._conn.commit()
+        return found
+
+    def revs(self, ids):
+        """
+        Return a dict of the cached _revs, by id, for any of ids.
+        """
+        revs = {}
+        for chunk in _chunks(list(ids), 500):
+            rows = self._conn.execute('SELECT id, rev FROM docs WHERE id IN (%s)'
+                                      % ','.join('?' * len(chunk)), chunk)
+            revs.update(rows)
+        return revs
+
+    def put_many(self, docs):
+        """
+        Store an iterable of documents, evicting the least recently used
+        documents if the cache has grown too big.
+        """
+        self._tick += 1
+        for doc in docs:
+            data = json.encode(doc).encode('utf-8')
+            row = self._conn.execute('SELECT size FROM docs WHERE id = ?', (doc['_id'],)).fetchone()
+            if row is not None:
+                self._bytes -= row[0]
+            self._conn.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)',
+                               (doc['_id'], doc['_rev'], sqlite3.Binary(data),
+                                len(data), self._tick))
+            self._bytes += len(data)
+        self._evict()
+        self._conn.commit()
+
+    def discard_many(self, ids):
+        for chunk in _chunks(list(ids), 500):
+            where = 'id IN (%s)' % ','.join('?' * len(chunk))
+            self._bytes -= self._conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM docs WHERE ' + where, chunk).fetchone()[0]
+            self._conn.execute('DELETE FROM docs WHERE ' + where, chunk)
+        self._conn.commit()
+
+    def clear(self):
+        self._conn.execute('DELETE FROM docs')
+        self._conn.execute('DELETE FROM meta')
+        self._conn.commit()
+        self._bytes = 0
+
+    def sync(self, db):
+        """
+        Discard documents that have changed in db since the last sync.
+
+        A cache that has never been synced with db is cleared and starts
+        following db's _changes feed from its current sequence.
+        """
+        since = self._meta('seq')
+        if self._meta('db') != db.name or since is None:
+            self.clear()
+            self._set_meta('db', db.name)
+            self._set_meta('seq', db.info()['update_seq'])
+            return
+        while True:
+            changes = db.changes(since=since, limit=self.changes_limit)
+            results = changes['results']
+            self.discard_many(change['id'] for change in results)
+            since = changes['last_seq']
+            self._set_meta('seq', since)
+            if len(results) < self.changes_limit:
+                break
+
+    def close(self):
+        self._conn.close()
+
+    def _meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.decode(row[0])
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                           (key, json.encode(value)))
+        self._conn.commit()
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self._bytes > self.max_bytes:
+            rows = self._conn.execute('SELECT id, size FROM docs ORDER BY used LIMIT 100').fetchall()
+            if not rows:
+                break
+            for id, size in rows:
+                if self._bytes <= self.max_bytes:
+                    break
+                self._conn.execute('DELETE FROM docs WHERE id = ?', (id,))
+                self._bytes -= size
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i+size]
@@ -0,0 +1,129 @@
+"""
+Unit of work spanning sessions on several databases.
+
+Known limitations:
+    * Not thread safe.
+    * Not atomic; a failure writing to one database does not undo the writes
+      to the others.
+"""
+
+import sys
+import threading
+
+
+class SessionGroup(object):
+    """
+    A group of sessions, each for a different database, that are flushed
+    together.
+
+    Sessions are added with a name that is used to report the results of a
+    flush, e.g. the database name.
+    """
+
+    def __init__(self, sessions=None):
+        self._sessions = {}
+        if sessions:
+            for name, session in dict(sessions).iteritems():
+                self.add(name, session)
+
+    def __getitem__(self, name):
+        return self._sessions[name]
+
+    def __iter__(self):
+        return iter(self._sessions)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def add(self, name, session):
+        if name in self._sessions:
+            raise ValueError('session already in group: %r' % (name,))
+        self._sessions[name] = session
+
+    def reset(self):
+        for session in self._sessions.itervalues():
+            session.reset()
+
+    def flush(self):
+        """
+        Flush every session in the group, returning a dict of the (success,
+        docid, rev_or_exc) results of each session's writes by name.
+
+        The pre-flush hooks of all sessions are run until none of them have
+        anything new to write, as a hook for one session may make changes in
+        another, and then all the databases are written to concurrently.
+        """
+        sessions = self._sessions.items()
+        for name, session in sessions:
+            session._begin_flush()
+        try:
+            results = self._flush(sessions)
+        finally:
+            for name, session in sessions:
+                session._flushing = False
+        for name, session in sessions:
+            session._end_flush()
+        return results
+
+    def _flush(self, sessions):
+        results = dict((name, []) for (name, session) in sessions)
+        while True:
+            frozen = self._pre_flush(sessions)
+            if not frozen:
+                break
+            written, errors = _write_concurrently(frozen)
+            # Reset internal tracking of everything that was written, even if
+            # something else failed.
+            for name, (session_results, spilled_revs) in written.iteritems():
+                session, deleted, created, changed = frozen[name]
+                results[name].extend(session_results)
+                session._post_flush(deleted, created, changed, spilled_revs)
+            if errors:
+                exc_info = errors.values()[0]
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return results
+
+    def _pre_flush(self, sessions):
+        """
+        Freeze all sessions, running their pre-flush hooks until no session
+        has been changed by another's hook, and return a dict of the frozen
+        (session, deleted, created, changed) by name for the sessions with
+        something to write.
+        """
+        frozen = {}
+        while True:
+            progress = False
+            for name, session in sessions:
+                deleted, created, changed = session._pre_flush()
+                if not (deleted or created or changed):
+                    continue
+                progress = True
+                if name not in frozen:
+                    frozen[name] = (session, {}, set(), set())
+                frozen[name][1].update(deleted)
+                frozen[name][2].update(created)
+                frozen[name][3].update(changed)
+            if not progress:
+                return frozen
+
+
+def _write_concurrently(frozen):
+    """
+    Write all frozen sessions, one thread per session, and return a dict of
+    the (results, spilled_revs) of each session that was written and a dict of
+    the sys.exc_info() of each session that failed, both by name.
+    """
+    written = {}
+    errors = {}
+    def write(name, session, deleted, created, changed):
+        try:
+            written[name] = session._write(deleted, created, changed)
+        except Exception:
+            errors[name] = sys.exc_info()
+    threads = [threading.Thread(target=write, args=(name,) + args)
+               for (name, args) in frozen.iteritems()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return written, errors
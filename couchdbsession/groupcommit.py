@@ -0,0 +1,146 @@
+"""
+Group commit: one _bulk_docs writer shared by the sessions of many threads
+so their small flushes go to CouchDB together.
+
+Each session passes the documents it's writing to write() and blocks until
+they've been written. The first thread to write becomes the leader: it
+waits up to window seconds, or until max_docs documents are pending, for
+other threads to join, then sends everything pending as one group, through
+a BatchWriter, and hands each thread back its own results. Threads that
+arrive while a group is being written are sent together in the next one,
+so even without a window the more sessions are flushing the bigger the
+groups get.
+
+Documents with the same id, e.g. a session's deletion and a re-creation by
+another session, are never sent in the same group; the later ones wait for
+the next group.
+
+Known limitations:
+    * Documents are held in memory until they're written; a flush's
+      updates are no longer streamed, e.g. from a spill store.
+    * Sessions using the writer must be for the writer's database.
+"""
+
+import itertools
+import threading
+import time
+
+from couchdbsession import batching
+
+
+class GroupCommitWriter(object):
+
+    def __init__(self, db, window=0.0, max_docs=1000, clock=time.time, **kwargs):
+        self.window = window
+        self.max_docs = max_docs
+        self._clock = clock
+        self._writer = batching.BatchWriter(db, **kwargs)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_docs = 0
+        self._leading = False
+        self._stats = {'groups': 0, 'submissions': 0, 'largest_group': 0}
+
+    def write(self, docs):
+        """
+        Write an iterable of documents, along with those of any other
+        threads, returning the (success, docid, rev_or_exc) result for each
+        one, in order.
+        """
+        submission = _Submission(list(docs))
+        if not submission.docs:
+            return []
+        with self._cond:
+            self._pending.append(submission)
+            self._pending_docs += len(submission.docs)
+            self._stats['submissions'] += 1
+            self._cond.notify_all()
+            while not submission.done:
+                if self._leading:
+                    self._cond.wait()
+                else:
+                    self._lead()
+        if submission.error is not None:
+            raise submission.error
+        return submission.results
+
+    def stats(self):
+        """
+        Return the BatchWriter's stats along with the number of groups and
+        submissions written, and the most submissions sent in one group.
+        """
+        with self._cond:
+            stats = self._writer.stats()
+            stats.update(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+    def _lead(self):
+        """
+        Gather and write the next group. Called, and returns, with the lock
+        held.
+        """
+        self._leading = True
+        try:
+            deadline = self._clock() + self.window
+            while self._pending_docs < self.max_docs:
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            group = self._take()
+            # Others can join the next group while this one is written.
+            self._cond.release()
+            try:
+                self._write(group)
+            finally:
+                self._cond.acquire()
+            self._stats['groups'] += 1
+            self._stats['largest_group'] = max(self._stats['largest_group'], len(group))
+        finally:
+            self._leading = False
+            self._cond.notify_all()
+
+    def _take(self):
+        """
+        Take the pending submissions for the next group: as many as fit in
+        max_docs, but at least one, without repeating a document id.
+        """
+        group = []
+        ids = set()
+        size = 0
+        for submission in list(self._pending):
+            submission_ids = set(doc['_id'] for doc in submission.docs if '_id' in doc)
+            if group and (size + len(submission.docs) > self.max_docs or
+                          ids & submission_ids):
+                continue
+            group.append(submission)
+            ids |= submission_ids
+            size += len(submission.docs)
+            self._pending.remove(submission)
+            self._pending_docs -= len(submission.docs)
+        return group
+
+    def _write(self, group):
+        docs = list(itertools.chain.from_iterable(s.docs for s in group))
+        try:
+            results = list(self._writer.write(docs))
+        except Exception, e:
+            for submission in group:
+                submission.error = e
+        else:
+            pos = 0
+            for submission in group:
+                submission.results = results[pos:pos+len(submission.docs)]
+                pos += len(submission.docs)
+        for submission in group:
+            submission.done = True
+
+
+class _Submission(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.results = None
+        self.error = None
+        self.done = False
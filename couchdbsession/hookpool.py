@@ -0,0 +1,68 @@
+"""
+Process pool for running CPU bound encode_doc and decode_doc hooks in
+parallel.
+
+Documents are sent to the pool in blocks of block_size, each split into
+chunks between the worker processes, and come back in their original
+order. The next block is submitted before the current one is handed back
+so encoding overlaps with whatever is consuming the results, e.g. writing
+the previous batch, while no more than two blocks are ever in flight.
+
+A block of fewer than min_batch documents is run inline; below that the
+cost of pickling documents to and from the workers outweighs the gain.
+
+A hook can only be sent to the pool if it can be pickled, i.e. it's a
+module level function.
+
+Known limitations:
+    * Not thread safe.
+"""
+
+import itertools
+import multiprocessing
+
+
+class HookPool(object):
+
+    def __init__(self, processes=None, min_batch=100, block_size=1000):
+        self._pool = multiprocessing.Pool(processes)
+        self._processes = processes or multiprocessing.cpu_count()
+        self.min_batch = min_batch
+        self.block_size = block_size
+
+    def imap(self, func, items):
+        """
+        Return an iterator over func applied to each of items, in order.
+        """
+        blocks = _blocks(items, self.block_size)
+        pending = self._submit(func, next(blocks, None))
+        while pending is not None:
+            following = self._submit(func, next(blocks, None))
+            for result in pending():
+                yield result
+            pending = following
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def _submit(self, func, block):
+        """
+        Start applying func to a block, returning a callable that returns
+        the results when they're ready.
+        """
+        if block is None:
+            return None
+        if len(block) < self.min_batch:
+            return lambda: [func(item) for item in block]
+        chunksize = max(1, len(block) // (self._processes * 4))
+        return self._pool.map_async(func, block, chunksize).get
+
+
+def _blocks(items, size):
+    items = iter(items)
+    while True:
+        block = list(itertools.islice(items, size))
+        if not block:
+            return
+        yield block
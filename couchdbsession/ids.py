@@ -0,0 +1,58 @@
+"""
+Document id generators for Session.create.
+
+A generator is any callable that takes no args and returns a new id.
+Random ids spread inserts across the whole of CouchDB's B-tree; ids that
+increase over time are appended to the end of it, which makes writes
+faster and the database and its indexes smaller.
+
+Known limitations:
+    * Not thread safe.
+"""
+
+import os
+import time
+import uuid
+
+
+def random_id():
+    """
+    Return a random id; the default.
+    """
+    return uuid.uuid4().hex
+
+
+class SequentialIds(object):
+    """
+    Time-prefixed ids, the same as CouchDB's utc_random algorithm: 14 hex
+    digits of microseconds since the epoch followed by 18 random hex digits.
+
+    Ids from the same generator always increase, even if the clock doesn't.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._last = 0
+
+    def __call__(self):
+        now = max(int(self._clock() * 1000000), self._last + 1)
+        self._last = now
+        return '%014x%s' % (now, os.urandom(9).encode('hex'))
+
+
+class ServerIds(object):
+    """
+    Ids fetched from the CouchDB server's _uuids resource, count at a time,
+    so they follow the server's configured algorithm.
+    """
+
+    def __init__(self, server, count=1000):
+        self._server = server
+        self.count = count
+        self._ids = []
+
+    def __call__(self):
+        if not self._ids:
+            # Reverse the batch so ids can be popped off in server order.
+            self._ids = self._server.uuids(self.count)[::-1]
+        return self._ids.pop()
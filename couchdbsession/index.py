@@ -0,0 +1,118 @@
+"""
+In-memory secondary indexes over a session's documents.
+
+An index maps a key, taken from each document by a field path or a key
+function, to the ids of the documents with that key. Entries are kept in a
+list sorted by (key, doc_id) so exact and range lookups are a binary search.
+
+Known limitations:
+    * Not thread safe.
+    * Keys are compared using Python's ordering, not CouchDB's collation.
+"""
+
+import bisect
+import copy
+
+
+class Index(object):
+
+    def __init__(self, key):
+        """
+        Create an index of documents by key, which is either a function that
+        takes a document and returns its key or the path of a field, e.g.
+        'order_id' or ['customer', 'id'].
+
+        Documents without the field, or for which the function returns None,
+        are not indexed.
+        """
+        if callable(key):
+            self.path = None
+            self._key = key
+        else:
+            if isinstance(key, basestring):
+                key = [key]
+            self.path = list(key)
+            self._key = lambda doc: _get_path(doc, self.path)
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries = []
+        self._keys = {}
+
+    def affected_by(self, path):
+        """
+        Check if a change at path could change a document's key.
+        """
+        if self.path is None:
+            return True
+        size = min(len(path), len(self.path))
+        return path[:size] == self.path[:size]
+
+    def update(self, doc_id, doc):
+        """
+        Index, or re-index, a document.
+        """
+        self.discard(doc_id)
+        key = self._key(doc)
+        if key is None:
+            return
+        # Keys may be lists or dicts from inside the document; don't let later
+        # changes to the document reorder the index.
+        if isinstance(key, (list, dict)):
+            key = copy.deepcopy(key)
+        self._keys[doc_id] = key
+        bisect.insort(self._entries, (key, doc_id))
+
+    def discard(self, doc_id):
+        """
+        Remove a document from the index, if it's there.
+        """
+        key = self._keys.pop(doc_id, None)
+        if key is None:
+            return
+        pos = bisect.bisect_left(self._entries, (key, doc_id))
+        del self._entries[pos]
+
+    def lookup(self, key):
+        """
+        Return the ids of the documents with key, in id order.
+        """
+        entries = self._entries
+        pos = bisect.bisect_left(entries, (key,))
+        ids = []
+        while pos < len(entries) and entries[pos][0] == key:
+            ids.append(entries[pos][1])
+            pos += 1
+        return ids
+
+    def lookup_range(self, startkey=None, endkey=None, inclusive_end=True):
+        """
+        Return the ids of the documents with keys from startkey to endkey, in
+        key then id order. A startkey or endkey of None leaves that end of the
+        range open.
+        """
+        entries = self._entries
+        if startkey is None:
+            start = 0
+        else:
+            start = bisect.bisect_left(entries, (startkey,))
+        if endkey is None:
+            end = len(entries)
+        else:
+            end = bisect.bisect_left(entries, (endkey,))
+            if inclusive_end:
+                while end < len(entries) and entries[end][0] == endkey:
+                    end += 1
+        return [doc_id for (key, doc_id) in entries[start:end]]
+
+
+def _get_path(doc, path):
+    for name in path:
+        try:
+            doc = doc[name]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return doc
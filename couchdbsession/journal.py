@@ -0,0 +1,113 @@
+"""
+Write-ahead journal of a session's unflushed changes.
+
+The journal is an append-only file of JSON lines, one record per document,
+describing everything that would be written for that document by the next
+flush. Later records for a document replace earlier ones so a journal can be
+replayed by folding it by document id.
+
+Known limitations:
+    * Not thread safe.
+    * Values are serialised when a batch is synced, not when the change is
+      made.
+"""
+
+import json
+import os
+
+from couchdbsession import a8n
+
+
+class Journal(object):
+
+    def __init__(self, filename, sync_every=100, dumps=None, loads=None):
+        self.filename = filename
+        self.sync_every = sync_every
+        self._dumps = dumps or _dumps
+        self._loads = loads or json.loads
+        self._file = open(filename, 'ab')
+        self._drop_torn_line()
+        self._pending = {}
+        self._events = 0
+
+    def mark(self, key, make_record):
+        """
+        Note that the record for key has changed, syncing the journal if
+        enough changes have been seen since the last sync.
+
+        make_record is called with no args, at sync time, to build the
+        record.
+        """
+        self._pending[key] = make_record
+        self._events += 1
+        if self._events >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Append records for everything marked since the last sync and fsync
+        the file.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        self._events = 0
+        for make_record in pending.itervalues():
+            self._file.write(self._dumps(make_record()))
+            self._file.write('\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def clear(self):
+        """
+        Forget everything journaled so far.
+        """
+        self._pending = {}
+        self._events = 0
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def _drop_torn_line(self):
+        """
+        Truncate a torn final line, left by a crash part way through a sync,
+        so that new records aren't appended to it.
+        """
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        if data and not data.endswith('\n'):
+            self._file.truncate(data.rfind('\n') + 1)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def __iter__(self):
+        """
+        Iterate the synced records, oldest first.
+
+        A torn final line, left by a crash part way through a sync, is
+        ignored.
+        """
+        with open(self.filename, 'rb') as f:
+            lines = f.read().split('\n')
+        for pos, line in enumerate(lines):
+            if not line:
+                continue
+            try:
+                yield self._loads(line)
+            except ValueError:
+                if pos != len(lines) - 1:
+                    raise
+
+
+def _dumps(record):
+    return json.dumps(record, default=_default, separators=(',', ':'))
+
+
+def _default(obj):
+    if isinstance(obj, a8n.Tracked):
+        return obj.__subject__
+    raise TypeError(repr(obj) + " is not JSON serializable")
@@ -1,9 +1,11 @@
+import copy
+import email.utils
 import logging
 import itertools
-import uuid
 import couchdb
+from multiprocessing.pool import ThreadPool
 
-from couchdbsession import a8n
+from couchdbsession import a8n, batching, dispatch, ids, index
 
 
 log = logging.getLogger(__name__)
@@ -13,14 +15,60 @@ class Session(object):
 
     tracker_factory = a8n.Tracker
 
+    # Maximum number of documents sent in a single _bulk_docs request, or None
+    # to send everything at once.
+    batch_size = 1000
+
+    # Number of _all_docs requests get_many() has in flight at once when it
+    # needs more than batch_size documents.
+    fetch_concurrency = 4
+
+    # Batches are resized after each request to take about batch_time
+    # seconds, and be no more than batch_bytes if set, but never fewer than
+    # min_batch_size documents.
+    min_batch_size = 10
+    batch_time = 1.0
+    batch_bytes = None
+
+    # Number of times a batch that fails with a transient error is resent,
+    # after a jittered exponential backoff starting at retry_delay seconds.
+    write_retries = 3
+    retry_delay = 0.1
+
+    # Number of dirty documents held in memory before they are spilled to the
+    # session's spill store, if it has one.
+    spill_threshold = 10000
+
+    # Field holding a document's type, used by subscribe().
+    type_field = 'type'
+
+    _journal = None
+
     def __init__(self, db, pre_flush_hook=None, post_flush_hook=None,
-                 encode_doc=None, decode_doc=None):
+                 encode_doc=None, decode_doc=None, journal=None, spill=None,
+                 indexes=None, id_generator=None, doc_cache=None,
+                 hook_pool=None, shared_docs=None, group_writer=None):
         self._db = db
         self._pre_flush_hook = pre_flush_hook
         self._post_flush_hook = post_flush_hook
         self._encode_doc = encode_doc
         self._decode_doc = decode_doc
+        self._spill = spill
+        self._id_generator = id_generator or ids.random_id
+        self._doc_cache = doc_cache
+        self._hook_pool = hook_pool
+        self._shared_docs = shared_docs
+        self._writer = batching.BatchWriter(db)
+        self._group_writer = group_writer
+        self._indexes = dict((name, index.Index(key))
+                             for (name, key) in (indexes or {}).iteritems())
+        self._pre_dispatcher = dispatch.Dispatcher(self.type_field)
+        self._post_dispatcher = dispatch.Dispatcher(self.type_field)
+        self._flushing = False
         self.reset()
+        # Set the journal after the reset so an existing journal survives to
+        # be replayed.
+        self._journal = journal
 
     #- Additional magic methods.
 
@@ -71,9 +119,11 @@ class Session(object):
         # dict itself in the cache.
         # deepcopy is not a very nice thing to use so, in the end the decision
         # was to store the doc dict dict in the cache.
+        self._maybe_spill()
         if '_id' not in doc:
-            doc['_id'] = uuid.uuid4().hex
+            doc['_id'] = self._id_generator()
         self._created.add(doc['_id'])
+        self._journal_mark(doc['_id'])
         return self._tracked_and_cached(doc)['_id']
 
     def delete(self, doc):
@@ -83,21 +133,127 @@ class Session(object):
             self._changed.discard(doc['_id'])
             self._deleted[doc['_id']] = doc
         del self._cache[doc['_id']]
+        self._journal_mark(doc['_id'])
+        self._unindex(doc['_id'])
 
     def get(self, id, default=None, **options):
+        self._maybe_spill()
         # Try cache first.
-        doc = self._cache.get(id)
+        doc = self._cache_get(id)
         if doc is not None:
             return doc
         if id in self._deleted:
             return None
+        # Try the documents shared with other sessions, unless asking for
+        # something special.
+        if self._shared_docs is not None and not options:
+            doc = self._shared_docs.get(id)
+            if doc is not None:
+                return self._tracked_and_cached(self.decode_doc(copy.deepcopy(doc)))
+        # Try the persistent cache, unless asking for something special.
+        if self._doc_cache is not None and not options:
+            doc = self._doc_cache_get_many([id]).get(id)
+            if doc is not None:
+                return self._tracked_and_cached(self.decode_doc(doc))
         # Ask CouchDB and cache the response (if found).
         doc = self._db.get(id, default, **options)
         if doc is default:
             return doc
+        if self._doc_cache is not None and not options:
+            self._doc_cache.put_many([doc])
         doc = self.decode_doc(doc)
         return self._tracked_and_cached(doc)
 
+    def get_many(self, ids):
+        """
+        Get a list of documents, in the same order as ids, with None for any
+        document that does not exist.
+
+        Cached documents are returned immediately and everything else is
+        fetched from CouchDB in as few _all_docs requests as possible, up to
+        fetch_concurrency of them at once.
+        """
+        self._maybe_spill()
+        missing = _unique(id for id in ids
+                          if id not in self._cache and id not in self._deleted
+                          and id not in self._spilled)
+        if self._shared_docs is not None and missing:
+            shared = [self._shared_docs.get(id) for id in missing]
+            shared = [copy.deepcopy(doc) for doc in shared if doc is not None]
+            for doc in self._decode_many(shared):
+                self._tracked_and_cached(doc)
+            missing = [id for id in missing if id not in self._cache]
+        if self._doc_cache is not None and missing:
+            for doc in self._decode_many(self._doc_cache_get_many(missing).itervalues()):
+                self._tracked_and_cached(doc)
+            missing = [id for id in missing if id not in self._cache]
+        chunks = list(_chunks(missing, self.batch_size))
+        for docs in _fetch_chunks(self._db, chunks, self.fetch_concurrency):
+            if self._doc_cache is not None:
+                self._doc_cache.put_many(docs)
+            for doc in self._decode_many(docs):
+                self._tracked_and_cached(doc)
+        return [self._cache_get(id) for id in ids]
+
+    def revalidate(self, ids=None):
+        """
+        Check that cached documents, all of them by default, are still
+        current, replacing any that have changed in CouchDB since they were
+        loaded and forgetting any that have been deleted. Return the ids of
+        the documents replaced or forgotten.
+
+        A single document is revalidated with a conditional GET. More than
+        one are checked with _all_docs requests, without include_docs, and
+        only those whose _rev has moved are fetched again.
+
+        Documents with unflushed changes are left alone. Copies of replaced
+        or forgotten documents obtained before the revalidation are no longer
+        tracked.
+        """
+        if ids is None:
+            ids = self._cache.keys()
+        revs = dict((doc_id, self._cache[doc_id]['_rev']) for doc_id in _unique(ids)
+                    if doc_id in self._cache and doc_id not in self._created
+                    and doc_id not in self._changed)
+        if len(revs) == 1:
+            (doc_id, rev), = revs.items()
+            try:
+                doc = _conditional_get(self._db, doc_id, rev)
+            except couchdb.ResourceNotFound:
+                doc = None
+            else:
+                if doc is None:
+                    return []
+            self._forget(doc_id)
+            self._discard_copies([doc_id])
+            if doc is not None:
+                self._tracked_and_cached(self.decode_doc(doc))
+            return [doc_id]
+        moved = self._moved(revs)
+        for doc_id in moved:
+            self._forget(doc_id)
+        # Refetch from CouchDB, not the same stale copies.
+        self._discard_copies(moved)
+        self.get_many(moved)
+        return moved
+
+    def lookup(self, index, key):
+        """
+        Get the documents with key in the named index, including unflushed
+        changes, in id order.
+        """
+        self._refresh_indexes()
+        return [self._cache_get(doc_id) for doc_id in self._indexes[index].lookup(key)]
+
+    def lookup_range(self, index, startkey=None, endkey=None, inclusive_end=True):
+        """
+        Get the documents with keys from startkey to endkey in the named index,
+        including unflushed changes, in key then id order.
+        """
+        self._refresh_indexes()
+        ids = self._indexes[index].lookup_range(startkey, endkey, inclusive_end)
+        return [self._cache_get(doc_id) for doc_id in ids]
+
     def delete_attachment(self, doc, filename):
         raise NotImplementedError()
 
@@ -111,7 +267,70 @@ class Session(object):
         return SessionViewResults(self, self._db.query(*a, **k))
 
     def update(self, documents):
-        raise NotImplementedError()
+        """
+        Create, change and delete documents, like couchdb-python's
+        Database.update(), by making the changes in the session and flushing
+        it. Returns a (success, docid, rev_or_exc) tuple for each document,
+        in order.
+
+        Documents without a _rev are created. Documents with a _rev replace
+        the session's copy, which is fetched, for all of them at once, if it
+        hasn't been loaded, so the differences are tracked like any other
+        change; a _deleted document deletes it. Documents tracked by this
+        session are just flushed. As in CouchDB, a _rev that isn't the
+        current one, a new document whose id is already taken, or a second
+        document with the same id, is a conflict. Each document's _id and
+        _rev are updated once it's written.
+        """
+        documents = [doc if self._owns(doc) else getattr(doc, '__subject__', doc)
+                     for doc in documents]
+        self.get_many([doc['_id'] for doc in documents
+                       if '_rev' in doc and '_id' in doc and not self._owns(doc)])
+        conflicts = set()
+        seen = set()
+        for pos, doc in enumerate(documents):
+            doc_id = doc.get('_id')
+            if self._owns(doc):
+                seen.add(doc_id)
+                continue
+            if doc_id in seen:
+                conflicts.add(pos)
+                continue
+            current = None
+            if doc_id is not None:
+                seen.add(doc_id)
+                current = self._cache_get(doc_id)
+            if '_rev' not in doc:
+                if current is not None:
+                    conflicts.add(pos)
+                else:
+                    self.create(doc)
+            elif current is None or current.get('_rev') != doc['_rev']:
+                conflicts.add(pos)
+            elif doc.get('_deleted'):
+                self.delete(current)
+            else:
+                _replace(current, doc)
+        self._begin_flush()
+        try:
+            written = self._flush()
+        finally:
+            self._flushing = False
+        self._end_flush()
+        results = []
+        for pos, doc in enumerate(documents):
+            if pos in conflicts:
+                exc = couchdb.ResourceConflict(('conflict', 'Document update conflict.'))
+                results.append((False, doc.get('_id'), exc))
+                continue
+            result = written.get(doc['_id'])
+            if result is None:
+                # Nothing had changed so nothing was written.
+                result = (True, doc['_id'], doc['_rev'])
+            elif result[0] and not self._owns(doc):
+                doc['_rev'] = result[2]
+            results.append(result)
+        return results
 
     def view(self, *a, **k):
         return SessionViewResults(self, self._db.view(*a, **k))
@@ -135,56 +354,236 @@ class Session(object):
             return self._decode_doc(doc)
         return doc
 
+    def batch_stats(self):
+        """
+        Return the bulk writer's configuration and the batch sizes, timings
+        and retries it has seen.
+        """
+        if self._group_writer is not None:
+            return self._group_writer.stats()
+        return self._batch_writer().stats()
+
     def reset(self):
         """
         Reset the session, forgetting everything it knows.
+
+        Documents obtained from the session before the reset are no longer
+        tracked.
         """
+        for tracker in getattr(self, '_trackers', {}).itervalues():
+            tracker.detach()
         self._trackers = {}
         self._cache = {}
         self._created = set()
         self._changed = set()
         self._deleted = {}
+        self._spilled = set()
+        self._savepoints = []
+        self._stale = set()
+        self._doc_cache_synced = False
+        for i in self._indexes.itervalues():
+            i.clear()
+        if self._spill is not None:
+            self._spill.clear()
+        if self._journal is not None:
+            self._journal.clear()
+
+    def savepoint(self):
+        """
+        Return a savepoint that the session can be rolled back to with
+        rollback(), until the session is next flushed or reset.
+
+        Spilled documents are brought back into memory and nothing is spilled
+        again until the next flush.
+        """
+        for doc_id in list(self._spilled):
+            self._unspill(doc_id)
+        savepoint = _Savepoint(self)
+        self._savepoints.append(savepoint)
+        return savepoint
+
+    def rollback(self, savepoint):
+        """
+        Roll the session back to a savepoint, undoing changes to documents in
+        place and forgetting documents created since.
+
+        Documents loaded since the savepoint are rolled back to how they were
+        loaded. Documents that are forgotten, i.e. created, or loaded and
+        deleted, since the savepoint, are no longer tracked. Savepoints taken
+        after this one are no longer valid.
+        """
+        for pos, s in enumerate(self._savepoints):
+            if s is savepoint:
+                break
+        else:
+            raise ValueError('savepoint is no longer valid')
+        del self._savepoints[pos+1:]
+        dirty = set(itertools.chain(self._created, self._changed, self._deleted))
+        # Roll back, or forget, everything tracked since the savepoint.
+        for doc_id, tracker in self._trackers.items():
+            if doc_id in savepoint.trackers:
+                continue
+            if doc_id in self._created or doc_id not in self._cache:
+                # Forgotten; the caller's copy must not mark it as changed.
+                self._trackers.pop(doc_id).detach()
+                self._cache.pop(doc_id, None)
+            else:
+                tracker.rollback(0)
+        # Put back everything the savepoint knew about. Trackers are shared
+        # with the savepoint so roll them back in place.
+        for doc_id, (tracker, mark) in savepoint.trackers.iteritems():
+            tracker.rollback(mark)
+            self._trackers[doc_id] = tracker
+        self._cache.update(savepoint.cache)
+        self._created = set(savepoint.created)
+        self._changed = set(savepoint.changed)
+        self._deleted = dict(savepoint.deleted)
+        dirty.update(self._created, self._changed, self._deleted)
+        for doc_id in dirty:
+            self._journal_mark(doc_id)
+            if doc_id in self._cache:
+                self._stale.add(doc_id)
+            else:
+                self._unindex(doc_id)
+
+    def replay_journal(self):
+        """
+        Replay the changes recorded in the session's journal, typically by a
+        previous session that never flushed, against freshly fetched
+        documents.
+
+        Documents that have been changed in CouchDB since they were journaled
+        are skipped and logged.
+        """
+        records = {}
+        for record in self._journal:
+            records[record['id']] = record
+        docs = self.get_many(records.keys())
+        for (doc_id, record), doc in zip(records.iteritems(), docs):
+            deleted = record.get('deleted')
+            if deleted is not None:
+                if doc is None or doc['_rev'] != deleted:
+                    log.warning('journal replay skipped deleted doc: docid=%r', doc_id)
+                    continue
+                self.delete(doc)
+                doc = None
+            if 'created' in record:
+                if doc is not None:
+                    log.warning('journal replay skipped created doc: docid=%r', doc_id)
+                    continue
+                self.create(record['created'])
+            elif 'changes' in record:
+                if doc is None or doc['_rev'] != record['rev']:
+                    log.warning('journal replay skipped changed doc: docid=%r', doc_id)
+                    continue
+                a8n.apply_changes(doc, record['changes'])
 
     def flush(self):
+        self._begin_flush()
+        try:
+            self._flush()
+        finally:
+            self._flushing = False
+        self._end_flush()
 
-        # XXX Due to a bug in CouchDB (see issue COUCHDB-188) we can't do
-        # deletions at the same time as additions if the list of updates
-        # includes a delete and create for the same id. For now, let's keep
-        # deletions out of the general updates list and make two calls to the
-        # backend.
+    def _begin_flush(self):
+        # Make sure everything is on disk before anything is sent.
+        if self._journal is not None:
+            self._journal.sync()
+        # Spilling would pull documents out from under the flush hooks.
+        self._flushing = True
 
+    def _end_flush(self):
+        # Savepoints refer to changes that have been written and forgotten.
+        self._savepoints = []
+        # Everything journaled has been written.
+        if self._journal is not None:
+            self._journal.clear()
+
+    def _flush(self):
+        """
+        Write everything until there's nothing left to write, returning the
+        (success, docid, rev_or_exc) result of each document's last write,
+        by docid.
+        """
+        written = {}
         while True:
             # Freeze the session and break out of the loop if there's nothing
             # to do.
             deleted, created, changed = self._pre_flush()
             if not (deleted or created or changed):
                 break
-            # Build a list of deletions.
-            deletions = [{'_id': id, '_rev': doc['_rev'], '_deleted': True}
-                         for (id, doc) in deleted.iteritems()]
-            # Build a list of other updates. Note that we get the subject out of
-            # changed documents; they're the only docs that will be wrapped in a8n
-            # tracking proxies.
-            # XXX It might be nicer if the cache only ever contains the real
-            # document to avoid having to know about the __subject__ stuff.
-            additions = (self._cache[doc_id].__subject__ for doc_id in created)
-            changes = (self._cache[doc_id].__subject__ for doc_id in changed)
-            updates = itertools.chain(additions, changes)
-            updates = (self.encode_doc(doc) for doc in updates)
-            updates = list(updates)
-            # Send deletions and clean up cache.
-            if deletions:
-                self._db.update(deletions)
-            # Perform updates and fix up the cache with the new _revs.
-            if updates:
-                for (success, docid, rev_or_exc) in self._db.update(updates):
-                    if success:
-                        self._cache[docid].__subject__['_rev'] = rev_or_exc
-                    else:
-                        # XXX Needs to be fixed.
-                        log.error('bulk update error: docid=%r, exc=%r', docid, rev_or_exc)
+            results, spilled_revs = self._write(deleted, created, changed)
+            for result in results:
+                written[result[1]] = result
             # Reset internal tracking now everything's been written.
-            self._post_flush(deleted, created, changed)
+            self._post_flush(deleted, created, changed, spilled_revs)
+        return written
+
+    def _write(self, deleted, created, changed):
+        """
+        Send frozen changes to CouchDB, returning the (success, docid,
+        rev_or_exc) result for every document and the new _revs of any
+        spilled documents.
+        """
+
+        # XXX Due to a bug in CouchDB (see issue COUCHDB-188) we can't do
+        # deletions at the same time as additions if the list of updates
+        # includes a delete and create for the same id. For now, let's keep
+        # deletions out of the general updates list and make two calls to the
+        # backend.
+
+        # Build a list of deletions.
+        deletions = [{'_id': id, '_rev': doc['_rev'], '_deleted': True}
+                     for (id, doc) in deleted.iteritems()]
+        # Build a list of other updates. Note that we get the subject out of
+        # changed documents; they're the only docs that will be wrapped in a8n
+        # tracking proxies.
+        # XXX It might be nicer if the cache only ever contains the real
+        # document to avoid having to know about the __subject__ stuff.
+        # Updates are generated lazily so spilled documents are streamed
+        # back out of the spill store a batch at a time.
+        updates = itertools.chain(created, changed)
+        updates = (self._subject(doc_id) for doc_id in updates)
+        updates = self._encode_many(updates)
+        # Send deletions and clean up cache.
+        results = list(self._bulk_update(deletions))
+        # Perform updates and fix up the cache with the new _revs. Spilled
+        # documents get their new _rev if and when they're rehydrated.
+        spilled_revs = {}
+        for result in self._bulk_update(updates):
+            results.append(result)
+            success, docid, rev_or_exc = result
+            if success:
+                if docid in self._spilled:
+                    spilled_revs[docid] = rev_or_exc
+                else:
+                    self._cache[docid].__subject__['_rev'] = rev_or_exc
+            else:
+                # XXX Needs to be fixed.
+                log.error('bulk update error: docid=%r, exc=%r', docid, rev_or_exc)
+        return results, spilled_revs
+
+    def subscribe(self, hook, doc_type=None, paths=None, pre_flush=False):
+        """
+        Call hook after, or before if pre_flush is true, each flush with only
+        the changes it's interested in, and only if there are any. Returns a
+        subscription that can be passed to unsubscribe().
+
+        Documents of doc_type, or any type if None, are passed to the hook if
+        they are deleted, created, or changed at, inside or above any of the
+        path patterns, e.g. ['items', '*', 'price']. The hook is called the
+        same way as the pre- and post-flush hooks but each document's
+        actions are only those that matched.
+        """
+        if pre_flush:
+            return self._pre_dispatcher.subscribe(hook, doc_type, paths)
+        return self._post_dispatcher.subscribe(hook, doc_type, paths)
+
+    def unsubscribe(self, subscription):
+        for dispatcher in (self._pre_dispatcher, self._post_dispatcher):
+            if subscription in dispatcher:
+                dispatcher.unsubscribe(subscription)
 
     def pre_flush_hook(self, deletions, additions, changes):
         if self._pre_flush_hook is not None:
@@ -196,13 +595,195 @@ class Session(object):
 
     #- Internal methods.
 
+    def _doc_cache_get_many(self, ids):
+        """
+        Get the documents in the persistent cache that are still current, as
+        plain dicts by id, validating them as the cache is configured to.
+        """
+        cache = self._doc_cache
+        if cache.validate == 'changes':
+            if not self._doc_cache_synced:
+                cache.sync(self._db)
+                self._doc_cache_synced = True
+            return cache.get_many(ids)
+        revs = cache.revs(ids)
+        if len(revs) == 1:
+            (doc_id, rev), = revs.items()
+            try:
+                doc = _conditional_get(self._db, doc_id, rev)
+            except couchdb.ResourceNotFound:
+                cache.discard_many([doc_id])
+                return {}
+            if doc is not None:
+                cache.put_many([doc])
+                return {doc_id: doc}
+        elif revs:
+            cache.discard_many(self._moved(revs))
+        return cache.get_many(ids)
+
+    def _encode_many(self, docs):
+        return self._map_hook('encode_doc', self._encode_doc, docs)
+
+    def _decode_many(self, docs):
+        return self._map_hook('decode_doc', self._decode_doc, docs)
+
+    def _map_hook(self, name, hook, docs):
+        """
+        Lazily apply the encode_doc or decode_doc method to an iterable of
+        documents, in order, using the hook pool if there is one and the
+        method just calls the hook.
+        """
+        method = getattr(self, name)
+        if self._hook_pool is None or hook is None or \
+                getattr(type(self), name).im_func is not getattr(Session, name).im_func:
+            return (method(doc) for doc in docs)
+        return self._hook_pool.imap(hook, docs)
+
+    def _moved(self, revs):
+        """
+        Return the ids, from a dict of _revs by id, of the documents that have
+        been changed or deleted in CouchDB.
+        """
+        moved = []
+        for chunk in _chunks(revs, self.batch_size):
+            for row in self._db.view('_all_docs', keys=chunk):
+                value = row.value
+                if value is None or value.get('deleted') or value['rev'] != revs[row.key]:
+                    moved.append(row.key)
+        return moved
+
+    def _forget(self, doc_id):
+        """
+        Forget a clean document, as if it had never been loaded. The
+        caller's copy is no longer tracked.
+        """
+        del self._cache[doc_id]
+        self._trackers.pop(doc_id).detach()
+        self._unindex(doc_id)
+
+    def _discard_copies(self, ids):
+        """
+        Discard documents from the persistent cache and the shared documents,
+        which only hold documents as they were fetched.
+        """
+        if self._doc_cache is not None:
+            self._doc_cache.discard_many(ids)
+        if self._shared_docs is not None:
+            for doc_id in ids:
+                self._shared_docs.pop(doc_id, None)
+
+    def _owns(self, doc):
+        """
+        Check if doc is the session's own tracked copy of a document.
+        """
+        return isinstance(doc, a8n.Tracked) and self._cache.get(doc['_id']) is doc
+
+    def _cache_get(self, doc_id):
+        if doc_id in self._spilled:
+            return self._unspill(doc_id)
+        return self._cache.get(doc_id)
+
+    def _subject(self, doc_id):
+        """
+        Get the untracked document for a dirty doc_id without rehydrating it
+        if it has been spilled.
+        """
+        if doc_id in self._spilled:
+            return self._spill.get(doc_id)['doc']
+        return self._cache[doc_id].__subject__
+
+    def _maybe_spill(self):
+        """
+        Move all dirty documents to the spill store if there are too many in
+        memory.
+
+        Spilled documents are no longer tracked; a reference obtained before
+        the spill has to be looked up again, which rehydrates the document,
+        for changes to it to be written.
+
+        This is never called from inside a tracker callback as the change
+        being recorded would not have been applied yet.
+        """
+        if self._spill is None or self._flushing or self._savepoints:
+            return
+        num_dirty = len(self._created) + len(self._changed) - len(self._spilled)
+        if num_dirty <= self.spill_threshold:
+            return
+        # Spilled documents can't record new journal entries so sync now.
+        if self._journal is not None:
+            self._journal.sync()
+        self._refresh_indexes()
+        ids = [doc_id for doc_id in itertools.chain(self._created, self._changed)
+               if doc_id not in self._spilled]
+        self._spill.put_many(
+            (doc_id, {'doc': self._cache[doc_id].__subject__,
+                      'changes': list(self._trackers[doc_id])})
+            for doc_id in ids)
+        for doc_id in ids:
+            del self._cache[doc_id]
+            # The spilled copy is what's written; stop the caller's copy from
+            # marking the document as changed or journaling it.
+            self._trackers.pop(doc_id).detach()
+        self._spilled.update(ids)
+
+    def _unspill(self, doc_id):
+        """
+        Move a document from the spill store back into the cache, along with
+        its tracked changes, and return it.
+        """
+        record = self._spill.pop(doc_id)
+        self._spilled.discard(doc_id)
+        doc = self._tracked_and_cached(record['doc'])
+        self._trackers[doc_id].restore(record['changes'])
+        return doc
+
+    def _bulk_update(self, docs):
+        """
+        Send docs to CouchDB in adaptively sized batches of at most batch_size
+        documents, retrying transient failures, and yield the (success,
+        docid, rev_or_exc) result for each one.
+
+        With a group writer the documents are sent along with those of
+        other sessions, as the group writer is configured to.
+        """
+        if self._group_writer is not None:
+            return self._group_writer.write(docs)
+        return self._batch_writer().write(docs)
+
+    def _batch_writer(self):
+        # Pick up any changes to the configuration since the last write.
+        writer = self._writer
+        writer.max_size = self.batch_size
+        writer.min_size = self.min_batch_size
+        writer.target_time = self.batch_time
+        writer.max_bytes = self.batch_bytes
+        writer.retries = self.write_retries
+        writer.retry_delay = self.retry_delay
+        return writer
+
     def _tracked_and_cached(self, doc):
+        doc_id = doc['_id']
         def callback():
-            if doc['_id'] in self._created:
+            if doc_id in self._created:
                 return
-            self._changed.add(doc['_id'])
-        tracker = self.tracker_factory(callback)
+            self._changed.add(doc_id)
+        def change_callback(action):
+            self._journal_mark(doc_id)
+            if doc_id not in self._stale:
+                for i in self._indexes.itervalues():
+                    if i.affected_by(action['path']):
+                        self._stale.add(doc_id)
+                        break
+        if self._journal is None and not self._indexes:
+            tracker = self.tracker_factory(callback)
+        else:
+            tracker = self.tracker_factory(callback, change_callback)
         doc = tracker.track(doc)
+        for i in self._indexes.itervalues():
+            i.update(doc_id, doc.__subject__)
+        if self._savepoints:
+            # Changes from now on may have to be rolled back.
+            tracker.savepoint()
         self._trackers[doc['_id']] = tracker
         return self._cached(doc)
 
@@ -210,6 +791,47 @@ class Session(object):
         self._cache[doc['_id']] = doc
         return doc
 
+    def _refresh_indexes(self):
+        """
+        Re-index documents changed since they were last indexed.
+
+        Changes are notified before they're made so documents are only marked
+        as stale by the notification and re-indexed before the next lookup.
+        """
+        while self._stale:
+            doc_id = self._stale.pop()
+            doc = self._subject(doc_id)
+            for i in self._indexes.itervalues():
+                i.update(doc_id, doc)
+
+    def _unindex(self, doc_id):
+        self._stale.discard(doc_id)
+        for i in self._indexes.itervalues():
+            i.discard(doc_id)
+
+    def _journal_mark(self, doc_id):
+        if self._journal is not None:
+            self._journal.mark(doc_id, lambda: self._journal_record(doc_id))
+
+    def _journal_record(self, doc_id):
+        """
+        Build the journal record describing everything that will be written
+        for doc_id at the next flush.
+        """
+        record = {'id': doc_id}
+        deleted = self._deleted.get(doc_id)
+        if deleted is not None:
+            record['deleted'] = deleted['_rev']
+        if doc_id in self._created:
+            record['created'] = self._cache[doc_id].__subject__
+        elif doc_id in self._changed:
+            record['rev'] = self._cache[doc_id]['_rev']
+            record['changes'] = [
+                {'action': action['action'], 'path': action['path'],
+                 'value': action.get('value')}
+                for action in self._trackers[doc_id]]
+        return record
+
     def _freeze(self):
         deleted, self._deleted = self._deleted, {}
         created, self._created = self._created, set()
@@ -232,27 +854,151 @@ class Session(object):
             def gen_deletions():
                 return deleted.itervalues()
             def gen_additions():
-                return (self._cache[doc_id].__subject__ for doc_id in created)
+                return (self._cache_get(doc_id).__subject__ for doc_id in created)
             def gen_changes():
-                changes = (self._cache[doc_id].__subject__ for doc_id in changed)
-                changes = ((doc, iter(self._trackers[doc['_id']])) for doc in changes)
+                changes = (self._cache_get(doc_id).__subject__ for doc_id in changed)
+                changes = ((doc, _action_dicts(self._trackers[doc['_id']])) for doc in changes)
                 return changes
             self.pre_flush_hook(gen_deletions(), gen_additions(), gen_changes())
+            self._pre_dispatcher.dispatch(self, gen_deletions(), gen_additions(), gen_changes())
 
         return all_deleted, all_created, all_changed
 
-    def _post_flush(self, deleted, created, changed):
-        actions_by_doc = dict((doc_id, self._trackers[doc_id].freeze())
-                              for doc_id in changed)
+    def _post_flush(self, deleted, created, changed, spilled_revs):
+        self._discard_copies(list(itertools.chain(deleted, created, changed)))
+        actions_by_doc = {}
+        for doc_id in changed:
+            if doc_id in self._spilled:
+                actions_by_doc[doc_id] = self._spill.get(doc_id)['changes']
+            else:
+                actions_by_doc[doc_id] = list(self._trackers[doc_id].freeze())
+        def get(doc_id):
+            if doc_id not in self._spilled:
+                return self._cache[doc_id]
+            doc = self._unspill(doc_id)
+            self._trackers[doc_id].clear()
+            if doc_id in spilled_revs:
+                doc.__subject__['_rev'] = spilled_revs[doc_id]
+            return doc
         def gen_deletions():
             return deleted.itervalues()
         def gen_additions():
-            return (self._cache[doc_id] for doc_id in created)
+            return (get(doc_id) for doc_id in created)
         def gen_changes():
-            changes = (self._cache[doc_id] for doc_id in changed)
-            changes = ((doc, actions_by_doc[doc['_id']]) for doc in changes)
+            changes = (get(doc_id) for doc_id in changed)
+            changes = ((doc, _action_dicts(actions_by_doc[doc['_id']])) for doc in changes)
             return changes
         self.post_flush_hook(gen_deletions(), gen_additions(), gen_changes())
+        self._post_dispatcher.dispatch(self, gen_deletions(), gen_additions(), gen_changes())
+        # Forget any spilled documents the hook didn't need; they're clean now
+        # and will be fetched again if needed.
+        if self._spilled:
+            self._spill.discard_many(self._spilled)
+            self._spilled = set()
+
+
+class _Savepoint(object):
+    """
+    Everything a session knew when a savepoint was taken.
+    """
+
+    def __init__(self, session):
+        self.cache = dict(session._cache)
+        self.created = set(session._created)
+        self.changed = set(session._changed)
+        self.deleted = dict(session._deleted)
+        self.trackers = dict((doc_id, (tracker, tracker.savepoint()))
+                             for (doc_id, tracker) in session._trackers.iteritems())
+
+
+def _conditional_get(db, doc_id, rev):
+    """
+    GET a document unless its current revision is rev, in which case return
+    None.
+    """
+    if doc_id[:1] == '_':
+        resource = db.resource(*doc_id.split('/', 1))
+    else:
+        resource = db.resource(doc_id)
+    # couchdb-python sends If-None-Match, and handles the 304, only for a
+    # response it has cached so give it one with the revision's ETag. The
+    # cache is shared with every other request through the database so put
+    # back whatever was cached before, unless the response replaced it.
+    cache = resource.session.cache
+    cached = cache.get(resource.url)
+    date = email.utils.formatdate(usegmt=True)
+    seeded = (304, {'etag': '"%s"' % rev, 'Date': date}, None)
+    cache.put(resource.url, seeded)
+    try:
+        status, headers, data = resource.get_json()
+    finally:
+        if cache.get(resource.url) is seeded:
+            if cached is None:
+                cache.remove(resource.url)
+            else:
+                cache.put(resource.url, cached)
+    if status == 304:
+        return None
+    return couchdb.Document(data)
+
+
+def _action_dicts(actions):
+    """
+    Iterate tracked actions as the plain dicts hooks are given, e.g. to pass
+    on as JSON.
+    """
+    return (dict(action) for action in actions)
+
+
+def _fetch_chunks(db, chunks, concurrency):
+    """
+    Fetch chunks of ids with _all_docs, up to concurrency requests at a time,
+    returning each chunk's documents in order.
+    """
+    def fetch(chunk):
+        rows = db.view('_all_docs', keys=chunk, include_docs=True)
+        return [row.doc for row in rows if row.doc is not None]
+    if len(chunks) < 2 or concurrency < 2:
+        return itertools.imap(fetch, chunks)
+    pool = ThreadPool(min(concurrency, len(chunks)))
+    try:
+        return pool.map(fetch, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _replace(doc, content):
+    """
+    Make a tracked document's content the same as content's, tracking only
+    what's different.
+    """
+    content = dict((name, value) for (name, value) in content.iteritems()
+                   if name not in ('_id', '_rev', '_deleted'))
+    for name in [name for name in doc if name not in content and name not in ('_id', '_rev')]:
+        del doc[name]
+    doc.update(content)
+
+
+def _chunks(items, size):
+    """
+    Split an iterable into lists of at most size items. A size of None means
+    everything in one chunk.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _unique(items):
+    """
+    Remove duplicates from a list, preserving order.
+    """
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
 
 
 class SessionViewResults(object):
@@ -292,7 +1038,7 @@ class SessionRow(object):
     def doc(self):
         doc = self._row.doc
         if doc is not None:
-            cached = self._session._cache.get(doc['_id'])
+            cached = self._session._cache_get(doc['_id'])
             if cached is not None:
                 return cached
             doc = self._session.decode_doc(doc)
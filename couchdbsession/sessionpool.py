@@ -0,0 +1,143 @@
+"""
+Pool of sessions for processes, e.g. web servers, that use a session per
+request.
+
+A session is taken from the pool with acquire(), or the session() context
+manager, and given back with release(). Sessions are created when needed,
+all bound to the same database, hooks and other Session arguments. Released
+sessions are reset, along with their batch writer's adapted batch size and
+stats, so the next request gets a session that knows nothing about the
+last one, and up to max_idle of them are kept to be handed out
+again rather than building a new session, with its batch writer,
+dispatchers and indexes, for every request. Anything a request didn't
+flush is lost when its session is released.
+
+A released session is only reused if it's as it was created: one that has
+had subscriptions added or attributes set, e.g. a different batch_size, is
+thrown away.
+
+Documents that every request reads and that rarely change, e.g.
+configuration, can be loaded once with prewarm() and shared by every
+session. A session that asks for a shared document gets its own copy
+without a request to CouchDB. A shared document is dropped as soon as any
+session writes it.
+
+Known limitations:
+    * The pool is thread safe but its sessions are not; a session must only
+      be used by one thread at a time.
+    * Shared documents changed by anything other than the pool's sessions
+      are not refreshed until prewarm() is called again.
+"""
+
+import contextlib
+import threading
+
+from couchdbsession import session as _session
+
+
+class SessionPool(object):
+
+    def __init__(self, db, max_idle=10, session_class=_session.Session, **kwargs):
+        # A journal or spill store belongs to a single session.
+        if kwargs.get('journal') is not None or kwargs.get('spill') is not None:
+            raise ValueError('pooled sessions cannot share a journal or spill store')
+        self.db = db
+        self.max_idle = max_idle
+        self.session_class = session_class
+        self._kwargs = kwargs
+        self._shared = {}
+        self._lock = threading.Lock()
+        self._idle = []
+        self._leased = set()
+        # The attributes of a session as it was created.
+        self._attrs = None
+        self._stats = {'created': 0, 'reused': 0, 'discarded': 0}
+
+    def acquire(self):
+        """
+        Return a session, reset and ready for a new request.
+        """
+        with self._lock:
+            session = None
+            if self._idle:
+                session = self._idle.pop()
+                self._stats['reused'] += 1
+        if session is None:
+            session = self._create()
+        with self._lock:
+            self._leased.add(session)
+        return session
+
+    def release(self, session):
+        """
+        Give a session back to the pool, forgetting everything it knows.
+        """
+        with self._lock:
+            if session not in self._leased:
+                raise ValueError('session is not leased from this pool')
+            self._leased.remove(session)
+        recyclable = self._recyclable(session)
+        # Reset even a session that's thrown away to free its trackers now.
+        session.reset()
+        # The next request starts with the default batch size and no stats.
+        session._writer.reset()
+        with self._lock:
+            if recyclable and len(self._idle) < self.max_idle:
+                self._idle.append(session)
+            else:
+                self._stats['discarded'] += 1
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Context manager acquiring a session and releasing it when done.
+        """
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def prewarm(self, ids):
+        """
+        Load the documents with ids, in as few requests as possible, to be
+        shared by every session, refreshing any that are already shared.
+        """
+        ids = list(ids)
+        docs = {}
+        for chunk in _session._chunks(ids, self.session_class.batch_size):
+            for row in self.db.view('_all_docs', keys=chunk, include_docs=True):
+                if row.doc is not None:
+                    docs[row.key] = row.doc
+        for doc_id in ids:
+            if doc_id not in docs:
+                self._shared.pop(doc_id, None)
+        self._shared.update(docs)
+
+    def stats(self):
+        """
+        Return the number of sessions created, reused, discarded, in use and
+        idle, and the number of shared documents.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._leased)
+            stats['idle'] = len(self._idle)
+        stats['shared'] = len(self._shared)
+        return stats
+
+    def _create(self):
+        session = self.session_class(self.db, shared_docs=self._shared, **self._kwargs)
+        with self._lock:
+            self._stats['created'] += 1
+            if self._attrs is None:
+                self._attrs = frozenset(vars(session))
+        return session
+
+    def _recyclable(self, session):
+        """
+        Check that nothing has been added to a session since it was created.
+        """
+        return (frozenset(vars(session)) == self._attrs and
+                not len(session._pre_dispatcher) and
+                not len(session._post_dispatcher))
@@ -0,0 +1,296 @@
+"""
+Asynchronous, bounded sink for flushed changes, e.g. for shipping change
+logs to an audit log or a search index without slowing down every flush.
+
+A ChangeSink is a post-flush hook, to pass as a session's post_flush_hook
+or to subscribe(). It copies what each flush did into records, queues them
+and returns; a background thread passes them on, in order, to
+deliver(records) in batches of up to batch_size. A batch is delivered as
+soon as it's full or once its oldest record has waited max_delay seconds.
+
+Each record is a dict with the document's 'id' and 'rev', 'kind' ('deleted',
+'created' or 'changed'), a copy of the 'doc' and, for a changed document,
+the 'actions' that changed it.
+
+At most max_queue records are held in memory. When the queue is full the
+policy decides what a flush does:
+
+    * 'block', the default: wait for the worker to make room.
+    * 'drop': throw the new records away; they're counted in the stats.
+    * 'spill': pickle the new records to a local SQLite file, in dir, to be
+      delivered, still in order, once the worker catches up.
+
+A failed delivery is retried, up to retries times, after retry_delay
+seconds; after that the batch is logged and counted as failed.
+
+close() stops accepting records, delivers everything still queued or
+spilled and stops the worker. Sinks still open when the interpreter exits
+are closed then.
+
+Known limitations:
+    * Records are lost if the process dies before they're delivered; the
+      spill file is scratch space, not a durable queue.
+"""
+
+import atexit
+import collections
+import copy
+import cPickle as pickle
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+
+
+log = logging.getLogger(__name__)
+
+
+class ChangeSink(object):
+
+    def __init__(self, deliver, max_queue=10000, batch_size=100, max_delay=1.0,
+                 policy='block', dir=None, retries=3, retry_delay=1.0,
+                 clock=time.time, sleep=time.sleep):
+        if policy not in ('block', 'drop', 'spill'):
+            raise ValueError('policy must be "block", "drop" or "spill"')
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.policy = policy
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._deliver = deliver
+        self._clock = clock
+        self._sleep = sleep
+        self._cond = threading.Condition()
+        # (queued, record) pairs, oldest first.
+        self._queue = collections.deque()
+        self._spill = _SpillQueue(dir) if policy == 'spill' else None
+        # Records taken from the queue but not yet delivered.
+        self._delivering = 0
+        # Threads waiting in flush(); partial batches are sent straight away.
+        self._flushers = 0
+        self._closed = False
+        self._stats = {'queued': 0, 'delivered': 0, 'dropped': 0, 'failed': 0,
+                       'batches': 0, 'last_lag': None}
+        self._worker = threading.Thread(target=self._run, name='couchdbsession-sink')
+        self._worker.daemon = True
+        self._worker.start()
+        _open_sinks.add(self)
+
+    def __call__(self, session, deletions, additions, changes):
+        """
+        Queue records of a flush's deletions, additions and changes.
+        """
+        records = []
+        for doc in deletions:
+            records.append(_record('deleted', doc))
+        for doc in additions:
+            records.append(_record('created', doc))
+        for doc, actions in changes:
+            records.append(_record('changed', doc, actions))
+        self.put(copy.deepcopy(records))
+
+    def put(self, records):
+        """
+        Queue records for delivery, as the policy says when the queue is
+        full. The records must not be changed afterwards.
+        """
+        now = self._clock()
+        with self._cond:
+            if self._closed:
+                raise ValueError('sink is closed')
+            for record in records:
+                if self._spill is not None and (self._spill or self._full()):
+                    # Spill everything once anything is spilled to keep
+                    # records in order.
+                    self._spill.put(now, record)
+                elif not self._full():
+                    self._queue.append((now, record))
+                elif self.policy == 'drop':
+                    self._stats['dropped'] += 1
+                    continue
+                else:
+                    while self._full() and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        raise ValueError('sink is closed')
+                    self._queue.append((now, record))
+                self._stats['queued'] += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything queued so far has been delivered, or tried,
+        returning False if that takes longer than timeout seconds.
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._cond:
+            self._flushers += 1
+            self._cond.notify_all()
+            try:
+                while self._queue or self._spill or self._delivering:
+                    remaining = None if deadline is None else deadline - self._clock()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushers -= 1
+        return True
+
+    def close(self, timeout=None):
+        """
+        Stop accepting records and deliver everything already queued.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout)
+        if self._spill is not None and not self._worker.is_alive():
+            self._spill.close()
+        _open_sinks.discard(self)
+
+    def stats(self):
+        """
+        Return the number of records queued, delivered, dropped and failed,
+        the number of batches delivered, the current depth of the queue and
+        spill file, the lag, in seconds, of the oldest undelivered record and
+        of the last batch when it was delivered.
+        """
+        now = self._clock()
+        with self._cond:
+            stats = dict(self._stats)
+            stats['depth'] = len(self._queue)
+            stats['spilled'] = len(self._spill) if self._spill is not None else 0
+            oldest = []
+            if self._queue:
+                oldest.append(self._queue[0][0])
+            if self._spill:
+                oldest.append(self._spill.oldest())
+        stats['lag'] = now - min(oldest) if oldest else 0.0
+        return stats
+
+    def _full(self):
+        return len(self._queue) >= self.max_queue
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                self._delivering = len(batch)
+                self._cond.notify_all()
+            try:
+                self._deliver_batch(batch)
+            finally:
+                with self._cond:
+                    self._delivering = 0
+                    self._cond.notify_all()
+
+    def _next_batch(self):
+        """
+        Wait for the next batch of (queued, record) pairs, or return None
+        when the sink is closed and everything has been delivered. Called
+        with the lock held.
+        """
+        while True:
+            if self._queue:
+                age = self._clock() - self._queue[0][0]
+                if len(self._queue) >= self.batch_size or age >= self.max_delay or \
+                        self._closed or self._flushers or self._spill:
+                    return [self._queue.popleft()
+                            for i in xrange(min(self.batch_size, len(self._queue)))]
+                self._cond.wait(self.max_delay - age)
+            elif self._spill:
+                return self._spill.take(self.batch_size)
+            elif self._closed:
+                return None
+            else:
+                self._cond.wait()
+
+    def _deliver_batch(self, batch):
+        records = [record for (queued, record) in batch]
+        attempt = 0
+        while True:
+            try:
+                self._deliver(records)
+            except Exception:
+                if attempt < self.retries:
+                    attempt += 1
+                    self._sleep(self.retry_delay)
+                    continue
+                log.exception('change sink delivery failed: records=%d', len(records))
+                with self._cond:
+                    self._stats['failed'] += len(records)
+                return
+            break
+        with self._cond:
+            self._stats['delivered'] += len(records)
+            self._stats['batches'] += 1
+            self._stats['last_lag'] = self._clock() - batch[0][0]
+
+
+class _SpillQueue(object):
+    """
+    Pickled (queued, record) pairs, in a SQLite file, in the order they were
+    put. Used with the sink's lock held.
+    """
+
+    def __init__(self, dir=None):
+        fd, self.filename = tempfile.mkstemp(prefix='couchdbsession-sink-', dir=dir)
+        os.close(fd)
+        # Written by flushing threads and read by the worker.
+        self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+        # Nothing here needs to survive a crash so don't pay for durability.
+        self._conn.execute('PRAGMA journal_mode = OFF')
+        self._conn.execute('PRAGMA synchronous = OFF')
+        self._conn.execute('CREATE TABLE queue (seq INTEGER PRIMARY KEY, '
+                           'queued REAL, data BLOB)')
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def put(self, queued, record):
+        data = sqlite3.Binary(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        self._conn.execute('INSERT INTO queue (queued, data) VALUES (?, ?)', (queued, data))
+        self._conn.commit()
+        self._len += 1
+
+    def oldest(self):
+        return self._conn.execute('SELECT queued FROM queue ORDER BY seq LIMIT 1').fetchone()[0]
+
+    def take(self, count):
+        rows = self._conn.execute('SELECT seq, queued, data FROM queue ORDER BY seq LIMIT ?',
+                                  (count,)).fetchall()
+        if rows:
+            self._conn.execute('DELETE FROM queue WHERE seq <= ?', (rows[-1][0],))
+            self._conn.commit()
+            self._len -= len(rows)
+        return [(queued, pickle.loads(str(data))) for (seq, queued, data) in rows]
+
+    def close(self):
+        self._conn.close()
+        os.remove(self.filename)
+
+
+def _record(kind, doc, actions=None):
+    doc = getattr(doc, '__subject__', doc)
+    record = {'kind': kind, 'id': doc['_id'], 'rev': doc.get('_rev'), 'doc': doc}
+    if actions is not None:
+        record['actions'] = [dict(action) for action in actions]
+    return record
+
+
+_open_sinks = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_sinks():
+    for sink in list(_open_sinks):
+        sink.close()
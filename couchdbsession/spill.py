@@ -0,0 +1,66 @@
+"""
+Local disk store for documents a session cannot afford to keep in memory.
+
+Records are pickled, so anything a decode_doc hook produces can be spilled,
+and kept in a SQLite database that is thrown away when the store is closed.
+The store is scratch space for a single session, not a durable cache; use a
+journal for durability.
+
+Known limitations:
+    * Not thread safe.
+    * Documents are no longer tracked once spilled; references to them taken
+      before the spill must be looked up again before changing them.
+"""
+
+import cPickle as pickle
+import os
+import sqlite3
+import tempfile
+
+
+class SpillStore(object):
+
+    def __init__(self, dir=None):
+        fd, self.filename = tempfile.mkstemp(prefix='couchdbsession-spill-',
+                                             dir=dir)
+        os.close(fd)
+        self._conn = sqlite3.connect(self.filename)
+        # Nothing here needs to survive a crash so don't pay for durability.
+        self._conn.execute('PRAGMA journal_mode = OFF')
+        self._conn.execute('PRAGMA synchronous = OFF')
+        self._conn.execute('CREATE TABLE spill (id TEXT PRIMARY KEY, data BLOB)')
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM spill').fetchone()[0]
+
+    def put_many(self, items):
+        """
+        Store an iterable of (id, record) pairs.
+        """
+        rows = ((id, sqlite3.Binary(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)))
+                for (id, record) in items)
+        self._conn.executemany('INSERT OR REPLACE INTO spill VALUES (?, ?)', rows)
+        self._conn.commit()
+
+    def get(self, id, default=None):
+        row = self._conn.execute('SELECT data FROM spill WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(str(row[0]))
+
+    def pop(self, id, default=None):
+        record = self.get(id, default)
+        self.discard_many([id])
+        return record
+
+    def discard_many(self, ids):
+        self._conn.executemany('DELETE FROM spill WHERE id = ?', ((id,) for id in ids))
+        self._conn.commit()
+
+    def clear(self):
+        self._conn.execute('DELETE FROM spill')
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+        os.remove(self.filename)
@@ -1,6 +1,8 @@
 import datetime
 import unittest
+from StringIO import StringIO
 
+import couchdb
 from couchdbsession import a8n
 
 
@@ -23,6 +25,59 @@ class TestTracker(unittest.TestCase):
         tracker.track({})['foo'] ='bar'
         assert state
 
+    def test_change_callback(self):
+        state = []
+        tracker = a8n.Tracker(change_callback=state.append)
+        obj = tracker.track({})
+        obj['foo'] = 'bar'
+        obj['foo'] = 'baz'
+        del obj['foo']
+        assert state == [{'action': 'create', 'path': ['foo'], 'value': 'bar'},
+                         {'action': 'edit', 'path': ['foo'], 'value': 'baz', 'was': 'bar'},
+                         {'action': 'remove', 'path': ['foo'], 'was': 'baz'}]
+        assert list(tracker) == []
+
+    def test_lazy_tables(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': {'b': [1]}})
+        obj['a']['b'][0]
+        assert tracker._changes == ()
+        assert tracker._recorder_creates is None and tracker._recorder_edits is None
+        obj['a']['b'][0] = 2
+        assert list(tracker) == [{'action': 'edit', 'path': ['a', 'b', 0], 'value': 2, 'was': 1}]
+
+
+class TestAction(unittest.TestCase):
+
+    def test_mapping(self):
+        action = a8n.Action('edit', ['a'], 2, 1)
+        assert action['path'] == ['a']
+        assert action == {'action': 'edit', 'path': ['a'], 'value': 2, 'was': 1}
+        assert dict(action) == {'action': 'edit', 'path': ['a'], 'value': 2, 'was': 1}
+        assert sorted(action) == ['action', 'path', 'value', 'was']
+        action['value'] = 3
+        assert action.get('value') == 3
+        self.assertRaises(KeyError, action.__setitem__, 'other', 1)
+
+    def test_missing_keys(self):
+        action = a8n.Action('remove', ['a'], was=1)
+        assert 'value' not in action and len(action) == 3
+        assert action.get('value') is None
+        self.assertRaises(KeyError, action.__getitem__, 'value')
+
+    def test_no_dict(self):
+        tracker = a8n.Tracker()
+        tracker.track({})['a'] = 1
+        action, = tracker
+        assert not hasattr(action, '__dict__')
+        assert not hasattr(tracker, '__dict__')
+
+    def test_pickle(self):
+        import cPickle as pickle
+        action = a8n.Action('create', ['a', 0], {'b': 1})
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            assert pickle.loads(pickle.dumps(action, protocol)) == action
+
 
 class TestImmutableTracking(unittest.TestCase):
 
@@ -34,6 +89,40 @@ class TestImmutableTracking(unittest.TestCase):
             assert obj is tracker.track(obj)
 
 
+class Point(object):
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+
+class Point3D(Point):
+    pass
+
+
+class Money(object):
+    pass
+
+
+class TestTypeRegistration(unittest.TestCase):
+
+    def test_when_type(self):
+        seen = []
+        @a8n.when_type(Point)
+        def track_point(obj, tracker, path):
+            seen.append(path)
+            return obj
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': Point(1, 2), 'b': Point3D(1, 2)})
+        obj['a'], obj['b']
+        assert seen == [['a'], ['b']]
+
+    def test_register_immutable(self):
+        a8n.register_immutable(Money)
+        money = Money()
+        tracker = a8n.Tracker()
+        assert tracker.track({'a': money})['a'] is money
+        assert Money in a8n._track.immutable
+
+
 class TestDictTracking(unittest.TestCase):
 
     def test_add_item(self):
@@ -143,6 +232,78 @@ class TestDictTracking(unittest.TestCase):
         obj.update({'foo': 'bar'})
         assert list(tracker) == [{'action': 'create', 'path': ['foo'], 'value': 'bar'}]
 
+    def test_update_merges(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': 0, 'b': 0, 'nested': {'x': 0}})
+        obj['a'] = 1
+        obj['c'] = 1
+        obj['nested']['x'] = 1
+        obj.update([('a', 2), ('b', 2)], c=2, nested={}, d=2)
+        assert obj == {'a': 2, 'b': 2, 'c': 2, 'd': 2, 'nested': {}}
+        changes = sorted(tracker, key=lambda action: action['path'])
+        assert changes == [{'action': 'edit', 'path': ['a'], 'value': 2, 'was': 0},
+                           {'action': 'edit', 'path': ['b'], 'value': 2, 'was': 0},
+                           {'action': 'create', 'path': ['c'], 'value': 2},
+                           {'action': 'create', 'path': ['d'], 'value': 2},
+                           {'action': 'edit', 'path': ['nested'], 'value': {}, 'was': {'x': 1}}]
+
+    def test_update_private(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track(couchdb.Document({'_id': 'a'}))
+        obj.update({'_rev': '1-a', 'foo': 'bar'})
+        assert obj['_rev'] == '1-a'
+        assert list(tracker) == [{'action': 'create', 'path': ['foo'], 'value': 'bar'}]
+
+    def test_clear(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': 0, 'nested': {'x': 0}})
+        obj['a'] = 1
+        obj['b'] = 1
+        obj['nested']['x'] = 1
+        obj.clear()
+        assert obj == {}
+        changes = sorted(tracker, key=lambda action: action['path'])
+        assert changes == [{'action': 'remove', 'path': ['a'], 'was': 0},
+                           {'action': 'remove', 'path': ['nested'], 'was': {'x': 1}}]
+
+    def test_pop(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'foo': 'bar'})
+        assert obj.pop('missing', None) is None
+        self.assertRaises(KeyError, obj.pop, 'missing')
+        assert obj.pop('foo') == 'bar'
+        assert list(tracker) == [{'action': 'remove', 'path': ['foo'], 'was': 'bar'}]
+
+    def test_popitem(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'foo': 'bar'})
+        assert obj.popitem() == ('foo', 'bar')
+        self.assertRaises(KeyError, obj.popitem)
+        assert list(tracker) == [{'action': 'remove', 'path': ['foo'], 'was': 'bar'}]
+
+    def test_setdefault(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'foo': {}})
+        obj.setdefault('foo', {})['x'] = 1
+        assert obj.setdefault('bar', 'baz') == 'baz'
+        assert list(tracker) == [{'action': 'create', 'path': ['foo', 'x'], 'value': 1},
+                                 {'action': 'create', 'path': ['bar'], 'value': 'baz'}]
+
+    def test_mapping(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'foo': {}, 'bar': 1})
+        assert 'foo' in obj and obj.has_key('bar') and 'baz' not in obj
+        assert len(obj) == 2
+        assert sorted(obj) == sorted(obj.iterkeys()) == ['bar', 'foo']
+        assert obj.get('baz', 'default') == 'default'
+        assert hasattr(obj.get('foo'), '__subject__')
+        assert hasattr(dict(obj.items())['foo'], '__subject__')
+        assert hasattr(dict(obj.iteritems())['foo'], '__subject__')
+        assert [hasattr(v, '__subject__') for v in obj.values() if v != 1] == [True]
+        assert repr(obj) == repr(obj.__subject__)
+        dict(obj.iteritems())['foo']['x'] = 1
+        assert list(tracker) == [{'action': 'create', 'path': ['foo', 'x'], 'value': 1}]
+
     def test_edits_not_wrapped(self):
         tracker = a8n.Tracker()
         obj = tracker.track({'foo': {}})
@@ -436,6 +597,43 @@ class TestChangingPaths(unittest.TestCase):
         assert list(tracker) == [{'action': 'remove', 'path': [0], 'was': {'a': 1}},
                                  {'action': 'edit', 'path': [0, 'b'], 'value': 'b', 'was': 2}]
 
+    def test_insert_then_edit_created(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track(['x'])
+        obj.append('y')
+        obj.insert(0, 'z')
+        obj[1] = 'q'
+        before = ['x']
+        a8n.apply_changes(before, tracker)
+        assert before == obj == ['z', 'q', 'y']
+
+    def test_insert_then_replace_nested(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track([{'a': 0}, {'b': 1}])
+        obj[0]['a'] = 5
+        obj.insert(0, 'z')
+        obj[0] = 'q'
+        before = [{'a': 0}, {'b': 1}]
+        a8n.apply_changes(before, tracker)
+        assert before == obj == ['q', {'a': 5}, {'b': 1}]
+
+    def test_remove_created_before_later_positions(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track([])
+        obj.extend([1, 2])
+        del obj[0]
+        before = []
+        a8n.apply_changes(before, tracker)
+        assert before == obj == [2]
+
+    def test_removed_item_not_tracked(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track([{}, {}])
+        removed = obj[0]
+        del obj[0]
+        removed['foo'] = 'bar'
+        assert list(tracker) == [{'action': 'remove', 'path': [0], 'was': {'foo': 'bar'}}]
+
 
 class TestUntracked(unittest.TestCase):
 
@@ -453,6 +651,267 @@ class TestUntracked(unittest.TestCase):
         obj[0]['foo'] = 'bar'
         assert list(tracker) == [{'action': 'create', 'path': [0], 'value': {'foo': 'bar'}}]
 
+    def test_untracked_in_nested_dict(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'nested': {}})
+        obj['nested']['list'] = []
+        obj['nested']['list'].append('foo')
+        assert list(tracker) == [{'action': 'create', 'path': ['nested', 'list'], 'value': ['foo']}]
+
+    def test_replaced_with_equal(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({})
+        obj['list'] = []
+        obj['list'] = []
+        obj['list'].append('foo')
+        assert list(tracker) == [{'action': 'create', 'path': ['list'], 'value': ['foo']}]
+
+
+class TestPaths(unittest.TestCase):
+
+    def test_interned(self):
+        root = a8n._Path()
+        assert root.child('a') is root.child('a')
+        assert root.child('a').child(0) is root.child('a').child(0)
+        assert root.child('b') is not root.child('a')
+        assert root.child('a').child(0) == ['a', 0] and list(root.child('b')) == ['b']
+        assert root.child('a').child(0).startswith(root.child('a'))
+        assert not root.child('b').startswith(root.child('a'))
+
+    def test_shared_by_actions(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': {'b': 1, 'c': 1}})
+        obj['a']['b'] = 2
+        obj['a']['c'] = 2
+        first, second = tracker
+        assert first.path.parent is second.path.parent
+        assert first['path'] == ['a', 'b'] and type(first['path']) is list
+        assert dict(second)['path'] == ['a', 'c']
+
+
+class TestSerialisation(unittest.TestCase):
+
+    def test_round_trip(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'items': [{'price': 1}, {'price': 2}], 'old': 1})
+        obj['items'][0]['price'] = 10
+        obj['items'][1]['price'] = 20
+        obj['items'].append({'price': 30})
+        del obj['old']
+        f = StringIO()
+        tracker.dump(f)
+        f.seek(0)
+        assert list(a8n.load_changes(f)) == list(tracker)
+
+    def test_interned_segments(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'items': [{'price': 1}, {'price': 2}]})
+        obj['items'][0]['price'] = 10
+        obj['items'][1]['price'] = 20
+        f = StringIO()
+        tracker.dump(f)
+        assert f.getvalue() == '["s","items","price"]\n' \
+                               '["e",[0,-1,1],10,1]\n' \
+                               '["e",[0,-2,1],20,2]\n'
+
+    def test_without_was(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': 1, 'b': 2})
+        obj['a'] = 10
+        del obj['b']
+        f = StringIO()
+        tracker.dump(f, was=False)
+        f.seek(0)
+        assert list(a8n.load_changes(f)) == [{'action': 'edit', 'path': ['a'], 'value': 10},
+                                             {'action': 'remove', 'path': ['b']}]
+
+    def test_encode_decode(self):
+        today = datetime.date.today()
+        tracker = a8n.Tracker()
+        tracker.track({})['when'] = today
+        f = StringIO()
+        tracker.dump(f, encode=lambda value: value.toordinal())
+        f.seek(0)
+        loaded = a8n.Tracker()
+        loaded.load(f, decode=datetime.date.fromordinal)
+        assert list(loaded) == [{'action': 'create', 'path': ['when'], 'value': today}]
+
+
+class TestJsonPatch(unittest.TestCase):
+
+    def test_patch(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': 1, 'b': 2, 'list': [1, 2]})
+        obj['a'] = 10
+        del obj['b']
+        obj['c'] = 3
+        obj['list'].insert(0, 0)
+        assert tracker.json_patch() == [
+            {'op': 'replace', 'path': '/a', 'value': 10},
+            {'op': 'remove', 'path': '/b'},
+            {'op': 'add', 'path': '/c', 'value': 3},
+            {'op': 'add', 'path': '/list/0', 'value': 0}]
+
+    def test_escaping(self):
+        tracker = a8n.Tracker()
+        tracker.track({})['a/b~c'] = 1
+        assert tracker.json_patch() == [{'op': 'add', 'path': '/a~1b~0c', 'value': 1}]
+        assert a8n.apply_json_patch({}, tracker.json_patch()) == {'a/b~c': 1}
+
+    def test_list_shifts(self):
+        before = {'list': [{'n': 0}, {'n': 1}, {'n': 2}]}
+        tracker = a8n.Tracker()
+        obj = tracker.track({'list': [{'n': 0}, {'n': 1}, {'n': 2}]})
+        item = obj['list'][2]
+        obj['list'].pop(0)
+        obj['list'].insert(0, {'n': -1})
+        obj['list'].append({'n': 3})
+        item['n'] = 20
+        del obj['list'][1]
+        assert a8n.apply_json_patch(before, tracker.json_patch()) == obj
+
+    def test_apply(self):
+        doc = {'a': {'b': [1, 2]}, 'c': 1}
+        a8n.apply_json_patch(doc, [
+            {'op': 'test', 'path': '/c', 'value': 1},
+            {'op': 'add', 'path': '/a/b/-', 'value': 3},
+            {'op': 'copy', 'from': '/a/b', 'path': '/d'},
+            {'op': 'move', 'from': '/c', 'path': '/a/c'},
+            {'op': 'replace', 'path': '/a/b/0', 'value': 0},
+            {'op': 'remove', 'path': '/d/1'}])
+        assert doc == {'a': {'b': [0, 2, 3], 'c': 1}, 'd': [1, 3]}
+
+    def test_apply_copies_values(self):
+        patch = [{'op': 'add', 'path': '/a', 'value': {'a': 1}},
+                 {'op': 'replace', 'path': '/a/a', 'value': 2},
+                 {'op': 'replace', 'path': '/b', 'value': [1]},
+                 {'op': 'add', 'path': '/b/-', 'value': 2}]
+        first = a8n.apply_json_patch({'b': None}, patch)
+        second = a8n.apply_json_patch({'b': None}, patch)
+        assert patch[0]['value'] == {'a': 1} and patch[2]['value'] == [1]
+        assert first == second == {'a': {'a': 2}, 'b': [1, 2]}
+        assert first['a'] is not second['a']
+
+    def test_apply_errors(self):
+        for op in [{'op': 'test', 'path': '/a', 'value': 2},
+                   {'op': 'remove', 'path': '/missing'},
+                   {'op': 'replace', 'path': '/missing', 'value': 1},
+                   {'op': 'add', 'path': '/list/5', 'value': 1},
+                   {'op': 'add', 'path': '/list/x', 'value': 1},
+                   {'op': 'add', 'path': '', 'value': 1},
+                   {'op': 'unknown', 'path': '/a'}]:
+            self.assertRaises(ValueError, a8n.apply_json_patch,
+                              {'a': 1, 'list': []}, [op])
+
+
+class TestApplyChanges(unittest.TestCase):
+
+    def test_apply(self):
+        doc = {'a': 1, 'b': 2, 'list': [1, 3]}
+        a8n.apply_changes(doc, [
+            {'action': 'edit', 'path': ['a'], 'value': 10},
+            {'action': 'remove', 'path': ['b']},
+            {'action': 'create', 'path': ['c'], 'value': 3},
+            {'action': 'create', 'path': ['list', 1], 'value': 2},
+            ])
+        assert doc == {'a': 10, 'c': 3, 'list': [1, 2, 3]}
+
+    def test_apply_tracked(self):
+        tracker = a8n.Tracker()
+        doc = tracker.track({'list': [1, 3]})
+        a8n.apply_changes(doc, [{'action': 'create', 'path': ['list', 1], 'value': 2}])
+        assert doc['list'] == [1, 2, 3]
+        assert list(tracker) == [{'action': 'create', 'path': ['list', 1], 'value': 2}]
+
+    def test_apply_tracked_changes(self):
+        tracker = a8n.Tracker()
+        before = {'a': {'b': 1}, 'list': [{'x': 1}, {'x': 2}]}
+        obj = tracker.track({'a': {'b': 1}, 'list': [{'x': 1}, {'x': 2}]})
+        obj['a']['b'] = 2
+        obj['list'][1]['x'] = 3
+        obj['list'].insert(0, {'x': 0})
+        a8n.apply_changes(before, tracker)
+        assert before == obj
+
+    def test_values_copied(self):
+        changes = [{'action': 'create', 'path': ['a'], 'value': {'b': 1}},
+                   {'action': 'edit', 'path': ['a', 'b'], 'value': 2},
+                   {'action': 'edit', 'path': ['c'], 'value': [1]},
+                   {'action': 'create', 'path': ['c', 1], 'value': 2}]
+        first, second = {'c': None}, {'c': None}
+        a8n.apply_changes(first, changes)
+        a8n.apply_changes(second, changes)
+        assert changes[0]['value'] == {'b': 1} and changes[2]['value'] == [1]
+        assert first == second == {'a': {'b': 2}, 'c': [1, 2]}
+        assert first['a'] is not second['a']
+
+
+class TestSavepoints(unittest.TestCase):
+
+    def test_rollback(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': 1, 'b': {'c': 1}, 'list': [1, 2, 3]})
+        obj['a'] = 2
+        savepoint = tracker.savepoint()
+        obj['a'] = 3
+        obj['b']['c'] = 2
+        del obj['list'][0]
+        obj['list'].insert(1, 'x')
+        obj['new'] = {}
+        tracker.rollback(savepoint)
+        assert obj == {'a': 2, 'b': {'c': 1}, 'list': [1, 2, 3]}
+        assert list(tracker) == [{'action': 'edit', 'path': ['a'], 'value': 2, 'was': 1}]
+
+    def test_rollback_created(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({})
+        obj['list'] = []
+        savepoint = tracker.savepoint()
+        obj['list'].append('foo')
+        tracker.rollback(savepoint)
+        assert obj == {'list': []}
+        obj['list'].append('bar')
+        before = {}
+        a8n.apply_changes(before, tracker)
+        assert before == obj == {'list': ['bar']}
+
+    def test_rollback_removed_parent(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'a': {'b': 1}})
+        savepoint = tracker.savepoint()
+        obj['a']['b'] = 2
+        del obj['a']
+        tracker.rollback(savepoint)
+        assert obj == {'a': {'b': 1}}
+        assert list(tracker) == []
+
+    def test_rollback_twice(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track([1, 2])
+        savepoint = tracker.savepoint()
+        obj.pop(0)
+        tracker.rollback(savepoint)
+        obj.append(3)
+        tracker.rollback(savepoint)
+        assert obj == [1, 2]
+
+    def test_rollback_sort(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({'list': [{'n': 2}, {'n': 1}]})
+        savepoint = tracker.savepoint()
+        obj['list'].sort(key=lambda i: i['n'])
+        obj['list'][0]['n'] = 3
+        tracker.rollback(savepoint)
+        assert obj == {'list': [{'n': 2}, {'n': 1}]}
+
+    def test_rollback_after_clear(self):
+        tracker = a8n.Tracker()
+        obj = tracker.track({})
+        obj['a'] = 1
+        savepoint = tracker.savepoint()
+        tracker.clear()
+        self.assertRaises(ValueError, tracker.rollback, savepoint)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,152 @@
+import socket
+import unittest
+import couchdb
+
+from couchdbsession import batching, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class Clock(object):
+    """
+    Clock where every write takes seconds_per_doc for each document.
+    """
+    def __init__(self, seconds_per_doc):
+        self.seconds_per_doc = seconds_per_doc
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+
+class FakeDatabase(object):
+    def __init__(self, clock=None, failures=()):
+        self.clock = clock
+        self.failures = list(failures)
+        self.batches = []
+    def update(self, docs):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.batches.append(len(docs))
+        if self.clock is not None:
+            self.clock.now += self.clock.seconds_per_doc * len(docs)
+        return [(True, doc['_id'], '1-x') for doc in docs]
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def test_fixed(self):
+        db = FakeDatabase()
+        writer = batching.BatchWriter(db, max_size=3, target_time=None)
+        results = list(writer.write({'_id': str(i)} for i in range(7)))
+        assert [r[1] for r in results] == [str(i) for i in range(7)]
+        assert db.batches == [3, 3, 1]
+
+    def test_everything_at_once(self):
+        db = FakeDatabase()
+        writer = batching.BatchWriter(db, max_size=None)
+        list(writer.write({'_id': str(i)} for i in range(7)))
+        assert db.batches == [7]
+
+    def test_shrinks_when_slow(self):
+        clock = Clock(0.1)
+        db = FakeDatabase(clock)
+        writer = batching.BatchWriter(db, max_size=100, target_time=1.0, clock=clock)
+        list(writer.write({'_id': str(i)} for i in range(200)))
+        # 100 docs take 10s so the next batch moves half way to 10 docs.
+        assert db.batches[:2] == [100, 55]
+        assert writer.stats()['size'] < 55
+
+    def test_grows_when_fast(self):
+        clock = Clock(0.1)
+        db = FakeDatabase(clock)
+        writer = batching.BatchWriter(db, max_size=100, target_time=1.0, clock=clock)
+        writer.size = 10
+        clock.seconds_per_doc = 0.001
+        list(writer.write({'_id': str(i)} for i in range(300)))
+        assert db.batches[:3] == [10, 100, 100]
+
+    def test_min_size(self):
+        clock = Clock(10)
+        writer = batching.BatchWriter(FakeDatabase(clock), max_size=100, min_size=5,
+                                      clock=clock)
+        list(writer.write({'_id': str(i)} for i in range(200)))
+        assert writer.stats()['size'] == 5
+
+    def test_max_bytes(self):
+        db = FakeDatabase()
+        writer = batching.BatchWriter(db, max_size=100, target_time=None, max_bytes=100)
+        list(writer.write({'_id': '%02d' % i, 'data': 'x' * 40} for i in range(200)))
+        assert db.batches[1] == 1
+        assert writer.stats()['bytes'] > 0
+
+    def test_retry(self):
+        sleeps = []
+        db = FakeDatabase(failures=[socket.timeout(),
+                                    couchdb.ServerError((503, ('error', 'reason')))])
+        writer = batching.BatchWriter(db, retry_delay=1, sleep=sleeps.append)
+        results = list(writer.write([{'_id': 'a'}]))
+        assert results == [(True, 'a', '1-x')]
+        assert len(sleeps) == 2
+        assert 0.5 <= sleeps[0] <= 1 and 1 <= sleeps[1] <= 2
+        assert writer.stats()['retried'] == 2
+
+    def test_gives_up(self):
+        db = FakeDatabase(failures=[socket.error()] * 3)
+        writer = batching.BatchWriter(db, retries=2, sleep=lambda s: None)
+        self.assertRaises(socket.error, list, writer.write([{'_id': 'a'}]))
+
+    def test_not_transient(self):
+        db = FakeDatabase(failures=[couchdb.ServerError((400, ('bad_request', 'reason')))])
+        writer = batching.BatchWriter(db, sleep=lambda s: None)
+        self.assertRaises(couchdb.ServerError, list, writer.write([{'_id': 'a'}]))
+
+
+class LostResponseDatabase(object):
+    """
+    Database wrapper that applies the first update and then times out.
+    """
+    def __init__(self, db):
+        self._db = db
+        self._lost = False
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+    def update(self, docs):
+        if not self._lost:
+            self._lost = True
+            self._db.update([dict(doc) for doc in docs])
+            raise socket.timeout()
+        return self._db.update(docs)
+
+
+class TestSessionRetry(TempDatabaseMixin, unittest.TestCase):
+
+    def test_lost_response(self):
+        self.db.update([{'_id': 'a'}, {'_id': 'b'}])
+        S = session.Session(LostResponseDatabase(self.db))
+        S.retry_delay = 0
+        S['a']['foo'] = 'bar'
+        S.create({'_id': 'c'})
+        S.flush()
+        # The writes that were lost are recovered with their current _rev.
+        assert S['a']['_rev'] == self.db['a']['_rev']
+        assert S['c']['_rev'] == self.db['c']['_rev']
+        assert self.db['a']['foo'] == 'bar'
+        assert S.batch_stats()['retried'] == 1
+        assert S.batch_stats()['recovered'] == 2
+        S['a']['foo'] = 'baz'
+        S.flush()
+        assert self.db['a']['foo'] == 'baz'
+
+    def test_batch_stats(self):
+        S = session.Session(self.db)
+        S.batch_size = 2
+        for i in range(5):
+            S.create({})
+        S.flush()
+        stats = S.batch_stats()
+        assert stats['max_size'] == 2
+        assert stats['batches'] == 3
+        assert stats['documents'] == 5
+
+
+if __name__ == '__main__':
+    unittest.main()
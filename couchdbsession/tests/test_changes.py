@@ -0,0 +1,105 @@
+import unittest
+
+from couchdbsession import changes, session, sessionpool
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TestChangesProcessor(TempDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestChangesProcessor, self).setUp()
+        self.db.update([{'_id': str(i), 'n': i} for i in range(10)])
+        self.batches = []
+
+    def count(self, S, docs):
+        self.batches.append(sorted(doc['_id'] for doc in docs))
+        for doc in docs:
+            if 'counted' not in doc:
+                doc['counted'] = True
+
+    def test_batches(self):
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter', batch_size=4)
+        processor.run()
+        assert [len(batch) for batch in self.batches[:3]] == [4, 4, 4]
+        assert set(sum(self.batches, [])) == set(str(i) for i in range(10))
+        assert all(self.db[str(i)]['counted'] for i in range(10))
+        # The callback's own changes have been processed too.
+        assert processor.checkpoint() == self.db.changes()['last_seq']
+        assert processor.process_batch() == 0
+
+    def test_checkpoint(self):
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter', batch_size=4)
+        assert processor.checkpoint() is None
+        assert processor.process_batch() == 4
+        seq = self.db['_local/counter']['seq']
+        # A new processor carries on where the last one stopped.
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter', batch_size=4)
+        assert processor.checkpoint() == seq
+        processor.process_batch()
+        assert self.batches[1] == ['4', '5', '6', '7']
+
+    def test_one_session_per_batch(self):
+        sessions = []
+        def factory():
+            sessions.append(CountingSession(self.db))
+            return sessions[-1]
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter', batch_size=5,
+                                             session_factory=factory)
+        processor.process_batch()
+        assert len(sessions) == 1
+        assert sessions[0].flushes == 1 and sessions[0].loads == 1
+
+    def test_pooled_sessions(self):
+        pool = sessionpool.SessionPool(self.db)
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter', batch_size=4,
+                                             session_factory=pool.acquire,
+                                             release_session=pool.release)
+        processor.run()
+        stats = pool.stats()
+        assert stats['in_use'] == 0
+        assert stats['created'] == 1 and stats['reused'] == len(self.batches) - 1
+        assert all(self.db[str(i)]['counted'] for i in range(10))
+
+    def test_deleted(self):
+        del self.db['0']
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter', batch_size=100)
+        processor.process_batch()
+        assert '0' not in self.batches[0]
+
+    def test_partitions(self):
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter', batch_size=100,
+                                             partitions=3)
+        try:
+            processor.process_batch()
+        finally:
+            processor.close()
+        assert sorted(sum(self.batches, [])) == sorted(str(i) for i in range(10))
+        assert len(self.batches) == 3
+        for batch in self.batches:
+            assert len(set(changes._partition(doc_id, 3) for doc_id in batch)) == 1
+        assert all(self.db[str(i)]['counted'] for i in range(10))
+
+    def test_poll(self):
+        polls = []
+        processor = changes.ChangesProcessor(self.db, self.count, 'counter',
+                                             sleep=lambda seconds: (polls.append(seconds),
+                                                                    processor.stop()))
+        processor.run(poll_interval=5)
+        assert polls == [5]
+
+
+class CountingSession(session.Session):
+
+    loads = flushes = 0
+
+    def get_many(self, ids):
+        self.loads += 1
+        return super(CountingSession, self).get_many(ids)
+
+    def flush(self):
+        self.flushes += 1
+        super(CountingSession, self).flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+from couchdbsession import dispatch, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = dispatch.Dispatcher()
+        self.calls = []
+
+    def hook(self, name):
+        def hook(session, deletions, additions, changes):
+            self.calls.append((name, deletions, additions, changes))
+        return hook
+
+    def test_paths(self):
+        self.dispatcher.subscribe(self.hook('price'), paths=[['items', '*', 'price']])
+        doc = {'_id': 'a'}
+        price = {'action': 'edit', 'path': ['items', 0, 'price'], 'value': 2, 'was': 1}
+        name = {'action': 'edit', 'path': ['items', 0, 'name'], 'value': 'b', 'was': 'a'}
+        items = {'action': 'edit', 'path': ['items'], 'value': [], 'was': [{}]}
+        nested = {'action': 'create', 'path': ['items', 1, 'price', 'currency'], 'value': 'EUR'}
+        self.dispatcher.dispatch(None, [], [], [(doc, [price, name, items, nested])])
+        assert self.calls == [('price', [], [], [(doc, [price, items, nested])])]
+
+    def test_not_called(self):
+        self.dispatcher.subscribe(self.hook('price'), paths=[['price']])
+        action = {'action': 'edit', 'path': ['name'], 'value': 'b', 'was': 'a'}
+        self.dispatcher.dispatch(None, [], [], [({'_id': 'a'}, [action])])
+        assert self.calls == []
+
+    def test_types(self):
+        self.dispatcher.subscribe(self.hook('order'), doc_type='order')
+        self.dispatcher.subscribe(self.hook('any'))
+        order = {'_id': 'a', 'type': 'order'}
+        other = {'_id': 'b', 'type': 'other'}
+        self.dispatcher.dispatch(None, [other], [order, other], [])
+        assert self.calls == [('order', [], [order], []),
+                              ('any', [other], [order, other], [])]
+
+    def test_type_field(self):
+        dispatcher = dispatch.Dispatcher(type_field='model_type')
+        dispatcher.subscribe(self.hook('order'), doc_type='order')
+        order = {'_id': 'a', 'model_type': 'order'}
+        dispatcher.dispatch(None, [], [order], [])
+        assert self.calls == [('order', [], [order], [])]
+
+    def test_unsubscribe(self):
+        subscription = self.dispatcher.subscribe(self.hook('any'), doc_type='order')
+        assert subscription in self.dispatcher
+        self.dispatcher.unsubscribe(subscription)
+        assert subscription not in self.dispatcher
+        self.dispatcher.dispatch(None, [], [{'_id': 'a', 'type': 'order'}], [])
+        assert self.calls == []
+
+
+class TestSessionSubscribe(TempDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSessionSubscribe, self).setUp()
+        self.db.update([{'_id': 'order', 'type': 'order', 'items': [{'price': 1}]},
+                        {'_id': 'other', 'type': 'other', 'price': 1}])
+        self.calls = []
+        self.session = session.Session(self.db)
+
+    def hook(self, session, deletions, additions, changes):
+        self.calls.append((list(deletions), list(additions),
+                           [(doc['_id'], actions) for (doc, actions) in changes]))
+
+    def test_post_flush(self):
+        self.session.subscribe(self.hook, doc_type='order', paths=[['items', '*', 'price']])
+        self.session['order']['items'][0]['price'] = 2
+        self.session['order']['note'] = 'foo'
+        self.session['other']['price'] = 2
+        self.session.flush()
+        assert self.calls == [([], [], [('order', [{'action': 'edit',
+                                                    'path': ['items', 0, 'price'],
+                                                    'value': 2, 'was': 1}])])]
+
+    def test_pre_flush(self):
+        def hook(session, deletions, additions, changes):
+            for doc, actions in changes:
+                doc['total'] = sum(item['price'] for item in doc['items'])
+        self.session.subscribe(hook, doc_type='order', paths=[['items']], pre_flush=True)
+        self.session['order']['items'].append({'price': 2})
+        self.session.flush()
+        assert self.db['order']['total'] == 3
+
+    def test_nothing_matched(self):
+        self.session.subscribe(self.hook, doc_type='order')
+        self.session['other']['price'] = 2
+        self.session.flush()
+        assert self.calls == []
+
+    def test_unsubscribe(self):
+        subscription = self.session.subscribe(self.hook)
+        self.session.unsubscribe(subscription)
+        self.session['other']['price'] = 2
+        self.session.flush()
+        assert self.calls == []
+
+
+if __name__ == '__main__':
+    unittest.main()
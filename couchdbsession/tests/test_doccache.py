@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+import unittest
+import couchdb
+from couchdb import json
+
+from couchdbsession import doccache, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TempDirMixin(object):
+
+    def setUp(self):
+        super(TempDirMixin, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(TempDirMixin, self).tearDown()
+
+
+class CountingDatabase(object):
+    """
+    Database wrapper that counts the requests for documents.
+    """
+    def __init__(self, db):
+        self._db = db
+        self.fetches = 0
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+    def get(self, *a, **k):
+        self.fetches += 1
+        return self._db.get(*a, **k)
+    def view(self, *a, **k):
+        self.fetches += 1
+        return self._db.view(*a, **k)
+
+
+class TestDocCache(TempDirMixin, unittest.TestCase):
+
+    def test_put_get(self):
+        cache = doccache.DocCache(self.filename)
+        cache.put_many([{'_id': 'a', '_rev': '1-a', 'foo': u'\xe9'}])
+        assert cache.get_many(['a', 'b']) == {'a': {'_id': 'a', '_rev': '1-a', 'foo': u'\xe9'}}
+        assert cache.revs(['a', 'b']) == {'a': '1-a'}
+        cache.discard_many(['a'])
+        assert len(cache) == 0
+
+    def test_persistent(self):
+        cache = doccache.DocCache(self.filename)
+        cache.put_many([{'_id': 'a', '_rev': '1-a'}])
+        cache.close()
+        cache = doccache.DocCache(self.filename)
+        assert 'a' in cache
+
+    def test_eviction(self):
+        size = len(json.encode({'_id': 'a', '_rev': '1-x'}))
+        cache = doccache.DocCache(self.filename, max_bytes=size * 3)
+        for id in 'abc':
+            cache.put_many([{'_id': id, '_rev': '1-x'}])
+        cache.get_many(['a'])
+        cache.put_many([{'_id': 'd', '_rev': '1-x'}])
+        # b was the least recently used.
+        assert sorted(cache.get_many('abcd')) == ['a', 'c', 'd']
+
+    def test_validate(self):
+        self.assertRaises(ValueError, doccache.DocCache, self.filename, validate='never')
+
+
+class TestSync(TempDirMixin, TempDatabaseMixin, unittest.TestCase):
+
+    def test_sync(self):
+        self.db.update([{'_id': 'a'}, {'_id': 'b'}])
+        cache = doccache.DocCache(self.filename, changes_limit=1)
+        cache.sync(self.db)
+        cache.put_many([self.db['a'], self.db['b']])
+        doc = self.db['a']
+        self.db.save(doc)
+        self.db.create({'_id': 'c'})
+        cache.sync(self.db)
+        assert 'a' not in cache and 'b' in cache
+        # Nothing's changed since.
+        cache.sync(self.db)
+        assert 'b' in cache
+
+    def test_other_database(self):
+        cache = doccache.DocCache(self.filename)
+        cache.sync(self.db)
+        cache.put_many([{'_id': 'a', '_rev': '1-a'}])
+        other = self.server.create(self.db_name + '-other')
+        try:
+            cache.sync(other)
+        finally:
+            del self.server[self.db_name + '-other']
+        assert len(cache) == 0
+
+
+class TestSessionDocCache(TempDirMixin, TempDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSessionDocCache, self).setUp()
+        self.db.update([{'_id': str(i)} for i in range(3)])
+
+    def session(self, **kwargs):
+        self.counting = CountingDatabase(self.db)
+        return session.Session(self.counting, doc_cache=doccache.DocCache(self.filename, **kwargs))
+
+    def test_get(self):
+        self.session().get('0')
+        S = self.session()
+        assert S.get('0')['_id'] == '0'
+        assert self.counting.fetches == 0
+
+    def test_get_many(self):
+        self.session().get_many(['0', '1'])
+        S = self.session()
+        docs = S.get_many(['0', '1', '2', 'missing'])
+        assert [doc and doc['_id'] for doc in docs] == ['0', '1', '2', None]
+        assert self.counting.fetches == 1
+
+    def test_changed(self):
+        self.session().get('0')
+        doc = self.db['0']
+        doc['foo'] = 'bar'
+        self.db.save(doc)
+        assert self.session().get('0')['foo'] == 'bar'
+
+    def test_flushed(self):
+        S = self.session()
+        S['0']['foo'] = 'bar'
+        S.flush()
+        assert '0' not in S._doc_cache
+
+    def test_revs(self):
+        self.session(validate='revs').get_many(['0', '1'])
+        doc = self.db['0']
+        doc['foo'] = 'bar'
+        self.db.save(doc)
+        S = self.session(validate='revs')
+        assert S.get_many(['0', '1'])[0]['foo'] == 'bar'
+        assert self.session(validate='revs').get('0')['foo'] == 'bar'
+        del self.db['1']
+        assert self.session(validate='revs').get('1') is None
+
+    def test_revs_http_cache(self):
+        self.session(validate='revs').get('0')
+        assert self.session(validate='revs').get('0')['_id'] == '0'
+        # The conditional GET leaves nothing behind in the HTTP cache.
+        assert session.Session(self.db).get('0')['_id'] == '0'
+        assert self.db.get('0')['_id'] == '0'
+
+    def test_cached_documents(self):
+        self.session().get('0')
+        S = self.session()
+        doc = S.get('0')
+        assert self.counting.fetches == 0
+        assert isinstance(doc.__subject__, couchdb.Document)
+        # Special fields aren't tracked, as for a document fetched from
+        # CouchDB.
+        doc['_attachments'] = {}
+        assert not S._changed
+
+    def test_revalidate(self):
+        S = self.session()
+        S.get_many(['0', '1'])
+        doc = self.db['0']
+        doc['foo'] = 'bar'
+        self.db.save(doc)
+        assert S.revalidate() == ['0']
+        assert S['0']['_rev'] == doc['_rev']
+        assert S['0']['foo'] == 'bar'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import uuid
+import couchdb
+
+from couchdbsession import group, session
+from couchdbsession.tests.test_session import SERVER_URL
+
+
+class TempDatabasesMixin(object):
+    def setUp(self):
+        self.server = couchdb.Server(SERVER_URL)
+        self.db_names = ['test-couchdbsession-'+str(uuid.uuid4()) for i in range(2)]
+        self.dbs = [self.server.create(db_name) for db_name in self.db_names]
+    def tearDown(self):
+        for db_name in self.db_names:
+            del self.server[db_name]
+
+
+class TestSessionGroup(TempDatabasesMixin, unittest.TestCase):
+
+    def test_flush(self):
+        a = session.Session(self.dbs[0])
+        b = session.Session(self.dbs[1])
+        sessions = group.SessionGroup({'a': a, 'b': b})
+        a_id = a.create({'db': 'a'})
+        b_id = b.create({'db': 'b'})
+        results = sessions.flush()
+        assert [r[1] for r in results['a']] == [a_id]
+        assert [r[1] for r in results['b']] == [b_id]
+        assert all(r[0] for r in results['a'] + results['b'])
+        assert self.dbs[0][a_id]['db'] == 'a'
+        assert self.dbs[1][b_id]['db'] == 'b'
+        assert not a._created and not b._created
+
+    def test_nothing_to_flush(self):
+        sessions = group.SessionGroup({'a': session.Session(self.dbs[0])})
+        assert sessions.flush() == {'a': []}
+
+    def test_hooks_dirty_other_sessions(self):
+        sessions = group.SessionGroup()
+        def a_hook(s, deletions, additions, changes):
+            # Every doc created in a is logged in b.
+            for doc in additions:
+                sessions['b'].create({'logged': doc['_id']})
+        def b_hook(s, deletions, additions, changes):
+            # The first time b logs something, a counts it.
+            for doc in additions:
+                if doc.get('logged') != 'counter':
+                    sessions['a'].create({'_id': 'counter'})
+        sessions.add('a', session.Session(self.dbs[0], pre_flush_hook=a_hook))
+        sessions.add('b', session.Session(self.dbs[1], pre_flush_hook=b_hook))
+        sessions['a'].create({'_id': 'doc'})
+        results = sessions.flush()
+        assert sorted(r[1] for r in results['a']) == ['counter', 'doc']
+        assert len(results['b']) == 2
+        logged = sorted(row.doc['logged'] for row in self.dbs[1].view('_all_docs', include_docs=True))
+        assert logged == ['counter', 'doc']
+
+    def test_add_twice(self):
+        sessions = group.SessionGroup({'a': session.Session(self.dbs[0])})
+        self.assertRaises(ValueError, sessions.add, 'a', session.Session(self.dbs[1]))
+
+    def test_write_error(self):
+        a = session.Session(self.dbs[0])
+        b = session.Session(self.dbs[1])
+        def fail(deleted, created, changed):
+            raise RuntimeError()
+        b._write = fail
+        a_id = a.create({})
+        b.create({})
+        sessions = group.SessionGroup({'a': a, 'b': b})
+        self.assertRaises(RuntimeError, sessions.flush)
+        # a was still written.
+        assert a_id in self.dbs[0]
+        assert not a._created
+
+
+if __name__ == '__main__':
+    unittest.main()
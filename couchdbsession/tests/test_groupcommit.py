@@ -0,0 +1,136 @@
+import threading
+import time
+import unittest
+
+from couchdbsession import groupcommit, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class GatedDatabase(object):
+    """
+    Database wrapper that records the ids sent in each bulk update and holds
+    the first one until it's opened.
+    """
+    def __init__(self, db):
+        self._db = db
+        self.gate = threading.Event()
+        self.entered = threading.Event()
+        self.updates = []
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+    def update(self, docs):
+        self.updates.append([doc['_id'] for doc in docs])
+        self.entered.set()
+        self.gate.wait()
+        return self._db.update(docs)
+
+
+class TestGroupCommitWriter(TempDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestGroupCommitWriter, self).setUp()
+        self.gated = GatedDatabase(self.db)
+        self.writer = groupcommit.GroupCommitWriter(self.gated)
+        self.results = {}
+
+    def write_in_thread(self, name, docs):
+        def write():
+            self.results[name] = self.writer.write(docs)
+        thread = threading.Thread(target=write)
+        thread.start()
+        return thread
+
+    def wait_pending(self, count):
+        while self.writer.stats()['pending'] < count:
+            time.sleep(0.001)
+
+    def test_single(self):
+        self.gated.gate.set()
+        results = self.writer.write([{'_id': 'a'}, {'_id': 'b'}])
+        assert [(success, docid) for (success, docid, rev) in results] == \
+                [(True, 'a'), (True, 'b')]
+        assert results[0][2] == self.db['a']['_rev']
+        assert self.writer.write([]) == []
+
+    def test_grouped(self):
+        threads = [self.write_in_thread('first', [{'_id': 'a'}])]
+        self.gated.entered.wait()
+        threads.append(self.write_in_thread('second', [{'_id': 'b'}, {'_id': 'c'}]))
+        threads.append(self.write_in_thread('third', [{'_id': 'd'}]))
+        self.wait_pending(2)
+        self.gated.gate.set()
+        for thread in threads:
+            thread.join()
+        assert sorted(map(sorted, self.gated.updates)) == [['a'], ['b', 'c', 'd']]
+        assert [docid for (success, docid, rev) in self.results['second']] == ['b', 'c']
+        assert [docid for (success, docid, rev) in self.results['third']] == ['d']
+        stats = self.writer.stats()
+        assert stats['groups'] == 2 and stats['submissions'] == 3
+        assert stats['largest_group'] == 2
+
+    def test_same_id_not_grouped(self):
+        threads = [self.write_in_thread('first', [{'_id': 'a'}])]
+        self.gated.entered.wait()
+        threads.append(self.write_in_thread('second', [{'_id': 'b'}]))
+        self.wait_pending(1)
+        threads.append(self.write_in_thread('third', [{'_id': 'b'}, {'_id': 'c'}]))
+        self.wait_pending(2)
+        self.gated.gate.set()
+        for thread in threads:
+            thread.join()
+        assert self.gated.updates == [['a'], ['b'], ['b', 'c']]
+        assert [success for (success, docid, rev) in self.results['third']] == [False, True]
+
+    def test_max_docs(self):
+        self.writer.max_docs = 2
+        threads = [self.write_in_thread('first', [{'_id': 'a'}])]
+        self.gated.entered.wait()
+        threads.append(self.write_in_thread('second', [{'_id': 'b'}, {'_id': 'c'}]))
+        self.wait_pending(1)
+        threads.append(self.write_in_thread('third', [{'_id': 'd'}]))
+        self.wait_pending(2)
+        self.gated.gate.set()
+        for thread in threads:
+            thread.join()
+        assert self.gated.updates == [['a'], ['b', 'c'], ['d']]
+
+    def test_error(self):
+        def update(docs):
+            raise ValueError('broken')
+        self.gated.update = update
+        self.assertRaises(ValueError, self.writer.write, [{'_id': 'a'}])
+        # The writer is still usable.
+        del self.gated.update
+        self.gated.gate.set()
+        assert self.writer.write([{'_id': 'a'}])[0][0]
+
+
+class TestSessionGroupCommit(TempDatabaseMixin, unittest.TestCase):
+
+    def test_sessions(self):
+        self.db.update([{'_id': str(i)} for i in range(4)])
+        writer = groupcommit.GroupCommitWriter(self.db, window=0.05)
+        flushed = []
+        def hook(session, deletions, additions, changes):
+            flushed.append([doc['_id'] for (doc, actions) in changes])
+        sessions = [session.Session(self.db, post_flush_hook=hook, group_writer=writer)
+                    for i in range(4)]
+        def request(S, doc_id):
+            S[doc_id]['foo'] = doc_id
+            S.flush()
+        threads = [threading.Thread(target=request, args=(S, str(i)))
+                   for (i, S) in enumerate(sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(flushed) == [['0'], ['1'], ['2'], ['3']]
+        for i, S in enumerate(sessions):
+            assert S[str(i)]['_rev'] == self.db[str(i)]['_rev']
+            assert self.db[str(i)]['foo'] == str(i)
+        assert writer.stats()['groups'] < 4
+        assert sessions[0].batch_stats()['submissions'] == 4
+
+
+if __name__ == '__main__':
+    unittest.main()
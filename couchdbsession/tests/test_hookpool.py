@@ -0,0 +1,104 @@
+import os
+import unittest
+
+from couchdbsession import hookpool, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+def square(n):
+    return n * n
+
+
+def pid(n):
+    return os.getpid()
+
+
+def stamp(doc):
+    doc = dict(doc)
+    doc['pid'] = os.getpid()
+    return doc
+
+
+class TestHookPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = hookpool.HookPool(processes=2, min_batch=10, block_size=25)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_ordered(self):
+        assert list(self.pool.imap(square, range(100))) == [n * n for n in range(100)]
+
+    def test_parallel(self):
+        assert os.getpid() not in self.pool.imap(pid, range(20))
+
+    def test_inline(self):
+        assert list(self.pool.imap(pid, range(5))) == [os.getpid()] * 5
+        # The short last block is run inline too.
+        pids = list(self.pool.imap(pid, range(30)))
+        assert os.getpid() not in pids[:25] and pids[25:] == [os.getpid()] * 5
+
+    def test_lazy(self):
+        consumed = []
+        def items():
+            for n in range(100):
+                consumed.append(n)
+                yield n
+        results = self.pool.imap(square, items())
+        results.next()
+        # The first block and the one after it.
+        assert len(consumed) == 50
+
+
+class StampingSession(session.Session):
+
+    def encode_doc(self, doc):
+        return stamp(doc)
+
+
+class TestSessionHookPool(TempDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSessionHookPool, self).setUp()
+        self.pool = hookpool.HookPool(processes=2, min_batch=10)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestSessionHookPool, self).tearDown()
+
+    def test_encode(self):
+        S = session.Session(self.db, encode_doc=stamp, hook_pool=self.pool)
+        ids = [S.create({'n': n}) for n in range(20)]
+        S.flush()
+        docs = [self.db[doc_id] for doc_id in ids]
+        assert [doc['n'] for doc in docs] == range(20)
+        assert os.getpid() not in [doc['pid'] for doc in docs]
+        # Documents are still tracked after the flush.
+        S[ids[0]]['n'] = 'changed'
+        S.flush()
+        assert self.db[ids[0]]['n'] == 'changed'
+
+    def test_decode(self):
+        self.db.update([{'_id': str(n)} for n in range(20)])
+        S = session.Session(self.db, decode_doc=stamp, hook_pool=self.pool)
+        docs = S.get_many([str(n) for n in range(20)])
+        assert [doc['_id'] for doc in docs] == [str(n) for n in range(20)]
+        assert os.getpid() not in [doc['pid'] for doc in docs]
+
+    def test_small_batch(self):
+        S = session.Session(self.db, encode_doc=stamp, hook_pool=self.pool)
+        doc_id = S.create({})
+        S.flush()
+        assert self.db[doc_id]['pid'] == os.getpid()
+
+    def test_overridden(self):
+        # An overridden method may need the session so is run inline.
+        S = StampingSession(self.db, encode_doc=stamp, hook_pool=self.pool)
+        ids = [S.create({}) for n in range(20)]
+        S.flush()
+        assert [self.db[doc_id]['pid'] for doc_id in ids] == [os.getpid()] * 20
+
+
+if __name__ == '__main__':
+    unittest.main()
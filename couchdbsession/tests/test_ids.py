@@ -0,0 +1,71 @@
+import itertools
+import unittest
+
+from couchdbsession import ids, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TestRandomId(unittest.TestCase):
+
+    def test_random_id(self):
+        assert len(ids.random_id()) == 32
+        assert ids.random_id() != ids.random_id()
+
+
+class TestSequentialIds(unittest.TestCase):
+
+    def test_time_prefixed(self):
+        generate = ids.SequentialIds(clock=lambda: 1.5)
+        doc_id = generate()
+        assert len(doc_id) == 32
+        assert doc_id.startswith('%014x' % 1500000)
+
+    def test_increasing(self):
+        # A clock that stands still and then goes backwards.
+        clock = iter([2.0, 2.0, 1.0]).next
+        generate = ids.SequentialIds(clock=clock)
+        generated = [generate() for i in range(3)]
+        assert generated == sorted(generated)
+        assert len(set(generated)) == 3
+
+
+class TestServerIds(TempDatabaseMixin, unittest.TestCase):
+
+    def test_batched(self):
+        requests = []
+        class Server(object):
+            def uuids(self, count):
+                requests.append(count)
+                return ['%02d' % i for i in range(len(requests) * 10, len(requests) * 10 + count)]
+        generate = ids.ServerIds(Server(), count=3)
+        assert [generate() for i in range(4)] == ['10', '11', '12', '20']
+        assert requests == [3, 3]
+
+    def test_server(self):
+        generate = ids.ServerIds(self.server, count=5)
+        generated = [generate() for i in range(6)]
+        assert len(set(generated)) == 6
+
+
+class TestSessionIds(TempDatabaseMixin, unittest.TestCase):
+
+    def test_default(self):
+        doc_id = session.Session(self.db).create({})
+        assert len(doc_id) == 32
+
+    def test_insert_order(self):
+        # Sequential ids are stored in the order the documents were created.
+        counter = itertools.count()
+        S = session.Session(self.db, id_generator=ids.SequentialIds())
+        created = [S.create({'n': counter.next()}) for i in range(100)]
+        S.flush()
+        assert [row.id for row in self.db.view('_all_docs')] == created
+
+    def test_explicit_id(self):
+        S = session.Session(self.db, id_generator=lambda: 'generated')
+        assert S.create({'_id': 'explicit'}) == 'explicit'
+        assert S.create({}) == 'generated'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+
+from couchdbsession import index, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TestIndex(unittest.TestCase):
+
+    def test_lookup(self):
+        i = index.Index('type')
+        i.update('b', {'type': 'x'})
+        i.update('a', {'type': 'x'})
+        i.update('c', {'type': 'y'})
+        i.update('d', {})
+        assert i.lookup('x') == ['a', 'b']
+        assert i.lookup('y') == ['c']
+        assert i.lookup('z') == []
+        assert len(i) == 3
+
+    def test_path(self):
+        i = index.Index(['customer', 'id'])
+        i.update('a', {'customer': {'id': 1}})
+        i.update('b', {'customer': 'not a dict'})
+        assert i.lookup(1) == ['a']
+        assert i.affected_by(['customer'])
+        assert i.affected_by(['customer', 'id'])
+        assert i.affected_by(['customer', 'id', 0])
+        assert not i.affected_by(['customer', 'name'])
+
+    def test_function(self):
+        i = index.Index(lambda doc: doc.get('first', '') + doc.get('last', '') or None)
+        i.update('a', {'first': 'a', 'last': 'b'})
+        i.update('b', {})
+        assert i.lookup('ab') == ['a']
+        assert i.affected_by(['anything'])
+
+    def test_update_and_discard(self):
+        i = index.Index('n')
+        i.update('a', {'n': 1})
+        i.update('a', {'n': 2})
+        assert i.lookup(1) == []
+        assert i.lookup(2) == ['a']
+        i.discard('a')
+        i.discard('missing')
+        assert i.lookup(2) == []
+        assert len(i) == 0
+
+    def test_lookup_range(self):
+        i = index.Index('n')
+        for n in range(10):
+            i.update(str(n), {'n': n})
+        assert i.lookup_range(3, 5) == ['3', '4', '5']
+        assert i.lookup_range(3, 5, inclusive_end=False) == ['3', '4']
+        assert i.lookup_range(endkey=1) == ['0', '1']
+        assert i.lookup_range(startkey=8) == ['8', '9']
+
+    def test_mutable_key(self):
+        i = index.Index('tags')
+        doc = {'tags': ['a']}
+        i.update('a', doc)
+        doc['tags'].append('b')
+        i.update('a', doc)
+        assert i.lookup(['a']) == []
+        assert i.lookup(['a', 'b']) == ['a']
+
+
+class TestSessionIndexes(TempDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSessionIndexes, self).setUp()
+        self.db.update([{'_id': str(n), 'order_id': n % 3, 'price': n} for n in range(9)])
+        self.session = session.Session(self.db, indexes={
+            'order': 'order_id',
+            'price': ['price']})
+
+    def test_loaded(self):
+        self.session.get_many([str(n) for n in range(9)])
+        docs = self.session.lookup('order', 1)
+        assert [doc['_id'] for doc in docs] == ['1', '4', '7']
+        assert docs[0] is self.session.get('1')
+        docs = self.session.lookup_range('price', 2, 4)
+        assert [doc['_id'] for doc in docs] == ['2', '3', '4']
+
+    def test_unflushed_changes(self):
+        doc = self.session.get('1')
+        doc['order_id'] = 2
+        doc_id = self.session.create({'order_id': 2})
+        assert [d['_id'] for d in self.session.lookup('order', 2)] == sorted(['1', doc_id])
+        assert self.session.lookup('order', 1) == []
+        self.session.delete(doc)
+        assert [d['_id'] for d in self.session.lookup('order', 2)] == [doc_id]
+
+    def test_unrelated_change(self):
+        doc = self.session.get('1')
+        doc['other'] = 'foo'
+        assert not self.session._stale
+
+    def test_rollback(self):
+        doc = self.session.get('1')
+        savepoint = self.session.savepoint()
+        doc['order_id'] = 2
+        self.session.create({'order_id': 1})
+        self.session.rollback(savepoint)
+        assert self.session.lookup('order', 1) == [doc]
+        assert self.session.lookup('order', 2) == []
+
+    def test_reset(self):
+        self.session.get('1')
+        self.session.reset()
+        assert self.session.lookup('order', 1) == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from couchdbsession import journal, session
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TempJournalMixin(object):
+    def setUp(self):
+        super(TempJournalMixin, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'journal')
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TempJournalMixin, self).tearDown()
+
+
+class TestJournal(TempJournalMixin, unittest.TestCase):
+
+    def test_sync_every(self):
+        j = journal.Journal(self.filename, sync_every=2)
+        j.mark('a', lambda: {'id': 'a'})
+        assert list(j) == []
+        j.mark('b', lambda: {'id': 'b'})
+        assert sorted(r['id'] for r in j) == ['a', 'b']
+
+    def test_record_built_at_sync(self):
+        state = {'value': 1}
+        j = journal.Journal(self.filename)
+        j.mark('a', lambda: {'id': 'a', 'value': state['value']})
+        state['value'] = 2
+        j.sync()
+        assert list(j) == [{'id': 'a', 'value': 2}]
+
+    def test_clear(self):
+        j = journal.Journal(self.filename)
+        j.mark('a', lambda: {'id': 'a'})
+        j.sync()
+        j.clear()
+        assert list(j) == []
+        j.mark('b', lambda: {'id': 'b'})
+        j.sync()
+        assert list(j) == [{'id': 'b'}]
+
+    def test_torn_last_line(self):
+        j = journal.Journal(self.filename)
+        j.mark('a', lambda: {'id': 'a'})
+        j.close()
+        with open(self.filename, 'ab') as f:
+            f.write('{"id": "b", "cre')
+        assert list(journal.Journal(self.filename)) == [{'id': 'a'}]
+
+    def test_append_after_torn_line(self):
+        j = journal.Journal(self.filename)
+        j.mark('a', lambda: {'id': 'a'})
+        j.close()
+        with open(self.filename, 'ab') as f:
+            f.write('{"id": "b", "cre')
+        j = journal.Journal(self.filename)
+        j.mark('c', lambda: {'id': 'c'})
+        j.sync()
+        assert list(j) == [{'id': 'a'}, {'id': 'c'}]
+
+
+class TestSessionJournal(TempJournalMixin, TempDatabaseMixin, unittest.TestCase):
+
+    def make_session(self):
+        return session.Session(self.db, journal=journal.Journal(self.filename))
+
+    def test_replay(self):
+        self.db.update([{'_id': 'changed', 'list': [1, 3]},
+                        {'_id': 'deleted'}])
+        S = self.make_session()
+        S['changed']['list'].insert(1, 2)
+        S['changed']['foo'] = 'bar'
+        del S['deleted']
+        S.create({'_id': 'created', 'foo': 'bar'})
+        S._journal.sync()
+        # Pretend the process died and start again.
+        S = self.make_session()
+        S.replay_journal()
+        assert S._changed == set(['changed'])
+        assert S._created == set(['created'])
+        assert set(S._deleted) == set(['deleted'])
+        S.flush()
+        assert self.db['changed']['list'] == [1, 2, 3]
+        assert self.db['changed']['foo'] == 'bar'
+        assert self.db['created']['foo'] == 'bar'
+        assert 'deleted' not in self.db
+        assert list(S._journal) == []
+
+    def test_replay_skips_moved_rev(self):
+        doc_id = self.db.create({})
+        S = self.make_session()
+        S[doc_id]['foo'] = 'bar'
+        S._journal.sync()
+        doc = self.db[doc_id]
+        doc['foo'] = 'baz'
+        self.db[doc_id] = doc
+        S = self.make_session()
+        S.replay_journal()
+        assert not S._changed
+
+    def test_reset_clears(self):
+        S = self.make_session()
+        S.create({})
+        S._journal.sync()
+        S.reset()
+        assert list(S._journal) == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import itertools
+import json
+import threading
 import unittest
 import uuid
 import couchdb
@@ -143,6 +145,111 @@ class TestCaching(PopulatedDatabaseBaseTestCase):
         assert doc_id not in self.session._cache
 
 
+class TestGetMany(PopulatedDatabaseBaseTestCase):
+
+    def test_get_many(self):
+        docs = self.session.get_many(['0', '1', 'missing', '2'])
+        assert [doc and doc['_id'] for doc in docs] == ['0', '1', None, '2']
+        assert isinstance(docs[0], a8n.Tracked)
+        assert docs[0] is self.session.get('0')
+
+    def test_cached(self):
+        doc = self.session.get('0')
+        doc['foo'] = 'bar'
+        docs = self.session.get_many(['0', '1'])
+        assert docs[0] is doc
+        assert docs[0]['foo'] == 'bar'
+
+    def test_created_and_deleted(self):
+        doc_id = self.session.create({})
+        self.session.delete(self.session.get('1'))
+        docs = self.session.get_many([doc_id, '1'])
+        assert docs[0]['_id'] == doc_id
+        assert docs[1] is None
+
+    def test_duplicates(self):
+        docs = self.session.get_many(['0', '0'])
+        assert docs[0] is docs[1]
+
+    def test_batched(self):
+        self.session.batch_size = 3
+        docs = self.session.get_many([str(i) for i in range(10)])
+        assert [doc['_id'] for doc in docs] == [str(i) for i in range(10)]
+
+
+    def test_concurrent(self):
+        db = ConcurrencyDatabase(self.db)
+        S = session.Session(db)
+        S.batch_size = 3
+        S.fetch_concurrency = 2
+        docs = S.get_many([str(i) for i in range(10)])
+        assert [doc['_id'] for doc in docs] == [str(i) for i in range(10)]
+        assert db.views == 4 and db.most_in_flight == 2
+
+
+class TestRevalidate(PopulatedDatabaseBaseTestCase):
+
+    def test_unchanged(self):
+        doc = self.session['0']
+        assert self.session.revalidate(['0']) == []
+        assert self.session['0'] is doc
+
+    def test_unchanged_http_cache(self):
+        self.session['0']
+        assert self.session.revalidate(['0']) == []
+        # The database's HTTP cache is left as it was.
+        assert self.db.get('0')['_id'] == '0'
+        assert session.Session(self.db).get('0')['_id'] == '0'
+
+    def test_changed(self):
+        self.session['0']
+        doc = self.db['0']
+        doc['foo'] = 'bar'
+        self.db.save(doc)
+        assert self.session.revalidate(['0']) == ['0']
+        assert self.session['0']['_rev'] == doc['_rev']
+        assert self.session['0']['foo'] == 'bar'
+        # It's tracked like any other document.
+        self.session['0']['foo'] = 'baz'
+        self.session.flush()
+        assert self.db['0']['foo'] == 'baz'
+
+    def test_edit_stale_reference(self):
+        stale = self.session['0']
+        doc = self.db['0']
+        doc['foo'] = 'bar'
+        self.db.save(doc)
+        assert self.session.revalidate(['0']) == ['0']
+        stale['foo'] = 'baz'
+        assert not self.session._changed
+        self.session.flush()
+        assert self.db['0']['_rev'] == doc['_rev']
+        assert self.session['0']['foo'] == 'bar'
+
+    def test_deleted(self):
+        self.session['0']
+        del self.db['0']
+        assert self.session.revalidate(['0']) == ['0']
+        assert self.session.get('0') is None
+
+    def test_many(self):
+        docs = self.session.get_many(['0', '1', '2'])
+        doc = self.db['1']
+        self.db.save(doc)
+        del self.db['2']
+        assert sorted(self.session.revalidate()) == ['1', '2']
+        assert self.session['0'] is docs[0]
+        assert self.session['1']['_rev'] == doc['_rev']
+        assert self.session.get('2') is None
+
+    def test_dirty(self):
+        self.session['0']['foo'] = 'bar'
+        self.session.create({'_id': 'new'})
+        self.db.save(self.db['0'])
+        assert self.session.revalidate() == []
+        assert self.session['0']['foo'] == 'bar'
+
+
 class TestSessionChangeRecorder(BaseTestCase):
 
     def test_initial(self):
@@ -201,6 +308,129 @@ class TestUpdates(PopulatedDatabaseBaseTestCase):
         assert len(self.session._cache) == 1
         assert len(self.session._changed) == 0
 
+    def test_batched(self):
+        self.session.batch_size = 3
+        for doc in self.session.get_many([str(i) for i in range(10)]):
+            doc['foo'] = 'bar'
+        self.session.flush()
+        assert not self.session._changed
+        for i in range(10):
+            assert self.db.get(str(i))['foo'] == 'bar'
+
+
+class TestBulkUpdate(PopulatedDatabaseBaseTestCase):
+
+    def test_mixed(self):
+        tracked = self.session['0']
+        tracked['foo'] = 'tracked'
+        raw = dict(self.db['1'], foo='raw')
+        new = {'foo': 'new'}
+        results = self.session.update([tracked, raw, new])
+        assert [success for (success, docid, rev) in results] == [True] * 3
+        assert [docid for (success, docid, rev) in results] == ['0', '1', new['_id']]
+        assert raw['_rev'] == results[1][2] and new['_rev'] == results[2][2]
+        for doc_id in ['0', '1', new['_id']]:
+            assert self.db[doc_id]['_rev'] == self.session[doc_id]['_rev']
+        assert [self.db[doc_id]['foo'] for doc_id in ['0', '1', new['_id']]] == \
+                ['tracked', 'raw', 'new']
+
+    def test_tracked_changes(self):
+        actions = []
+        def hook(session, deletions, additions, changes):
+            for doc, doc_actions in changes:
+                actions.extend(doc_actions)
+        S = session.Session(self.db, post_flush_hook=hook)
+        doc = self.db['0']
+        doc['foo'] = 'bar'
+        S.update([doc])
+        assert actions == [{'action': 'create', 'path': ['foo'], 'value': 'bar'}]
+
+    def test_fetched_once(self):
+        counting = CountingDatabase(self.db)
+        S = session.Session(counting)
+        docs = [dict(self.db[str(i)], foo=i) for i in range(5)]
+        S.update(docs)
+        assert counting.views == 1
+        assert [self.db[str(i)]['foo'] for i in range(5)] == range(5)
+
+    def test_conflicts(self):
+        stale = self.db['0']
+        self.db.save(self.db['0'])
+        results = self.session.update([stale, {'_id': '1'}, {'_id': 'missing', '_rev': '1-x'}])
+        assert [success for (success, docid, rev) in results] == [False] * 3
+        assert [docid for (success, docid, rev) in results] == ['0', '1', 'missing']
+        assert all(isinstance(exc, couchdb.ResourceConflict) for (s, d, exc) in results)
+
+    def test_duplicate_conflicts(self):
+        first, second = self.db['0'], self.db['0']
+        first['q'], second['q'] = 1, 2
+        results = self.session.update([first, second])
+        assert results[0] == (True, '0', self.db['0']['_rev'])
+        assert results[1][:2] == (False, '0')
+        assert isinstance(results[1][2], couchdb.ResourceConflict)
+        assert self.db['0']['q'] == 1
+        assert second['_rev'] != self.db['0']['_rev']
+
+    def test_rev_without_id(self):
+        (success, docid, exc), = self.session.update([{'_rev': '1-x'}])
+        assert (success, docid) == (False, None)
+        assert isinstance(exc, couchdb.ResourceConflict)
+
+    def test_delete(self):
+        doc = self.db['0']
+        doc['_deleted'] = True
+        (success, docid, rev), = self.session.update([doc])
+        assert success and docid == '0'
+        assert '0' not in self.db
+
+    def test_unchanged(self):
+        doc = self.db['0']
+        assert self.session.update([doc]) == [(True, '0', doc['_rev'])]
+        assert self.db['0']['_rev'] == doc['_rev']
+
+    def test_flushes_session(self):
+        self.session['2']['foo'] = 'bar'
+        self.session.update([{}])
+        assert self.db['2']['foo'] == 'bar'
+
+
+class CountingDatabase(object):
+    """
+    Database wrapper that counts the views it's asked for.
+    """
+    def __init__(self, db):
+        self._db = db
+        self.views = 0
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+    def view(self, *a, **k):
+        self.views += 1
+        return self._db.view(*a, **k)
+
+
+class ConcurrencyDatabase(CountingDatabase):
+    """
+    Database wrapper whose views wait, for a while, for another to start, and
+    that records the most views in flight at once.
+    """
+    def __init__(self, db):
+        super(ConcurrencyDatabase, self).__init__(db)
+        self._cond = threading.Condition()
+        self.in_flight = self.most_in_flight = 0
+    def view(self, *a, **k):
+        with self._cond:
+            self.views += 1
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            self._cond.notify_all()
+            if self.most_in_flight < 2:
+                self._cond.wait(0.5)
+        try:
+            return list(self._db.view(*a, **k))
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+
 
 class TestCreation(BaseTestCase):
 
@@ -304,6 +534,75 @@ class TestCombinations(PopulatedDatabaseBaseTestCase):
         assert self.db.get(doc_id)['foo'] == 'wibble'
 
 
+class TestSavepoints(PopulatedDatabaseBaseTestCase):
+
+    def test_rollback_changes(self):
+        doc = self.session.get('0')
+        doc['foo'] = 'bar'
+        savepoint = self.session.savepoint()
+        doc['foo'] = 'baz'
+        doc['list'] = [1]
+        self.session.rollback(savepoint)
+        assert doc['foo'] == 'bar'
+        assert 'list' not in doc
+        assert self.session._changed == set(['0'])
+        self.session.flush()
+        assert self.db.get('0')['foo'] == 'bar'
+        assert 'list' not in self.db.get('0')
+
+    def test_rollback_loaded_since(self):
+        savepoint = self.session.savepoint()
+        doc = self.session.get('0')
+        doc['foo'] = 'bar'
+        self.session.rollback(savepoint)
+        assert 'foo' not in doc
+        assert not self.session._changed
+        assert self.session.get('0') is doc
+
+    def test_rollback_created_and_deleted(self):
+        doc = self.session.get('0')
+        savepoint = self.session.savepoint()
+        doc_id = self.session.create({})
+        self.session.delete(doc)
+        self.session.rollback(savepoint)
+        assert not self.session._created
+        assert not self.session._deleted
+        assert self.session.get(doc_id) is None
+        assert self.session.get('0') is doc
+
+    def test_edit_forgotten_after_rollback(self):
+        savepoint = self.session.savepoint()
+        doc_id = self.session.create({})
+        created = self.session.get(doc_id)
+        deleted = self.session.get('0')
+        self.session.delete(deleted)
+        self.session.rollback(savepoint)
+        created['foo'] = 'bar'
+        deleted['foo'] = 'bar'
+        assert not self.session._changed
+        self.session.flush()
+        assert doc_id not in self.db
+        assert 'foo' not in self.db['0']
+
+    def test_nested_savepoints(self):
+        doc = self.session.get('0')
+        outer = self.session.savepoint()
+        doc['a'] = 1
+        inner = self.session.savepoint()
+        doc['b'] = 2
+        self.session.rollback(inner)
+        assert doc['a'] == 1 and 'b' not in doc
+        self.session.rollback(outer)
+        assert 'a' not in doc
+        self.assertRaises(ValueError, self.session.rollback, inner)
+
+    def test_rollback_after_flush(self):
+        savepoint = self.session.savepoint()
+        self.session.get('0')['foo'] = 'bar'
+        self.session.flush()
+        self.assertRaises(ValueError, self.session.rollback, savepoint)
+
+
 class TestFlush(TempDatabaseMixin, unittest.TestCase):
 
     def setUp(self):
@@ -385,6 +684,27 @@ class TestFlushHook(TempDatabaseMixin, unittest.TestCase):
         doc2id = S.create({})
         S.flush()
 
+    def test_actions_are_dicts(self):
+        # Hooks can ship actions as JSON, e.g. to an audit log.
+        logged = []
+        def flush_hook(session, deletions, additions, changes):
+            for doc, actions in changes:
+                actions = list(actions)
+                assert all(type(action) is dict for action in actions)
+                logged.append(json.dumps(actions))
+        S = session.Session(self.db, pre_flush_hook=flush_hook,
+                            post_flush_hook=flush_hook)
+        S.subscribe(flush_hook)
+        doc = S.get(self.db.create({'type': 'tag', 'name': 'foo'}))
+        doc['name'] = 'oof'
+        doc['list'] = [{'a': 1}]
+        S.flush()
+        assert len(logged) == 3
+        assert json.loads(logged[0]) == [
+            {'action': 'edit', 'path': ['name'], 'value': 'oof', 'was': 'foo'},
+            {'action': 'create', 'path': ['list'], 'value': [{'a': 1}]}]
+        assert logged[0] == logged[1] == logged[2]
+
     def test_pre_flush_hook_arg(self):
         S = session.Session(self.db, pre_flush_hook=self._flush_hook)
         self._run_test_with_session(S)
@@ -0,0 +1,138 @@
+import threading
+import unittest
+
+from couchdbsession import group, sessionpool
+from couchdbsession.tests.test_doccache import CountingDatabase
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TestSessionPool(TempDatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSessionPool, self).setUp()
+        self.db.update([{'_id': str(i), 'n': i} for i in range(3)])
+        self.pool = sessionpool.SessionPool(self.db, max_idle=1)
+
+    def test_reused(self):
+        S = self.pool.acquire()
+        self.pool.release(S)
+        assert self.pool.acquire() is S
+        assert self.pool.stats() == {'created': 1, 'reused': 1, 'discarded': 0,
+                                     'in_use': 1, 'idle': 0, 'shared': 0}
+
+    def test_no_leaks(self):
+        S = self.pool.acquire()
+        doc = S['0']
+        doc['n'] = 'unflushed'
+        S.create({'_id': 'created'})
+        self.pool.release(S)
+        doc['n'] = 'after release'
+        S = self.pool.acquire()
+        assert not (S._cache or S._trackers or S._created or S._changed)
+        assert S['0']['n'] == 0
+        S.flush()
+        assert self.db['0']['n'] == 0 and 'created' not in self.db
+
+    def test_batch_writer_reset(self):
+        S = self.pool.acquire()
+        S['0']['n'] = 'flushed'
+        S.flush()
+        S._writer.size = 1
+        self.pool.release(S)
+        S = self.pool.acquire()
+        stats = S.batch_stats()
+        assert stats['batches'] == 0 and stats['size'] == S.batch_size
+
+    def test_changed_sessions_discarded(self):
+        S = self.pool.acquire()
+        S.batch_size = 1
+        self.pool.release(S)
+        S = self.pool.acquire()
+        S.subscribe(lambda *a: None)
+        self.pool.release(S)
+        assert self.pool.acquire().batch_size != 1
+        assert self.pool.stats()['discarded'] == 2
+
+    def test_max_idle(self):
+        sessions = [self.pool.acquire() for i in range(3)]
+        for S in sessions:
+            self.pool.release(S)
+        stats = self.pool.stats()
+        assert stats['idle'] == 1 and stats['discarded'] == 2
+
+    def test_release_unknown(self):
+        S = self.pool.acquire()
+        self.pool.release(S)
+        self.assertRaises(ValueError, self.pool.release, S)
+
+    def test_context_manager(self):
+        with self.pool.session() as S:
+            assert self.pool.stats()['in_use'] == 1
+        assert self.pool.stats()['in_use'] == 0
+
+    def test_threads(self):
+        errors = []
+        def request():
+            try:
+                for i in range(20):
+                    with self.pool.session() as S:
+                        S.get('0')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=request) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
+        stats = self.pool.stats()
+        assert stats['created'] + stats['reused'] == 80 and stats['in_use'] == 0
+
+    def test_shared(self):
+        counting = CountingDatabase(self.db)
+        pool = sessionpool.SessionPool(counting)
+        pool.prewarm(['0', '1', 'missing'])
+        assert pool.stats()['shared'] == 2
+        counting.fetches = 0
+        with pool.session() as S:
+            S['0']['n'] = 'changed'
+            assert [doc['n'] for doc in S.get_many(['0', '1'])] == ['changed', 1]
+        with pool.session() as S:
+            assert S['0']['n'] == 0
+        assert counting.fetches == 0
+
+    def test_shared_written(self):
+        self.pool.prewarm(['0'])
+        with self.pool.session() as S:
+            S['0']['n'] = 'written'
+            S.flush()
+        with self.pool.session() as S:
+            assert S['0']['n'] == 'written'
+        assert self.pool.stats()['shared'] == 0
+
+    def test_shared_written_by_group(self):
+        self.pool.prewarm(['0'])
+        with self.pool.session() as S:
+            S['0']['n'] = 'written'
+            group.SessionGroup({'db': S}).flush()
+        with self.pool.session() as S:
+            assert S['0']['n'] == 'written'
+        assert self.pool.stats()['shared'] == 0
+
+    def test_shared_revalidated(self):
+        self.pool.prewarm(['0', '1'])
+        doc = self.db['0']
+        doc['n'] = 'changed'
+        self.db.save(doc)
+        with self.pool.session() as S:
+            S.get_many(['0', '1'])
+            assert S.revalidate() == ['0']
+            assert S['0']['_rev'] == doc['_rev'] and S['0']['n'] == 'changed'
+        assert self.pool.stats()['shared'] == 1
+
+    def test_journal(self):
+        self.assertRaises(ValueError, sessionpool.SessionPool, self.db, journal=object())
+
+
+if __name__ == '__main__':
+    unittest.main()
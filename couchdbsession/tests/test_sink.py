@@ -0,0 +1,163 @@
+import os
+import threading
+import unittest
+
+from couchdbsession import session, sink
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class Collector(object):
+    """
+    deliver() function that collects the batches it's given, optionally
+    waiting for a gate to open first.
+    """
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.entered = threading.Event()
+    def __call__(self, records):
+        self.entered.set()
+        self.gate.wait()
+        self.batches.append([record['id'] for record in records])
+    @property
+    def ids(self):
+        return [id for batch in self.batches for id in batch]
+
+
+def records(*ids):
+    return [{'id': id} for id in ids]
+
+
+class TestChangeSink(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = Collector()
+        self.sinks = []
+
+    def tearDown(self):
+        self.collector.gate.set()
+        for s in self.sinks:
+            s.close()
+
+    def sink(self, **kwargs):
+        s = sink.ChangeSink(self.collector, **kwargs)
+        self.sinks.append(s)
+        return s
+
+    def hold_worker(self, s):
+        """
+        Keep the worker busy delivering a batch until the gate is opened.
+        """
+        self.collector.gate.clear()
+        s.put(records('held'))
+        self.collector.entered.wait()
+
+    def test_batched(self):
+        s = self.sink(batch_size=2, max_delay=60)
+        s.put(records('a', 'b', 'c'))
+        assert s.flush(5)
+        assert self.collector.batches == [['a', 'b'], ['c']]
+        stats = s.stats()
+        assert stats['delivered'] == 3 and stats['batches'] == 2 and stats['depth'] == 0
+
+    def test_delay(self):
+        s = self.sink(batch_size=100, max_delay=0.01)
+        s.put(records('a'))
+        self.collector.entered.wait(5)
+        assert self.collector.entered.is_set()
+
+    def test_close_delivers(self):
+        s = self.sink(batch_size=100, max_delay=60)
+        s.put(records('a', 'b'))
+        s.close()
+        assert self.collector.ids == ['a', 'b']
+        self.assertRaises(ValueError, s.put, records('c'))
+
+    def test_drop(self):
+        s = self.sink(max_queue=2, policy='drop')
+        self.hold_worker(s)
+        s.put(records('a', 'b', 'c'))
+        stats = s.stats()
+        assert stats['dropped'] == 1 and stats['depth'] == 2 and stats['lag'] >= 0
+        self.collector.gate.set()
+        s.flush(5)
+        assert self.collector.ids == ['held', 'a', 'b']
+
+    def test_spill(self):
+        s = self.sink(max_queue=2, policy='spill', batch_size=2)
+        filename = s._spill.filename
+        self.hold_worker(s)
+        s.put(records('a', 'b', 'c'))
+        s.put(records('d'))
+        assert s.stats()['spilled'] == 2
+        self.collector.gate.set()
+        s.close()
+        assert self.collector.ids == ['held', 'a', 'b', 'c', 'd']
+        assert not os.path.exists(filename)
+
+    def test_block(self):
+        s = self.sink(max_queue=1)
+        self.hold_worker(s)
+        s.put(records('a'))
+        blocked = threading.Thread(target=s.put, args=(records('b'),))
+        blocked.start()
+        blocked.join(0.05)
+        assert blocked.is_alive()
+        self.collector.gate.set()
+        blocked.join(5)
+        s.flush(5)
+        assert self.collector.ids == ['held', 'a', 'b']
+
+    def test_retries(self):
+        failures = []
+        def deliver(records):
+            if len(failures) < 2:
+                failures.append(records)
+                raise IOError()
+            self.collector(records)
+        s = sink.ChangeSink(deliver, retries=2, retry_delay=0)
+        self.sinks.append(s)
+        s.put(records('a'))
+        s.flush(5)
+        assert self.collector.ids == ['a'] and s.stats()['failed'] == 0
+
+    def test_failed(self):
+        def deliver(records):
+            raise IOError()
+        s = sink.ChangeSink(deliver, retries=1, retry_delay=0)
+        self.sinks.append(s)
+        s.put(records('a'))
+        s.flush(5)
+        assert s.stats()['failed'] == 1
+
+    def test_policy(self):
+        self.assertRaises(ValueError, sink.ChangeSink, self.collector, policy='never')
+
+
+class TestSessionSink(TempDatabaseMixin, unittest.TestCase):
+
+    def test_post_flush_hook(self):
+        delivered = []
+        s = sink.ChangeSink(delivered.extend)
+        self.db.update([{'_id': 'changed', 'foo': 1}, {'_id': 'deleted'}])
+        S = session.Session(self.db, post_flush_hook=s)
+        S['changed']['foo'] = 2
+        del S['deleted']
+        S.create({'_id': 'created'})
+        S.flush()
+        # Records are copies, unaffected by later changes.
+        S['changed']['foo'] = 3
+        s.close()
+        by_id = dict((record['id'], record) for record in delivered)
+        assert sorted(by_id) == ['changed', 'created', 'deleted']
+        assert [by_id[id]['kind'] for id in ['changed', 'created', 'deleted']] == \
+                ['changed', 'created', 'deleted']
+        assert by_id['changed']['doc']['foo'] == 2
+        assert by_id['changed']['rev'] == self.db['changed']['_rev']
+        assert by_id['changed']['actions'] == \
+                [{'action': 'edit', 'path': ['foo'], 'value': 2, 'was': 1}]
+
+
+if __name__ == '__main__':
+    unittest.main()
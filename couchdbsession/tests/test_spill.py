@@ -0,0 +1,152 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from couchdbsession import journal, session, spill
+from couchdbsession.tests.test_session import TempDatabaseMixin
+
+
+class TestSpillStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = spill.SpillStore()
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_put_get(self):
+        now = datetime.datetime.utcnow()
+        self.store.put_many([('a', {'when': now}), ('b', 2)])
+        assert len(self.store) == 2
+        assert self.store.get('a') == {'when': now}
+        assert self.store.get('missing') is None
+
+    def test_pop(self):
+        self.store.put_many([('a', 1)])
+        assert self.store.pop('a') == 1
+        assert self.store.pop('a') is None
+        assert len(self.store) == 0
+
+    def test_shared_references(self):
+        value = {'foo': 'bar'}
+        self.store.put_many([('a', {'doc': {'value': value}, 'changes': [value]})])
+        record = self.store.get('a')
+        assert record['doc']['value'] is record['changes'][0]
+
+    def test_close_removes_file(self):
+        store = spill.SpillStore()
+        store.close()
+        assert not os.path.exists(store.filename)
+
+
+class SpillSessionMixin(object):
+    def setUp(self):
+        super(SpillSessionMixin, self).setUp()
+        self.db.update([{'_id': str(i), 'list': []} for i in range(10)])
+        self.store = spill.SpillStore()
+        self.session = session.Session(self.db, spill=self.store)
+        self.session.spill_threshold = 2
+    def tearDown(self):
+        self.store.close()
+        super(SpillSessionMixin, self).tearDown()
+
+
+class TestSessionSpill(SpillSessionMixin, TempDatabaseMixin, unittest.TestCase):
+
+    def test_spill(self):
+        for i in range(3):
+            self.session[str(i)]['foo'] = i
+        assert not self.session._spilled
+        self.session.get('3')
+        assert self.session._spilled == set(['0', '1', '2'])
+        assert '0' not in self.session._cache
+        assert len(self.store) == 3
+
+    def test_rehydrate(self):
+        for i in range(3):
+            self.session[str(i)]['list'].append(i)
+        self.session.create({'_id': 'new'})
+        assert '0' in self.session._spilled
+        doc = self.session['0']
+        assert '0' not in self.session._spilled
+        assert doc['list'] == [0]
+        assert list(self.session._trackers['0']) == [
+            {'action': 'create', 'path': ['list', 0], 'value': 0}]
+        doc['list'].append(1)
+        self.session.flush()
+        assert self.db['0']['list'] == [0, 1]
+
+    def test_edit_held_doc_after_spill(self):
+        held = self.session['0']
+        held['foo'] = 0
+        for i in range(1, 3):
+            self.session[str(i)]['foo'] = i
+        self.session.create({'_id': 'new'})
+        assert '0' in self.session._spilled
+        # The held copy is no longer tracked ...
+        held['foo'] = 'held'
+        held['bar'] = 'held'
+        assert '0' in self.session._spilled
+        # ... but the session's copy is.
+        doc = self.session['0']
+        assert doc is not held
+        assert doc['foo'] == 0
+        doc['bar'] = 'session'
+        self.session.flush()
+        assert self.db['0']['foo'] == 0
+        assert self.db['0']['bar'] == 'session'
+
+    def test_edit_held_doc_after_spill_journaled(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            j = journal.Journal(os.path.join(tempdir, 'journal'))
+            S = session.Session(self.db, spill=self.store, journal=j)
+            S.spill_threshold = 2
+            S.create({'_id': 'new'})
+            held = S['new']
+            for i in range(3):
+                S[str(i)]['foo'] = i
+            assert 'new' in S._spilled
+            held['foo'] = 'held'
+            j.sync()
+            S.flush()
+            assert 'foo' not in self.db['new']
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_flush(self):
+        for i in range(10):
+            self.session[str(i)]['foo'] = i
+        self.session.create({'_id': 'new'})
+        self.session.batch_size = 3
+        self.session.flush()
+        assert not self.session._spilled
+        assert len(self.store) == 0
+        for i in range(10):
+            assert self.db[str(i)]['foo'] == i
+        assert 'new' in self.db
+        # Spilled docs are forgotten and fetched again.
+        doc = self.session['0']
+        doc['foo'] = 'bar'
+        self.session.flush()
+        assert self.db['0']['foo'] == 'bar'
+
+    def test_post_flush_hook(self):
+        state = {}
+        def post_flush_hook(session, deletions, additions, changes):
+            for doc, actions in changes:
+                state[doc['_id']] = (doc['_rev'], list(actions))
+        self.session._post_flush_hook = post_flush_hook
+        for i in range(3):
+            self.session[str(i)]['foo'] = i
+        self.session.get('3')
+        self.session.flush()
+        assert sorted(state) == ['0', '1', '2']
+        assert state['0'] == (self.db['0']['_rev'],
+                              [{'action': 'create', 'path': ['foo'], 'value': 0}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+import BaseHTTPServer
+import errno
+import gzip
+import hashlib
+import json
+import socket
+import SocketServer
+import StringIO
+import threading
+import time
+import unittest
+import couchdb
+
+from couchdbsession import session, transport
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in CouchDB that understands just enough to bulk update and fetch
+    documents, gzipping responses for clients that accept it.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers), None))
+        if self.path.endswith('/garbage'):
+            self.wfile.write('HTTP/1.1 garbage\r\n')
+            self.close_connection = 1
+            return
+        self._respond('{}')
+        # Close the connection without telling the client.
+        if self.path.endswith('/close'):
+            self.close_connection = 1
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.requests.append((self.path, dict(self.headers), body))
+        if self.path.endswith('/_bulk_docs'):
+            result = [{'id': doc['_id'], 'rev': '1-x'}
+                      for doc in json.loads(body)['docs']]
+        else:
+            result = {'rows': [{'id': key, 'key': key, 'value': {'rev': '1-x'},
+                                'doc': {'_id': key, '_rev': '1-x', 'data': _data(key)}}
+                               for key in json.loads(body)['keys']]}
+        self._respond(json.dumps(result))
+
+    def _read_body(self):
+        if self.headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    break
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers['content-length']))
+        if self.headers.get('content-encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+        return body
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('accept-encoding', ''):
+            buf = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _data(key):
+    return hashlib.sha1(key).hexdigest() * 4
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Requests the client gives up on part way through are expected.
+        pass
+
+
+class StandInServerMixin(object):
+
+    def setUp(self):
+        super(StandInServerMixin, self).setUp()
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.httpd.requests = []
+        self.httpd.connections = []
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/db' % self.httpd.server_port
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        # Hang up on keep-alive connections so their threads finish.
+        for conn in self.httpd.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        super(StandInServerMixin, self).tearDown()
+
+    def database(self, **kwargs):
+        return couchdb.Database(self.url, session=transport.CompressingSession(**kwargs))
+
+
+class TestCompressingSession(StandInServerMixin, unittest.TestCase):
+
+    def test_small_body(self):
+        db = self.database()
+        assert db.update([{'_id': 'a'}]) == [(True, u'a', u'1-x')]
+        path, headers, body = self.httpd.requests[0]
+        assert 'content-encoding' not in headers
+        assert json.loads(body) == {'docs': [{'_id': 'a'}]}
+
+    def test_large_body(self):
+        db = self.database(min_size=1024)
+        docs = [{'_id': str(i), 'data': u'\xe9' * 100} for i in range(100)]
+        sent = json.loads(json.dumps({'docs': docs}))
+        results = db.update(docs)
+        assert [r[1] for r in results] == [str(i) for i in range(100)]
+        path, headers, body = self.httpd.requests[0]
+        assert headers['content-encoding'] == 'gzip'
+        assert headers['transfer-encoding'] == 'chunked'
+        assert json.loads(body) == sent
+
+    def test_compressed_response(self):
+        db = self.database()
+        rows = list(db.view('_all_docs', keys=['a', 'b'], include_docs=True))
+        assert [row.doc['_id'] for row in rows] == ['a', 'b']
+        assert 'gzip' in self.httpd.requests[0][1]['accept-encoding']
+
+    def test_uncompressed_response(self):
+        db = self.database(accept_gzip=False)
+        rows = list(db.view('_all_docs', keys=['a'], include_docs=True))
+        assert rows[0].doc['data'] == _data('a')
+
+    def test_large_response(self):
+        # Big enough that couchdb-python streams rather than buffers it.
+        db = self.database()
+        keys = [str(i) for i in range(1000)]
+        rows = list(db.view('_all_docs', keys=keys, include_docs=True))
+        assert [row.doc['data'] for row in rows] == [_data(key) for key in keys]
+
+    def test_body_rereadable(self):
+        body = transport.GzipBody({'docs': [{'_id': 'a'}] * 1000})
+        first = ''.join(iter(lambda: body.read(100), ''))
+        second = ''.join(iter(lambda: body.read(100), ''))
+        assert first == second
+        assert json.loads(gzip.GzipFile(fileobj=StringIO.StringIO(first)).read()) \
+                == {'docs': [{'_id': 'a'}] * 1000}
+
+
+    def test_body_rewound_on_retry(self):
+        pool = transport.ConnectionPool()
+        db = self.database(min_size=1024, pool=pool)
+        # Fail the first attempt after the headers and the first chunk of
+        # the body have been sent.
+        conn = pool.get(self.url)
+        send, sends = conn.send, []
+        def flaky_send(data):
+            sends.append(data)
+            if len(sends) == 3:
+                raise socket.error(errno.ECONNRESET)
+            return send(data)
+        conn.send = flaky_send
+        pool.release(self.url, conn)
+        docs = [{'_id': str(i), 'data': _data(str(i))} for i in range(1000)]
+        sent = json.loads(json.dumps({'docs': docs}))
+        results = db.update(docs)
+        assert len(sends) > 3
+        assert [r[1] for r in results] == [str(i) for i in range(1000)]
+        path, headers, body = self.httpd.requests[-1]
+        assert json.loads(body) == sent
+
+
+class TestConnectionPool(StandInServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.pool = transport.ConnectionPool(max_per_host=2, wait_timeout=0.1)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestConnectionPool, self).tearDown()
+
+    def get(self, path=''):
+        session = transport.CompressingSession(pool=self.pool)
+        return session.request('GET', self.url + path)
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.get()
+        stats = self.pool.stats()
+        assert (stats['created'], stats['reused'], stats['idle']) == (1, 2, 1)
+        assert stats['hosts']['http://127.0.0.1:%d' % self.httpd.server_port]['reused'] == 2
+
+    def test_shared(self):
+        assert transport.CompressingSession().connection_pool is transport.default_pool()
+        assert transport.CompressingSession().connection_pool is transport.default_pool()
+
+    def test_max_per_host(self):
+        a, b = self.pool.get(self.url), self.pool.get(self.url)
+        self.assertRaises(transport.PoolTimeout, self.pool.get, self.url)
+        self.pool.release(self.url, a)
+        assert self.pool.get(self.url) is a
+        assert self.pool.stats()['waited'] == 1
+
+    def test_waits_for_release(self):
+        pool = transport.ConnectionPool(max_per_host=1)
+        conn = pool.get(self.url)
+        timer = threading.Timer(0.1, pool.release, [self.url, conn])
+        timer.start()
+        assert pool.get(self.url) is conn
+        assert pool.stats()['waited'] >= 1
+        timer.join()
+
+    def test_max_idle(self):
+        pool = transport.ConnectionPool(max_per_host=2, max_idle=1)
+        a, b = pool.get(self.url), pool.get(self.url)
+        pool.release(self.url, a)
+        pool.release(self.url, b)
+        stats = pool.stats()
+        assert (stats['idle'], stats['closed']) == (1, 1)
+        # Releasing twice does nothing.
+        pool.release(self.url, a)
+        assert pool.stats()['idle'] == 1
+
+    def test_closed_by_server(self):
+        self.get('/close')
+        time.sleep(0.1)
+        self.get()
+        stats = self.pool.stats()
+        assert (stats['created'], stats['reused'], stats['closed']) == (2, 0, 1)
+
+    def test_idle_timeout(self):
+        now = [0]
+        pool = transport.ConnectionPool(idle_timeout=10, clock=lambda: now[0])
+        pool.release(self.url, pool.get(self.url))
+        now[0] = 11
+        pool.get(self.url)
+        assert pool.stats()['created'] == 2
+
+    def test_failed_request(self):
+        from httplib import BadStatusLine
+        self.assertRaises(BadStatusLine, self.get, '/garbage')
+        stats = self.pool.stats()
+        assert (stats['in_use'], stats['closed']) == (0, 1)
+
+    def test_closed_lease(self):
+        a, b = self.pool.get(self.url), self.pool.get(self.url)
+        a.close()
+        assert self.pool.get(self.url) is not a
+
+
+class TestSessionTransport(StandInServerMixin, unittest.TestCase):
+
+    def test_flush_and_get_many(self):
+        S = session.Session(self.database(min_size=0))
+        docs = S.get_many(['a', 'b'])
+        assert [doc['_id'] for doc in docs] == ['a', 'b']
+        docs[0]['data'] = 'y'
+        S.flush()
+        path, headers, body = self.httpd.requests[-1]
+        assert path.endswith('/_bulk_docs')
+        assert headers['content-encoding'] == 'gzip'
+        assert json.loads(body)['docs'][0]['data'] == 'y'
+
+
+if __name__ == '__main__':
+    unittest.main()
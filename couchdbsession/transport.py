@@ -0,0 +1,436 @@
+"""
+HTTP transport for couchdb-python that shares a bounded pool of keep-alive
+connections, compresses large request bodies and accepts gzip compressed
+responses.
+
+Use it wherever couchdb-python takes an http session:
+
+    db = couchdb.Database(url, session=transport.CompressingSession())
+    session = Session(db)
+
+Unless given a pool, every CompressingSession shares the connections of
+default_pool(), so short-lived sessions reuse connections rather than
+each opening, and leaving in TIME_WAIT, their own.
+
+JSON request bodies, e.g. a flush's _bulk_docs or a get_many's _all_docs
+keys, are encoded incrementally. A body that stays under min_size bytes is
+sent as is; a larger one is gzipped as it is encoded and sent using chunked
+transfer encoding, so neither the encoded nor the compressed body is ever
+held in memory in full.
+
+Responses with a gzip Content-Encoding are decompressed as they are read.
+
+ConnectionPool limits the number of connections open to each host, blocking
+until one is released when the limit is reached, and keeps at most
+max_idle of them open between requests. An idle connection is checked
+before it's reused and is replaced if it has been idle for longer than
+idle_timeout or the server has closed it.
+
+Known limitations:
+    * CompressingSession is not thread safe; ConnectionPool is.
+    * Socket timeouts are a property of the pool, not the session.
+    * Continuous and event source _changes feeds are never compressed.
+"""
+
+import httplib
+import json
+import select
+import thread
+import threading
+import time
+import zlib
+
+from couchdb import http, util
+
+
+# Bodies smaller than this aren't worth compressing.
+MIN_SIZE = 16 * 1024
+
+# Feeds that are read by couchdb-python straight from the socket.
+_STREAMED_FEEDS = ('feed=continuous', 'feed=eventsource')
+
+
+# The compressed body, if any, of the request each thread is sending.
+_sending = threading.local()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    """
+    Return the pool shared by sessions that aren't given one.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+class PoolTimeout(Exception):
+    """
+    No connection became available within the pool's wait_timeout.
+    """
+
+
+class CompressingSession(http.Session):
+
+    def __init__(self, min_size=MIN_SIZE, level=6, accept_gzip=True, pool=None,
+                 **kwargs):
+        http.Session.__init__(self, **kwargs)
+        self.min_size = min_size
+        self.level = level
+        self.accept_gzip = accept_gzip
+        if pool is None:
+            pool = default_pool()
+        self.connection_pool = pool
+
+    def disable_ssl_verification(self):
+        self._disable_ssl_verification = True
+        self.connection_pool = ConnectionPool(self._timeout,
+                                              disable_ssl_verification=True)
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if self.accept_gzip and not [f for f in _STREAMED_FEEDS if f in url]:
+            headers.setdefault('Accept-Encoding', 'gzip')
+        if body is not None and not isinstance(body, basestring) \
+                and not hasattr(body, 'read'):
+            headers.setdefault('Content-Type', 'application/json')
+            body = self._encode(body, headers)
+        # couchdb-python neither releases nor closes a connection when a
+        # request fails part way through, so give back anything leased.
+        pool = self.connection_pool
+        leased = pool.leased_by(thread.get_ident())
+        _sending.body = body if isinstance(body, GzipBody) else None
+        try:
+            return http.Session.request(self, method, url, body, headers, **kwargs)
+        except:
+            for conn in pool.leased_by(thread.get_ident()) - leased:
+                pool.discard(conn)
+            raise
+        finally:
+            _sending.body = None
+
+    def _encode(self, body, headers):
+        """
+        Encode body as JSON, returning either the encoded string or, once it
+        reaches min_size, a file-like object that compresses as it's read.
+        """
+        chunks = _iterencode(body)
+        head, size = [], 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if self.min_size is not None and size >= self.min_size:
+                break
+        else:
+            return ''.join(head)
+        headers['Content-Encoding'] = 'gzip'
+        return GzipBody(body, self.level)
+
+
+class GzipBody(object):
+    """
+    File-like, gzip compressed, JSON encoding of an object.
+
+    Reading starts again from the beginning once the end has been reached
+    or the body is rewound. The pool's connections rewind the body at the
+    start of every attempt at sending it, so a request that couchdb-python
+    retries after a partial send is resent in full.
+    """
+
+    def __init__(self, obj, level=6):
+        self._obj = obj
+        self._level = level
+        self.rewind()
+
+    def rewind(self):
+        self._chunks = _iterencode(self._obj)
+        self._compressor = zlib.compressobj(self._level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while self._chunks is not None and (size < 0 or len(self._buffer) < size):
+            chunk = ''.join(_take(self._chunks, http.CHUNK_SIZE))
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._chunks = None
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if not data and self._chunks is None:
+            self.rewind()
+        return data
+
+
+class GzipResponse(httplib.HTTPResponse):
+    """
+    HTTPResponse that decompresses a gzip encoded body as it's read.
+    """
+
+    def begin(self):
+        httplib.HTTPResponse.begin(self)
+        self._gzipped = (self.getheader('content-encoding') or '').lower() == 'gzip'
+        if self._gzipped:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._decoded = ''
+
+    def read(self, amt=None):
+        if not self._gzipped:
+            return httplib.HTTPResponse.read(self, amt)
+        # Keep reading until there's amt decompressed bytes to return;
+        # couchdb-python treats a short read as the end of the body.
+        while self._decompressor is not None and (amt is None or len(self._decoded) < amt):
+            data = httplib.HTTPResponse.read(self, http.CHUNK_SIZE if amt else None)
+            if data:
+                self._decoded += self._decompressor.decompress(data)
+            if not data or amt is None:
+                self._decoded += self._decompressor.flush()
+                self._decompressor = None
+        if amt is None:
+            amt = len(self._decoded)
+        data, self._decoded = self._decoded[:amt], self._decoded[amt:]
+        return data
+
+
+class ConnectionPool(object):
+    """
+    Bounded, thread safe, pool of keep-alive connections whose responses
+    are decompressed if gzip encoded.
+
+    max_per_host limits the connections, in use or idle, open to each host
+    and max_idle the connections kept open while idle. wait_timeout is how
+    long get waits for a connection when max_per_host have been taken
+    before raising PoolTimeout; None waits forever.
+    """
+
+    def __init__(self, timeout=None, max_per_host=10, max_idle=None,
+                 idle_timeout=60.0, wait_timeout=None,
+                 disable_ssl_verification=False, clock=time.time):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle if max_idle is not None else max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.disable_ssl_verification = disable_ssl_verification
+        self._clock = clock
+        self._lock = threading.Condition()
+        # Per host state, by (scheme, host).
+        self._hosts = {}
+        # Leased connections, mapped to their host and the leasing thread.
+        self._leases = {}
+
+    def get(self, url):
+        key = tuple(util.urlsplit(url, 'http', False)[:2])
+        with self._lock:
+            host = self._host(key)
+            deadline, waited = None, False
+            if self.wait_timeout is not None:
+                deadline = self._clock() + self.wait_timeout
+            while True:
+                conn = self._reuse(host)
+                if conn is not None:
+                    host.stats['reused'] += 1
+                    break
+                self._prune(host)
+                if self.max_per_host is None or \
+                        host.in_use + len(host.idle) < self.max_per_host:
+                    break
+                if not waited:
+                    host.stats['waited'] += 1
+                    waited = True
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        raise PoolTimeout('No connection to %s://%s available' % key)
+                # Leases can be lost by closing their connection rather than
+                # releasing it, so wake up now and then to look for them.
+                self._lock.wait(min(remaining, 1.0) if remaining is not None else 1.0)
+            host.in_use += 1
+        if conn is None:
+            try:
+                conn = self._connect(key)
+            except:
+                with self._lock:
+                    host.in_use -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                host.stats['created'] += 1
+        with self._lock:
+            self._leases[conn] = (key, thread.get_ident())
+        return conn
+
+    def release(self, url, conn):
+        with self._lock:
+            lease = self._leases.pop(conn, None)
+            # couchdb-python sometimes releases a connection twice.
+            if lease is None:
+                return
+            host = self._hosts[lease[0]]
+            host.in_use -= 1
+            if conn.sock is None or len(host.idle) >= self.max_idle:
+                conn.close()
+                host.stats['closed'] += 1
+            else:
+                host.idle.append((conn, self._clock()))
+            self._lock.notify()
+
+    def discard(self, conn):
+        """
+        Close a leased connection that can't be released for reuse.
+        """
+        with self._lock:
+            lease = self._leases.pop(conn, None)
+            if lease is None:
+                return
+            conn.close()
+            host = self._hosts[lease[0]]
+            host.in_use -= 1
+            host.stats['closed'] += 1
+            self._lock.notify()
+
+    def leased_by(self, ident):
+        """
+        Return the set of connections leased by the thread with ident.
+        """
+        with self._lock:
+            return set(conn for (conn, lease) in self._leases.iteritems()
+                       if lease[1] == ident)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for host in self._hosts.itervalues():
+                for conn, released in host.idle:
+                    conn.close()
+                    host.stats['closed'] += 1
+                del host.idle[:]
+
+    def stats(self):
+        """
+        Return counts of connections created, reused, closed and waited for,
+        and currently in use or idle, in total and by host.
+        """
+        with self._lock:
+            totals = dict.fromkeys(_Host.STATS + ('in_use', 'idle'), 0)
+            hosts = {}
+            for key, host in self._hosts.iteritems():
+                stats = dict(host.stats, in_use=host.in_use, idle=len(host.idle))
+                hosts['%s://%s' % key] = stats
+                for name, value in stats.iteritems():
+                    totals[name] += value
+            totals['hosts'] = hosts
+            return totals
+
+    def _host(self, key):
+        host = self._hosts.get(key)
+        if host is None:
+            host = self._hosts[key] = _Host()
+        return host
+
+    def _reuse(self, host):
+        """
+        Pop the most recently used healthy idle connection, closing any that
+        aren't healthy.
+        """
+        now = self._clock()
+        while host.idle:
+            conn, released = host.idle.pop()
+            if self._healthy(conn, now - released):
+                return conn
+            conn.close()
+            host.stats['closed'] += 1
+        return None
+
+    def _healthy(self, conn, idle):
+        if conn.sock is None:
+            return False
+        if self.idle_timeout is not None and idle > self.idle_timeout:
+            return False
+        # An idle connection should have nothing to read; if it has then
+        # the server has closed it or it's out of step.
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, ValueError):
+            return False
+        return not readable
+
+    def _prune(self, host):
+        """
+        Forget leases whose connection has been closed instead of released.
+        """
+        for conn, (key, ident) in self._leases.items():
+            if conn.sock is None and self._hosts[key] is host:
+                del self._leases[conn]
+                host.in_use -= 1
+                host.stats['closed'] += 1
+
+    def _connect(self, key):
+        scheme, netloc = key
+        if scheme == 'http':
+            cls = http.HTTPConnection
+        elif scheme == 'https':
+            if self.disable_ssl_verification:
+                cls = http.InsecureHTTPSConnection
+            else:
+                cls = http.HTTPSConnection
+        else:
+            raise ValueError('%s is not a supported scheme' % scheme)
+        conn = cls(netloc, timeout=self.timeout)
+        conn.response_class = GzipResponse
+        conn.putrequest = _rewinding(conn.putrequest)
+        conn.connect()
+        return conn
+
+
+class _Host(object):
+
+    STATS = ('created', 'reused', 'closed', 'waited')
+
+    def __init__(self):
+        self.idle = []
+        self.in_use = 0
+        self.stats = dict.fromkeys(self.STATS, 0)
+
+
+def _rewinding(putrequest):
+    """
+    Wrap a connection's putrequest, which couchdb-python calls to start each
+    attempt at a request, to rewind the body the thread is sending.
+    """
+    def wrapper(*args, **kwargs):
+        body = getattr(_sending, 'body', None)
+        if body is not None:
+            body.rewind()
+        return putrequest(*args, **kwargs)
+    return wrapper
+
+
+def _iterencode(obj):
+    encoder = json.JSONEncoder(allow_nan=False, ensure_ascii=False)
+    for chunk in encoder.iterencode(obj):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        yield chunk
+
+
+def _take(chunks, size):
+    """
+    Take chunks until at least size bytes have been taken.
+    """
+    taken = 0
+    for chunk in chunks:
+        yield chunk
+        taken += len(chunk)
+        if taken >= size:
+            return
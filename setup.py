@@ -20,7 +20,6 @@ setup(name='couchdb-session',
       install_requires=[
           # -*- Extra requirements: -*-
           'couchdb',
-          'simplegeneric',
           'ProxyTypes',
       ],
       entry_points="""